@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Apply a plan written by postrecsort.py --plan=<file> (see moveplan.py).
+"""
+import sys
+
+import transfer
+from moveplan import applyPlan
+from moveplan import undoPlan
+from moveplan import journalSuffix
+from moveplan import trashSuffix
+
+
+def usage():
+    print(sys.argv[0] + " <plan file> [options]")
+    print("")
+    print("options:")
+    print("--dry-run          Only show what would be done.")
+    print("--streams=<count>  Move <count> files at once (for other disks).")
+    print("--verify           Read each file copied to another disk back from")
+    print("                   the disk and compare it to the original before")
+    print("                   removing the original.")
+    print("--undo             Put back everything that was done by applying")
+    print("                   the plan (see the <plan file>" + journalSuffix
+          + " journal).")
+    print("")
+    print("If applying is interrupted, run it again to resume.")
+    print("Removed files are moved to <plan file>" + trashSuffix + ", so")
+    print("delete that folder yourself after checking the result.")
+
+
+if __name__ == "__main__":
+    planPath = None
+    enableDryRun = False
+    enableUndo = False
+    streamCount = 1
+    for arg in sys.argv[1:]:
+        if arg == "--dry-run":
+            enableDryRun = True
+        elif arg == "--undo":
+            enableUndo = True
+        elif arg == "--verify":
+            transfer.enableVerify = True
+        elif arg.startswith("--streams="):
+            try:
+                streamCount = int(arg[len("--streams="):])
+            except ValueError:
+                usage()
+                print("")
+                print("ERROR: --streams must be a number such as --streams=4")
+                exit(1)
+        elif arg[:2] == "--":
+            usage()
+            print("")
+            print("ERROR: Unknown option: " + arg)
+            exit(1)
+        elif planPath is None:
+            planPath = arg
+        else:
+            usage()
+            exit(1)
+    if planPath is None:
+        usage()
+        print("")
+        print("ERROR: You must specify a plan file.")
+        exit(1)
+    if enableUndo:
+        results = undoPlan(planPath, dryRun=enableDryRun)
+    else:
+        results = applyPlan(planPath, dryRun=enableDryRun,
+                            streamCount=streamCount)
+    for k, v in results.items():
+        print(k + ": " + str(v))
+    if enableDryRun:
+        print("# dry run: nothing was changed")
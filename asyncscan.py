@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Read many files at once when each filesystem call is slow (such as a
+PhotoRec result on a network share or a slow USB bridge), where waiting
+for each os.stat or open in turn leaves the link idle.
+
+The walk and a read function for each file run in a bounded pool of
+threads driven by asyncio, so up to concurrency calls are in flight at
+a time. The results are handled in this thread in the same order as a
+plain walk would visit the files, so moves and counts are the same as
+without it.
+
+Usage:
+def read(folderPath, depth, entry):
+    # in a thread: only read, and return what handle needs
+    return entry.path, entry.stat().st_size
+
+def handle(result):
+    # in this thread, in walk order
+    ...
+
+mapFilesInOrder(folderPath, read, handle, concurrency=32)
+"""
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from treewalk import walkEntries
+
+defaultConcurrency = 16  # filesystem calls in flight (see --async)
+# Files read ahead of the one being handled, per thread (this bounds
+# the results held in memory while waiting for a slow file).
+windowFactor = 4
+
+
+async def walkEntriesAsync(executor, topPath, **walkOptions):
+    """
+    Yield the same tuples as walkEntries, listing each directory in
+    executor. The next directory is listed while the caller uses the
+    current one, so the caller can't remove entries from dirEntries to
+    prevent walking into them.
+    """
+    loop = asyncio.get_running_loop()
+    walker = walkEntries(topPath, **walkOptions)
+    nextFolder = loop.run_in_executor(executor, next, walker, None)
+    while True:
+        folder = await nextFolder
+        if folder is None:
+            return
+        nextFolder = loop.run_in_executor(executor, next, walker, None)
+        yield folder
+
+
+async def mapFilesInOrderAsync(folderPath, read, handle, concurrency,
+                               selectFiles=None, **walkOptions):
+    loop = asyncio.get_running_loop()
+    window = max(concurrency * windowFactor, 1)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            async for subFolderPath, depth, dirEntries, fileEntries in \
+                    walkEntriesAsync(executor, folderPath, **walkOptions):
+                if selectFiles is not None:
+                    fileEntries = selectFiles(subFolderPath, fileEntries)
+                for entry in fileEntries:
+                    if len(pending) >= window:
+                        handle(await pending.popleft())
+                    pending.append(loop.run_in_executor(
+                        executor, read, subFolderPath, depth, entry
+                    ))
+            while pending:
+                handle(await pending.popleft())
+        finally:
+            # Don't start reads whose results can't be handled.
+            for future in pending:
+                future.cancel()
+
+
+def mapFilesInOrder(folderPath, read, handle, concurrency=None,
+                    selectFiles=None, **walkOptions):
+    """
+    Call read(subFolderPath, depth, entry) in a thread for each file
+    under folderPath (see walkEntries for the walkOptions), and call
+    handle with each result in this thread in walk order. An exception
+    from read or handle stops the walk and is raised here.
+
+    Keyword arguments:
+    concurrency -- (default defaultConcurrency) the number of threads,
+                   which is the number of filesystem calls in flight
+    selectFiles -- If not None, only read the files returned by
+                   selectFiles(subFolderPath, fileEntries) (called in this
+                   thread in walk order, such as PassState.selectFiles)
+    """
+    if concurrency is None:
+        concurrency = defaultConcurrency
+    asyncio.run(mapFilesInOrderAsync(folderPath, read, handle,
+                                     concurrency, selectFiles=selectFiles,
+                                     **walkOptions))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+Find songs that have the same audio even if their tags differ, such as
+the same MP3 carved twice with different ID3v1, ID3v2 or APE tags, or
+with junk from the next sector after the last frame.
+
+Only the audio payload is hashed: ID3v2 tags are skipped at the start,
+and ID3v1, APE and Lyrics3 tags are skipped at the end. For MP3 (and
+other MPEG audio) the frames are walked using their headers and only
+complete frames are hashed, so trailing junk is left out. For FLAC the
+metadata blocks are skipped and the rest of the file is hashed (so junk
+after a FLAC stream is not left out). The MD5 in the STREAMINFO block is
+not used, since a truncated copy has the same one as the intact file.
+The length of the payload is part of the digest.
+"""
+import os
+import struct
+
+from dedupe import newHasher
+from dedupe import readChunkSize
+from scancache import cachedFact
+from metrics import count
+from metrics import timed
+
+payloadExts = set(["mp3", "mp2", "mpa", "flac"])
+maxSyncSearch = 64 * 1024  # bytes to search for the first MPEG frame
+maxTrailingTags = 8  # tags to strip from the end (in any order)
+
+# MPEG-1 kbps by layer (1 to 3), then by bitrate index
+_mpeg1Bitrates = {
+    1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416,
+        448],
+    2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+}
+# MPEG-2 and 2.5 kbps by layer, then by bitrate index
+_mpeg2Bitrates = {
+    1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# sample rates by version bits (0: MPEG-2.5, 2: MPEG-2, 3: MPEG-1)
+_sampleRates = {
+    0: (11025, 12000, 8000),
+    2: (22050, 24000, 16000),
+    3: (44100, 48000, 32000),
+}
+
+
+def getMpegFrameLength(header):
+    """
+    Get the length in bytes of the MPEG audio frame that starts with the
+    4-byte header, or None if it is not a valid frame header (free
+    format bitrates are not handled).
+    """
+    if (header[0] != 0xFF) or ((header[1] & 0xE0) != 0xE0):
+        return None
+    versionBits = (header[1] >> 3) & 3
+    layer = 4 - ((header[1] >> 1) & 3)
+    bitrateIndex = header[2] >> 4
+    sampleRateIndex = (header[2] >> 2) & 3
+    padding = (header[2] >> 1) & 1
+    if (versionBits == 1) or (layer == 4) or (bitrateIndex == 0) \
+            or (bitrateIndex == 15) or (sampleRateIndex == 3):
+        return None
+    if versionBits == 3:
+        bitrate = _mpeg1Bitrates[layer][bitrateIndex] * 1000
+    else:
+        bitrate = _mpeg2Bitrates[layer][bitrateIndex] * 1000
+    sampleRate = _sampleRates[versionBits][sampleRateIndex]
+    if layer == 1:
+        return (12 * bitrate // sampleRate + padding) * 4
+    if (layer == 3) and (versionBits != 3):
+        return 72 * bitrate // sampleRate + padding
+    return 144 * bitrate // sampleRate + padding
+
+
+def skipId3v2(ins, start, end):
+    """
+    Get the offset after any ID3v2 tags that start at start.
+    """
+    while start + 10 <= end:
+        ins.seek(start)
+        header = ins.read(10)
+        if header[:3] != b"ID3":
+            break
+        size = 0
+        for byte in header[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        start += 10 + size
+        if header[5] & 0x10:
+            # footer present
+            start += 10
+    return min(start, end)
+
+
+def stripTrailingTags(ins, start, end):
+    """
+    Get the end of the data before any ID3v1, APEv1/v2 and Lyrics3 tags
+    at the end (they can be in any order, so repeat until none is
+    found).
+    """
+    for tagI in range(maxTrailingTags):
+        if end - start >= 128:
+            ins.seek(end - 128)
+            if ins.read(3) == b"TAG":
+                end -= 128
+                if end - start >= 227:
+                    ins.seek(end - 227)
+                    if ins.read(4) == b"TAG+":
+                        end -= 227
+                continue
+        if end - start >= 32:
+            ins.seek(end - 32)
+            footer = ins.read(32)
+            if footer[:8] == b"APETAGEX":
+                tagSize, itemCount, flags = struct.unpack("<III",
+                                                          footer[12:24])
+                if flags & 0x80000000:
+                    # header present (not included in tagSize)
+                    tagSize += 32
+                end = max(start, end - tagSize)
+                continue
+        if end - start >= 15:
+            ins.seek(end - 15)
+            trailer = ins.read(15)
+            if trailer[6:] == b"LYRICS200":
+                try:
+                    tagSize = int(trailer[:6])
+                except ValueError:
+                    break
+                end = max(start, end - 15 - tagSize)
+                continue
+            if trailer[6:] == b"LYRICSEND":
+                searchStart = max(start, end - 5100 - 9)
+                ins.seek(searchStart)
+                data = ins.read(end - 9 - searchStart)
+                beginI = data.rfind(b"LYRICSBEGIN")
+                if beginI < 0:
+                    break
+                end = searchStart + beginI
+                continue
+        break
+    return end
+
+
+def hashMpegFrames(ins, start, end, hasher):
+    """
+    Hash the complete MPEG audio frames between start and end, starting
+    at the first frame header found within maxSyncSearch bytes of start
+    (that is followed by another frame or by end) and stopping at the
+    first thing that is not a frame. Get the number of bytes hashed.
+    """
+    ins.seek(start)
+    data = ins.read(min(end - start, readChunkSize))
+    dataStart = start
+    readPos = start + len(data)
+    frameI = None
+    searchEnd = min(len(data) - 4, maxSyncSearch)
+    i = data.find(b"\xff", 0, max(searchEnd, 0))
+    while (i >= 0) and (i < searchEnd):
+        frameLength = getMpegFrameLength(data[i:i+4])
+        if frameLength is not None:
+            nextI = i + frameLength
+            if (dataStart + nextI == end) or ((nextI + 4 <= len(data))
+                    and (getMpegFrameLength(data[nextI:nextI+4])
+                         is not None)):
+                frameI = i
+                break
+        i = data.find(b"\xff", i + 1, searchEnd)
+    if frameI is None:
+        return 0
+    hashedCount = 0
+    while True:
+        # Read more when the next header or frame is not all in data.
+        if (frameI + 4 > len(data)) and (readPos < end):
+            data = data[frameI:] + ins.read(min(end - readPos,
+                                                readChunkSize))
+            dataStart += frameI
+            frameI = 0
+            readPos = dataStart + len(data)
+        if frameI + 4 > len(data):
+            break
+        frameLength = getMpegFrameLength(data[frameI:frameI+4])
+        if frameLength is None:
+            break
+        if (frameI + frameLength > len(data)) and (readPos < end):
+            data = data[frameI:] + ins.read(
+                min(end - readPos, max(readChunkSize, frameLength))
+            )
+            dataStart += frameI
+            frameI = 0
+            readPos = dataStart + len(data)
+        if frameI + frameLength > len(data):
+            # truncated last frame
+            break
+        hasher.update(data[frameI:frameI+frameLength])
+        hashedCount += frameLength
+        frameI += frameLength
+    return hashedCount
+
+
+def hashRange(ins, start, end, hasher):
+    ins.seek(start)
+    left = end - start
+    while left > 0:
+        chunk = ins.read(min(left, readChunkSize))
+        if not chunk:
+            break
+        hasher.update(chunk)
+        left -= len(chunk)
+    return end - start - left
+
+
+def getAudioDigestOfFile(ins, fileSize):
+    """
+    Get a digest of the audio payload of a binary file object (see the
+    module docstring), the number of bytes of tags (metadata) around it
+    and the number of bytes of payload as a list, or None if it is not
+    MPEG audio or FLAC.
+    """
+    start = skipId3v2(ins, 0, fileSize)
+    end = stripTrailingTags(ins, start, fileSize)
+    ins.seek(start)
+    if ins.read(4) == b"fLaC":
+        start += 4
+        while start + 4 <= end:
+            ins.seek(start)
+            blockHeader = ins.read(4)
+            isLast = blockHeader[0] & 0x80
+            blockLength = struct.unpack(">I", b"\x00" + blockHeader[1:])[0]
+            start += 4 + blockLength
+            if isLast:
+                break
+        if start >= end:
+            return None
+        hasher = newHasher()
+        hashedCount = hashRange(ins, start, end, hasher)
+        count("bytes.read", hashedCount)
+        return ["flac:" + str(hashedCount) + ":" + hasher.hexdigest(),
+                start + fileSize - end, hashedCount]
+    hasher = newHasher()
+    hashedCount = hashMpegFrames(ins, start, end, hasher)
+    count("bytes.read", end - start)
+    if hashedCount < 1:
+        return None
+    return ["mpeg:" + str(hashedCount) + ":" + hasher.hexdigest(),
+            start + fileSize - end, hashedCount]
+
+
+def getAudioDigest(path, st=None):
+    """
+    Get getAudioDigestOfFile for the file at path, using the scan cache
+    if one is open.
+    """
+    def compute():
+        with timed("audioHash"):
+            with open(path, 'rb') as ins:
+                return getAudioDigestOfFile(
+                    ins, os.fstat(ins.fileno()).st_size
+                )
+    return cachedFact(path, "audioPayload", compute, st=st)
+
+
+def findAudioDuplicateGroups(paths):
+    """
+    Get a list of groups where every song in a group has the same audio
+    payload. Each group is a list of (path, tagByteCount,
+    payloadByteCount) tuples (see getAudioDigestOfFile). Paths whose
+    extension is not in payloadExts (or that can't be parsed) are
+    skipped, and groups with only one path are not included.
+    """
+    byDigest = {}
+    for path in paths:
+        ext = os.path.splitext(path)[1]
+        if ext[1:].lower() not in payloadExts:
+            continue
+        try:
+            result = getAudioDigest(path)
+        except (OSError, struct.error):
+            continue
+        if result is not None:
+            digest, tagByteCount, payloadByteCount = result
+            byDigest.setdefault(digest, []).append(
+                (path, tagByteCount, payloadByteCount)
+            )
+    groups = []
+    for group in byDigest.values():
+        if len(group) > 1:
+            groups.append(group)
+    return groups
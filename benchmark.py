@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+"""
+Measure each phase of postrecsort on synthetic PhotoRec results (see
+gendump.py) and keep the results so that commits can be compared.
+
+Each phase runs in its own process so that its peak memory (RSS) can be
+measured separately. The generated dumps are kept in the work directory
+and each run uses a fresh copy made of hard links, so the dump itself is
+never changed.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import tempfile
+from datetime import datetime
+
+from gendump import generateDump
+from gendump import dumpVersion
+
+myDirPath = os.path.dirname(os.path.abspath(__file__))
+resultsPath = os.path.join(myDirPath, "benchmark_results.jsonl")
+defaultSizes = [10000]
+fullSizes = [10000, 100000, 1000000]
+
+# phase name -> which folder it reads: "src", "prof" or "pictures"
+phaseInputs = [
+    ("tags", "src"),
+    ("sort", "src"),
+    ("dedupe", "prof"),
+    ("audio", "prof"),
+    ("blanks", "prof"),
+    ("near", "pictures"),
+    ("photos", "pictures"),
+]
+phaseNames = [name for name, inputName in phaseInputs]
+
+
+def usage():
+    print(sys.argv[0] + " [options]")
+    print("")
+    print("options:")
+    print("--sizes=<counts>   Comma-separated file counts (default "
+          + ",".join(str(size) for size in defaultSizes) + "; use --full")
+    print("                   for " + ",".join(str(size) for size in fullSizes)
+          + ").")
+    print("--full             Use all of the sizes above.")
+    print("--phases=<names>   Comma-separated phases (default all: "
+          + ",".join(phaseNames) + ").")
+    print("--jobs=<count>     Use --jobs for the sort phase (see postrecsort).")
+    print("--cache            Use the scan cache (it starts empty).")
+    print("--seed=<number>    Use a different dump (see gendump.py).")
+    print("--work=<dir>       Keep dumps and runs in <dir> (default "
+          + getDefaultWorkPath() + ").")
+    print("--label=<text>     Save a note with the results.")
+
+
+def getDefaultWorkPath():
+    return os.path.join(tempfile.gettempdir(), "postrecsort-benchmark")
+
+
+def getCommit():
+    """
+    Get the current commit of this repository (with "-dirty" if there
+    are uncommitted changes), or "unknown".
+    """
+    try:
+        output = subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=myDirPath, stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return output.decode('utf-8').strip()
+
+
+def countFiles(folderPath):
+    fileCount = 0
+    byteCount = 0
+    for subFolderPath, dirNames, fileNames in os.walk(folderPath):
+        for fileName in fileNames:
+            fileCount += 1
+            byteCount += os.path.getsize(os.path.join(subFolderPath, fileName))
+    return fileCount, byteCount
+
+
+def prepareDump(workPath, size, seed):
+    """
+    Get the path of a generated dump, generating it the first time.
+    """
+    dumpPath = os.path.join(workPath, "dump-{}-s{}-v{}".format(
+        size, seed, dumpVersion))
+    donePath = dumpPath + ".done"
+    if not os.path.isfile(donePath):
+        if os.path.isdir(dumpPath):
+            shutil.rmtree(dumpPath)
+        print("# generating " + str(size) + " files in " + dumpPath
+              + "...")
+        generateDump(dumpPath, size, seed=seed, enablePrint=False)
+        with open(donePath, 'w') as outs:
+            outs.write(datetime.now().isoformat() + "\n")
+    return dumpPath
+
+
+def linkTree(srcPath, dstPath):
+    for subFolderPath, dirNames, fileNames in os.walk(srcPath):
+        relPath = os.path.relpath(subFolderPath, srcPath)
+        newFolderPath = os.path.normpath(os.path.join(dstPath, relPath))
+        os.makedirs(newFolderPath)
+        for fileName in fileNames:
+            os.link(os.path.join(subFolderPath, fileName),
+                    os.path.join(newFolderPath, fileName))
+
+
+def runPhaseHere(phase, srcPath, profilePath, workPath, jobCount,
+                 enableCache):
+    """
+    Run one phase in this process (see --run-phase), and get the number
+    of seconds it took.
+    """
+    import moremeta
+    # Don't add the generated names to the real data/similar lists.
+    moremeta.similarsDirPath = os.path.join(workPath, "similar")
+    import postrecsort
+    from scancache import openScanCache
+    from scancache import closeScanCache
+    if enableCache:
+        openScanCache(os.path.join(profilePath, moremeta.stateDirName))
+    picturesPath = os.path.join(profilePath,
+                                postrecsort.catDirNames["Pictures"])
+    start = time.perf_counter()
+    if phase == "tags":
+        for folderPath, dirNames, fileNames in os.walk(srcPath):
+            for fileName in fileNames:
+                path = os.path.join(folderPath, fileName)
+                if moremeta.getCategoryByExtUsingPath(path) == "Music":
+                    moremeta.neatMetaTags(path)
+    elif phase == "sort":
+        postrecsort.sortFiles(srcPath, profilePath, jobCount=jobCount)
+    elif phase == "dedupe":
+        postrecsort.removeDuplicates(profilePath)
+    elif phase == "audio":
+        postrecsort.removeAudioDuplicates(profilePath)
+    elif phase == "blanks":
+        postrecsort.removeExtra(profilePath, profilePath)
+    elif phase == "near":
+        postrecsort.moveNearDuplicates(profilePath)
+    elif phase == "photos":
+        if os.path.isdir(picturesPath):
+            moremeta.process_files(picturesPath, 'move')
+    else:
+        raise ValueError("Unknown phase: " + phase)
+    seconds = time.perf_counter() - start
+    moremeta.flushSimilarNames()
+    closeScanCache()
+    return seconds
+
+
+def runPhase(phase, srcPath, profilePath, workPath, jobCount,
+             enableCache):
+    """
+    Run one phase in a new process, and get a tuple of seconds and peak
+    RSS in bytes.
+    """
+    resultPath = os.path.join(workPath, "phase-result.json")
+    if os.path.isfile(resultPath):
+        os.remove(resultPath)
+    cmd = [sys.executable, os.path.abspath(__file__),
+           "--run-phase=" + phase, "--jobs=" + str(jobCount),
+           "--work=" + workPath, srcPath, profilePath, resultPath]
+    if enableCache:
+        cmd.append("--cache")
+    logPath = os.path.join(workPath, "phase-" + phase + ".log")
+    with open(logPath, 'w') as outs:
+        proc = subprocess.Popen(cmd, stdout=outs, stderr=subprocess.STDOUT)
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = 0 if status == 0 else 1
+    if (status != 0) or (not os.path.isfile(resultPath)):
+        print("ERROR: the " + phase + " phase failed (see '" + logPath
+              + "').")
+        exit(1)
+    with open(resultPath, 'r') as ins:
+        seconds = json.load(ins)['seconds']
+    # ru_maxrss is in KB on Linux but in bytes on macOS. It includes the
+    # largest child (such as a --jobs worker) if that was larger.
+    peakRss = rusage.ru_maxrss
+    if platform.system() != "Darwin":
+        peakRss *= 1024
+    return seconds, peakRss
+
+
+def loadResults():
+    results = []
+    if os.path.isfile(resultsPath):
+        with open(resultsPath, 'r') as ins:
+            for line in ins:
+                line = line.strip()
+                if len(line) > 0:
+                    results.append(json.loads(line))
+    return results
+
+
+def findPrevious(results, result):
+    """
+    Get the newest result from another commit with the same settings.
+    """
+    for prev in reversed(results):
+        if prev['commit'] == result['commit']:
+            continue
+        same = True
+        for key in ('size', 'seed', 'dumpVersion', 'phase', 'jobs',
+                    'cache'):
+            if prev.get(key) != result.get(key):
+                same = False
+                break
+        if same:
+            return prev
+    return None
+
+
+def formatRow(values):
+    widths = [8, 7, 9, 12, 10, 10, 9, 20]
+    ret = ""
+    for value, width in zip(values, widths):
+        ret += str(value).rjust(width) + " "
+    return ret.rstrip()
+
+
+def runBenchmark(sizes, phases, workPath, seed=0, jobCount=1,
+                 enableCache=False, label=None):
+    commit = getCommit()
+    prevResults = loadResults()
+    newResults = []
+    print(formatRow(["size", "phase", "files/s", "MB/s", "seconds",
+                     "peak MB", "vs prev", "prev commit"]))
+    for size in sizes:
+        dumpPath = prepareDump(workPath, size, seed)
+        runPath = os.path.join(workPath, "run")
+        if os.path.isdir(runPath):
+            shutil.rmtree(runPath)
+        srcPath = os.path.join(runPath, "src")
+        profilePath = os.path.join(runPath, "prof")
+        linkTree(dumpPath, srcPath)
+        os.makedirs(profilePath)
+        similarPath = os.path.join(workPath, "similar")
+        if os.path.isdir(similarPath):
+            shutil.rmtree(similarPath)
+        for phase, inputName in phaseInputs:
+            if phase not in phases:
+                continue
+            inputPath = srcPath
+            if inputName == "prof":
+                inputPath = profilePath
+            elif inputName == "pictures":
+                inputPath = os.path.join(profilePath, "Pictures")
+            fileCount, byteCount = countFiles(inputPath)
+            seconds, peakRss = runPhase(phase, srcPath, profilePath,
+                                        workPath, jobCount, enableCache)
+            result = {
+                'date': datetime.now().isoformat(),
+                'commit': commit,
+                'label': label,
+                'python': platform.python_version(),
+                'size': size,
+                'seed': seed,
+                'dumpVersion': dumpVersion,
+                'phase': phase,
+                'jobs': jobCount,
+                'cache': enableCache,
+                'files': fileCount,
+                'bytes': byteCount,
+                'seconds': seconds,
+                'filesPerSec': fileCount / seconds if seconds > 0 else None,
+                'bytesPerSec': byteCount / seconds if seconds > 0 else None,
+                'peakRss': peakRss,
+            }
+            newResults.append(result)
+            with open(resultsPath, 'a') as outs:
+                outs.write(json.dumps(result) + "\n")
+            prev = findPrevious(prevResults, result)
+            change = ""
+            prevCommit = ""
+            if (prev is not None) and (prev['seconds'] > 0) \
+                    and (seconds > 0):
+                change = "{:.2f}x".format(prev['seconds'] / seconds)
+                prevCommit = prev['commit']
+            print(formatRow([
+                size, phase,
+                "{:.0f}".format(result['filesPerSec'] or 0),
+                "{:.2f}".format((result['bytesPerSec'] or 0)/1024/1024),
+                "{:.2f}".format(seconds),
+                "{:.0f}".format(peakRss/1024/1024),
+                change, prevCommit
+            ]))
+        shutil.rmtree(runPath)
+    print("# saved to '" + resultsPath + "' as " + commit)
+    return newResults
+
+
+if __name__ == "__main__":
+    sizes = defaultSizes
+    phases = phaseNames
+    workPath = getDefaultWorkPath()
+    seed = 0
+    jobCount = 1
+    enableCache = False
+    label = None
+    runPhaseName = None
+    paths = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--sizes="):
+            sizes = [int(part) for part in arg[len("--sizes="):].split(",")]
+        elif arg == "--full":
+            sizes = fullSizes
+        elif arg.startswith("--phases="):
+            phases = arg[len("--phases="):].split(",")
+            for phase in phases:
+                if phase not in phaseNames:
+                    usage()
+                    print("")
+                    print("ERROR: Unknown phase: " + phase)
+                    exit(1)
+        elif arg.startswith("--jobs="):
+            jobCount = int(arg[len("--jobs="):])
+        elif arg == "--cache":
+            enableCache = True
+        elif arg.startswith("--seed="):
+            seed = int(arg[len("--seed="):])
+        elif arg.startswith("--work="):
+            workPath = os.path.abspath(arg[len("--work="):])
+        elif arg.startswith("--label="):
+            label = arg[len("--label="):]
+        elif arg.startswith("--run-phase="):
+            runPhaseName = arg[len("--run-phase="):]
+        elif arg[:2] == "--":
+            usage()
+            print("")
+            print("ERROR: Unknown option: " + arg)
+            exit(1)
+        else:
+            paths.append(arg)
+    if runPhaseName is not None:
+        # This is a child process started by runPhase.
+        srcPath, profilePath, resultPath = paths
+        seconds = runPhaseHere(runPhaseName, srcPath, profilePath,
+                               workPath, jobCount, enableCache)
+        with open(resultPath, 'w') as outs:
+            json.dump({'seconds': seconds}, outs)
+        exit(0)
+    if len(paths) > 0:
+        usage()
+        exit(1)
+    if not os.path.isdir(workPath):
+        os.makedirs(workPath)
+    runBenchmark(sizes, phases, workPath, seed=seed, jobCount=jobCount,
+                 enableCache=enableCache, label=label)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+Record which folders and files each pass of a run (such as the sort or
+the blank check) has finished, along with statistics, in a JSON file in
+the state directory, so that a run stopped by a crash or Ctrl-C can
+continue where it left off (see --resume in postrecsort.py).
+
+Usage:
+checkpoint = openCheckpoint(stateDirPath, enableResume=True)
+state = checkpoint.getPass("sort", topPath)
+if not state.finished:
+    for folderPath, depth, dirEntries, fileEntries in walkEntries(topPath):
+        for entry in state.selectFiles(folderPath, fileEntries):
+            ...
+            state.fileDone(entry.path)
+            checkpoint.saveIfDue()
+    state.finish()
+checkpoint.close()
+
+Only the files of a folder are tracked (walkEntries lists each folder
+on its own), so a folder is finished once each file that was in it is
+done, even if it has subfolders that are not.
+"""
+import os
+import json
+import time
+import threading
+
+checkpointFileName = "checkpoint.json"
+saveInterval = 30.0  # seconds between saves by saveIfDue
+
+
+class PassState:
+    """
+    The finished folders (relative to topPath) and the done files of
+    unfinished folders for one pass over topPath.
+    """
+    def __init__(self, checkpoint, topPath, data=None):
+        if data is None:
+            data = {}
+        self.checkpoint = checkpoint
+        self.topPath = topPath
+        # selectFiles may be called by a thread feeding a Pool (see
+        # sortFiles), so share the lock that save uses.
+        self.lock = checkpoint.lock
+        self.finished = data.get('finished', False)
+        self.doneFolders = set(data.get('doneFolders', []))
+        self.doneFiles = {}  # relPath -> names
+        for relPath, names in data.get('doneFiles', {}).items():
+            self.doneFiles[relPath] = set(names)
+        self.pending = {}  # relPath -> names selected but not done yet
+
+    def _getRelPath(self, folderPath):
+        return os.path.relpath(folderPath, self.topPath)
+
+    def _folderDone(self, relPath):
+        self.doneFolders.add(relPath)
+        self.doneFiles.pop(relPath, None)
+
+    def isFolderDone(self, folderPath):
+        with self.lock:
+            return (self.finished
+                    or (self._getRelPath(folderPath) in self.doneFolders))
+
+    def selectFiles(self, folderPath, fileEntries):
+        """
+        Get the os.DirEntry items in fileEntries (the files in
+        folderPath) that are not done. The folder is finished once
+        fileDone was called for each of them.
+        """
+        relPath = self._getRelPath(folderPath)
+        with self.lock:
+            if self.finished or (relPath in self.doneFolders):
+                return []
+            doneNames = self.doneFiles.get(relPath, ())
+            selected = [entry for entry in fileEntries
+                        if entry.name not in doneNames]
+            if len(selected) > 0:
+                self.pending[relPath] = set(entry.name for entry in selected)
+            else:
+                self._folderDone(relPath)
+        return selected
+
+    def fileDone(self, path):
+        folderPath, name = os.path.split(path)
+        relPath = self._getRelPath(folderPath)
+        with self.lock:
+            pending = self.pending.get(relPath)
+            if pending is None:
+                return
+            pending.discard(name)
+            if len(pending) > 0:
+                self.doneFiles.setdefault(relPath, set()).add(name)
+            else:
+                del self.pending[relPath]
+                self._folderDone(relPath)
+
+    def finish(self):
+        """
+        Mark the whole pass as done (the folders are no longer needed)
+        and save the checkpoint.
+        """
+        with self.lock:
+            self.finished = True
+            self.doneFolders = set()
+            self.doneFiles = {}
+            self.pending = {}
+        self.checkpoint.save()
+
+    def toDict(self):
+        doneFiles = {}
+        for relPath, names in self.doneFiles.items():
+            doneFiles[relPath] = sorted(names)
+        return {
+            'topPath': self.topPath,
+            'finished': self.finished,
+            'doneFolders': sorted(self.doneFolders),
+            'doneFiles': doneFiles,
+        }
+
+
+class Checkpoint:
+    """
+    The PassState of each pass of a run and the run's statistics, saved
+    to path (replacing it, so a crash while saving leaves the previous
+    checkpoint).
+    """
+    def __init__(self, path, data=None):
+        self.path = path
+        self.resumed = data is not None
+        if data is None:
+            data = {}
+        self.lock = threading.Lock()
+        self.passes = {}
+        self.passData = data.get('passes', {})
+        self.stats = data.get('stats', {})
+        # If not None, save calls this to get the stats to save.
+        self.getStats = None
+        self.lastSaveTime = time.perf_counter()
+
+    def getPass(self, name, topPath):
+        """
+        Get the PassState of the pass called name over topPath. Raise
+        ValueError if the checkpoint is of a pass over another folder.
+        """
+        topPath = os.path.abspath(topPath)
+        state = self.passes.get(name)
+        if state is None:
+            data = self.passData.get(name)
+            if (data is not None) and (data.get('topPath') != topPath):
+                raise ValueError(
+                    "The checkpoint in '" + self.path + "' is of a " + name
+                    + " pass over '" + str(data.get('topPath'))
+                    + "', not '" + topPath + "'."
+                )
+            state = PassState(self, topPath, data)
+            self.passes[name] = state
+        if state.topPath != topPath:
+            raise ValueError("The " + name + " pass is over '"
+                             + state.topPath + "', not '" + topPath + "'.")
+        return state
+
+    def saveIfDue(self):
+        """
+        Save if saveInterval seconds passed since the last save (call
+        this from the thread that changes the stats).
+        """
+        if time.perf_counter() - self.lastSaveTime >= saveInterval:
+            self.save()
+
+    def save(self):
+        if self.getStats is not None:
+            self.stats = self.getStats()
+        with self.lock:
+            passes = self.passData.copy()
+            for name, state in self.passes.items():
+                passes[name] = state.toDict()
+            text = json.dumps({
+                'passes': passes,
+                'stats': self.stats,
+            })
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, 'w') as outs:
+            outs.write(text)
+        os.replace(tmpPath, self.path)
+        self.lastSaveTime = time.perf_counter()
+
+    def close(self):
+        self.save()
+
+
+def openCheckpoint(stateDirPath, enableResume=False):
+    """
+    Get a Checkpoint saved in stateDirPath. If enableResume is True and
+    there is a checkpoint from a previous run, continue from it (see
+    Checkpoint.resumed), otherwise start a new one.
+    """
+    if not os.path.isdir(stateDirPath):
+        os.makedirs(stateDirPath)
+    path = os.path.join(stateDirPath, checkpointFileName)
+    data = None
+    if enableResume and os.path.isfile(path):
+        with open(path, 'r') as ins:
+            data = json.load(ins)
+    return Checkpoint(path, data)
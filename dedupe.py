@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Find files with identical content anywhere in a tree without comparing
+every pair. Files are grouped by size, then by a hash of their first
+and last few KB, and only files that still collide are fully hashed.
+"""
+import time
+import hashlib
+
+from scancache import cachedFact
+from treewalk import iterFileEntries
+from metrics import count
+from metrics import observe
+from metrics import timed
+
+headTailSize = 4 * 1024
+readChunkSize = 1024 * 1024
+
+
+def newHasher():
+    return hashlib.blake2b(digest_size=16)
+
+
+def hashHeadTail(path, fileSize, stats=None):
+    """
+    Hash the first and last headTailSize bytes of a file. For a file no
+    larger than 2 * headTailSize the result covers the whole file.
+    """
+    hasher = newHasher()
+    start = time.perf_counter()
+    with open(path, 'rb') as ins:
+        if fileSize <= 2 * headTailSize:
+            data = ins.read()
+        else:
+            data = ins.read(headTailSize)
+            ins.seek(fileSize - headTailSize)
+            data += ins.read(headTailSize)
+    hasher.update(data)
+    observe("hash", time.perf_counter() - start)
+    count("bytes.read", len(data))
+    if stats is not None:
+        stats['bytesRead'] = stats.get('bytesRead', 0) + len(data)
+    return hasher.hexdigest()
+
+
+def hashFile(path, stats=None):
+    hasher = newHasher()
+    readCount = 0
+    with timed("hash"):
+        with open(path, 'rb') as ins:
+            while True:
+                chunk = ins.read(readChunkSize)
+                if not chunk:
+                    break
+                readCount += len(chunk)
+                hasher.update(chunk)
+    count("bytes.read", readCount)
+    if stats is not None:
+        stats['bytesRead'] = stats.get('bytesRead', 0) + readCount
+    return hasher.hexdigest()
+
+
+def findDuplicateGroups(sizedPaths, stats=None):
+    """
+    Get a list of groups (lists of paths) where every path in a group
+    has the same content. Groups with only one path are not included.
+
+    Keyword arguments:
+    sizedPaths -- an iterable of (path, size) tuples (empty files are
+                  skipped)
+    stats -- if not None, a dict where 'bytesRead' and
+             'fullHashCount' are accumulated
+    """
+    bySize = {}
+    for path, fileSize in sizedPaths:
+        if fileSize < 1:
+            continue
+        bySize.setdefault(fileSize, []).append(path)
+    groups = []
+    for fileSize, paths in bySize.items():
+        if len(paths) < 2:
+            continue
+        byHeadTail = {}
+        for path in paths:
+            try:
+                key = cachedFact(
+                    path, "headTailHash",
+                    lambda: hashHeadTail(path, fileSize, stats=stats)
+                )
+            except OSError:
+                continue
+            byHeadTail.setdefault(key, []).append(path)
+        for partialPaths in byHeadTail.values():
+            if len(partialPaths) < 2:
+                continue
+            if fileSize <= 2 * headTailSize:
+                # The partial hash already covered the whole file.
+                groups.append(partialPaths)
+                continue
+            byFull = {}
+            for path in partialPaths:
+                try:
+                    key = cachedFact(path, "contentHash",
+                                     lambda: hashFile(path, stats=stats))
+                except OSError:
+                    continue
+                if stats is not None:
+                    stats['fullHashCount'] = \
+                        stats.get('fullHashCount', 0) + 1
+                byFull.setdefault(key, []).append(path)
+            for fullPaths in byFull.values():
+                if len(fullPaths) > 1:
+                    groups.append(fullPaths)
+    return groups
+
+
+def iterSizedFiles(folderPath, skipNames=None):
+    """
+    Yield (path, size) for every file under folderPath, not descending
+    into directories named in skipNames.
+    """
+    for parentPath, entry in iterFileEntries(folderPath,
+                                             skipNames=skipNames):
+        try:
+            yield entry.path, entry.stat().st_size
+        except OSError:
+            pass
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Find names that are probably the same as another name despite a typo
+or tag junk (such as "Led Zepplin" for "Led Zeppelin", or "Beatles,
+The" for "The Beatles").
+
+Names are normalized (see normalizeName), then candidates are found
+with an inverted index of character trigrams and checked with an edit
+distance limit that depends on the length (see maxDistanceOf). Only the
+trigrams with the shortest posting lists are used to find candidates:
+if the distance is at most k, all but 3 * k of any trigrams of the name
+must be in the other name, since each edit changes at most 3 trigrams.
+
+A typo must stay inside one word: names with a different number of
+words, or where a whole word is replaced (such as "Side A" and "Side
+B") or a Roman numeral differs (such as "Led Zeppelin III" and "Led
+Zeppelin II"), are never considered the same (see isTypoOf).
+"""
+import re
+
+minFuzzyLength = 6  # don't guess for shorter names (such as "Blur")
+charsPerEdit = 6  # allow 1 edit per this many characters
+maxEdits = 2
+extraGrams = 3  # trigrams to count beyond the 3 * k rarest (see find)
+
+_junkRE = re.compile(r"[^\w\s]+", re.UNICODE)
+_spacesRE = re.compile(r"\s+", re.UNICODE)
+_digitsRE = re.compile(r"\d+")
+_romanRE = re.compile(r"^m{0,3}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})$")
+
+
+def normalizeName(name):
+    """
+    Get a lowercase version of name without punctuation, extra spaces,
+    or "the" at the start (or ", the" at the end).
+    """
+    ret = _junkRE.sub(" ", name.lower())
+    ret = _spacesRE.sub(" ", ret).strip()
+    if ret.startswith("the "):
+        ret = ret[4:]
+    elif ret.endswith(" the"):
+        ret = ret[:-4]
+    return ret
+
+
+def maxDistanceOf(key):
+    """
+    Get the highest edit distance allowed for a normalized name.
+    """
+    if len(key) < minFuzzyLength:
+        return 0
+    return min(maxEdits, len(key) // charsPerEdit)
+
+
+def trigramsOf(key):
+    padded = "  " + key + " "
+    ret = set()
+    for i in range(len(padded) - 2):
+        ret.add(padded[i:i+3])
+    return ret
+
+
+def boundedLevenshtein(a, b, maxDistance):
+    """
+    Get the edit distance between a and b, or None if it is more than
+    maxDistance (only cells within maxDistance of the diagonal are
+    checked, and checking stops early once every cell is too far).
+    """
+    if abs(len(a) - len(b)) > maxDistance:
+        return None
+    if a == b:
+        return 0
+    tooFar = maxDistance + 1
+    prevRow = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        row = [tooFar] * (len(b) + 1)
+        if i <= maxDistance:
+            row[0] = i
+        start = max(1, i - maxDistance)
+        end = min(len(b), i + maxDistance)
+        rowMin = row[0]
+        charA = a[i-1]
+        for j in range(start, end + 1):
+            cost = 0 if charA == b[j-1] else 1
+            value = min(prevRow[j] + 1, row[j-1] + 1, prevRow[j-1] + cost)
+            if value > tooFar:
+                value = tooFar
+            row[j] = value
+            if value < rowMin:
+                rowMin = value
+        if rowMin > maxDistance:
+            return None
+        prevRow = row
+    if prevRow[len(b)] > maxDistance:
+        return None
+    return prevRow[len(b)]
+
+
+def isRomanNumeral(word):
+    return (len(word) > 0) and (_romanRE.match(word) is not None)
+
+
+def isTypoOf(key, otherKey):
+    """
+    Check whether two different normalized names that are within a few
+    edits of each other differ only by typos inside their words (see
+    the module docstring).
+    """
+    if _digitsRE.findall(key) != _digitsRE.findall(otherKey):
+        return False
+    words = key.split(" ")
+    otherWords = otherKey.split(" ")
+    if len(words) != len(otherWords):
+        return False
+    for word, otherWord in zip(words, otherWords):
+        if word == otherWord:
+            continue
+        if isRomanNumeral(word) or isRomanNumeral(otherWord):
+            return False
+        # A word with as many edits as letters was replaced.
+        shorter = min(len(word), len(otherWord))
+        distance = boundedLevenshtein(word, otherWord, shorter - 1)
+        if distance is None:
+            return False
+    return True
+
+
+class TrigramIndex:
+    """
+    Map normalized names to values, and find the values of keys that are
+    within a few edits of a name.
+    """
+    def __init__(self):
+        self.keys = []
+        self.values = []
+        self.idByKey = {}
+        self.postings = {}  # trigram -> list of key ids
+
+    def get(self, key):
+        keyId = self.idByKey.get(key)
+        if keyId is None:
+            return None
+        return self.values[keyId]
+
+    def set(self, key, value):
+        keyId = self.idByKey.get(key)
+        if keyId is not None:
+            self.values[keyId] = value
+            return
+        keyId = len(self.keys)
+        self.idByKey[key] = keyId
+        self.keys.append(key)
+        self.values.append(value)
+        for gram in trigramsOf(key):
+            self.postings.setdefault(gram, []).append(keyId)
+
+    def find(self, key, maxDistance=None):
+        """
+        Get a list of (distance, key, value) for each key within
+        maxDistance (default maxDistanceOf(key)) edits of key, closest
+        first. Names that differ in their numbers (such as "Volume 1"
+        and "Volume 2") or by more than a typo in a word are never
+        considered the same (see isTypoOf).
+        """
+        if maxDistance is None:
+            maxDistance = maxDistanceOf(key)
+        keyId = self.idByKey.get(key)
+        if maxDistance < 1:
+            if keyId is None:
+                return []
+            return [(0, key, self.values[keyId])]
+        grams = sorted(trigramsOf(key),
+                       key=lambda gram: len(self.postings.get(gram, ())))
+        if len(grams) <= 3 * maxDistance:
+            # A match might not share any trigram, so only check exact.
+            return self.find(key, maxDistance=0)
+        # A match has all but at most 3 * maxDistance of any trigrams, so
+        # count the rarest few and skip keys with too few in common.
+        checkedGrams = grams[:3 * maxDistance + extraGrams]
+        minShared = len(checkedGrams) - 3 * maxDistance
+        sharedCounts = {}
+        for gram in checkedGrams:
+            for candidateId in self.postings.get(gram, ()):
+                sharedCounts[candidateId] = sharedCounts.get(candidateId, 0) + 1
+        ret = []
+        for candidateId, sharedCount in sharedCounts.items():
+            if sharedCount < minShared:
+                continue
+            otherKey = self.keys[candidateId]
+            distance = boundedLevenshtein(key, otherKey, maxDistance)
+            if distance is None:
+                continue
+            if (distance > 0) and not isTypoOf(key, otherKey):
+                continue
+            ret.append((distance, otherKey, self.values[candidateId]))
+        ret.sort(key=lambda found: found[0])
+        return ret
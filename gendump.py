@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+"""
+Write a synthetic PhotoRec result (recup_dir.1, recup_dir.2, ...) for
+trying out or benchmarking postrecsort without a real recovery: images
+of assorted sizes (including blanks, thumbnails, JPEGs of only a few
+pixels, and JPEGs with EXIF dates), tagged MP3 and FLAC files, HTML
+with GeoCities and webbot date comments, documents, duplicates (exact,
+re-encoded and resized), system files with ignored extensions, and
+files without a usable extension.
+
+The output only depends on the file count and seed.
+"""
+import os
+import sys
+import struct
+import random
+
+try:
+    from PIL import Image
+    from PIL import ImageDraw
+except ImportError:
+    print("This program requires PIL such as from the python-pil package")
+
+dumpVersion = 1  # change when the output for the same arguments changes
+filesPerDir = 500  # as PhotoRec does
+
+artistNames = ["The Beatles", "Led Zeppelin", "Pink Floyd", "Queen",
+               "The Rolling Stones", "Fleetwood Mac", "Grateful Dead",
+               "Creedence Clearwater Revival", "The Who", "ABBA"]
+# variants that getAndCollectSimilar should merge
+artistVariants = {
+    "The Beatles": ["Beatles", "beatles", "Beatles, The"],
+    "Led Zeppelin": ["Led Zepplin", "LED ZEPPELIN"],
+    "Pink Floyd": ["pink floyd", "Pink Floyd "],
+}
+albumWords = ["Abbey", "Road", "Dark", "Side", "Moon", "Physical",
+              "Graffiti", "Rumours", "Live", "Greatest", "Hits", "Vol."]
+titleWords = ["Come", "Together", "Money", "Time", "Kashmir", "Dreams",
+              "Truckin'", "Ramble", "On", "Echoes", "Love", "Road"]
+junkExts = ["dll", "exe", "xml", "ini", "sys", "cab", "ttf"]
+documentExts = ["pdf", "doc", "xls", "rtf"]
+weekdayNames = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+monthNames = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug",
+              "Sep", "Oct", "Nov", "Dec"]
+
+# (kind, weight) for each file
+kindWeights = [
+    ("jpeg", 16),
+    ("png", 8),
+    ("bmp", 2),
+    ("gif", 2),
+    ("thumbnail", 6),
+    ("blank", 4),
+    ("tiny", 1),
+    ("mp3", 12),
+    ("flac", 3),
+    ("html", 7),
+    ("text", 5),
+    ("document", 5),
+    ("junk", 10),
+    ("noext", 3),
+    ("unknown", 2),
+    ("duplicate", 10),
+    ("reencoded", 3),
+    ("resized", 2),
+]
+
+knownThumbnailSizes = [(160, 120), (200, 200), (100, 100), (320, 240)]
+imageSizes = [(640, 480), (800, 600), (1024, 768), (480, 640),
+              (300, 300), (728, 90), (1600, 1200)]
+
+
+def randomBytes(rng, count):
+    randbytes = getattr(rng, "randbytes", None)
+    if randbytes is not None:
+        return randbytes(count)
+    # before Python 3.9
+    return bytes(rng.getrandbits(8) for i in range(count))
+
+
+def drawImage(rng, size, mode="RGB"):
+    """
+    Draw a few random shapes so that images differ from each other
+    (and have detail for perceptual hashing) but still compress well.
+    """
+    im = Image.new(mode, size, (rng.randrange(256), rng.randrange(256),
+                                rng.randrange(256)))
+    draw = ImageDraw.Draw(im)
+    width, height = size
+    for shapeI in range(rng.randint(3, 8)):
+        x0 = rng.randrange(width)
+        y0 = rng.randrange(height)
+        x1 = min(width - 1, x0 + rng.randint(1, max(1, width // 2)))
+        y1 = min(height - 1, y0 + rng.randint(1, max(1, height // 2)))
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        if rng.random() < 0.5:
+            draw.rectangle([x0, y0, x1, y1], fill=color)
+        else:
+            draw.ellipse([x0, y0, x1, y1], fill=color)
+    return im
+
+
+def exifDate(rng):
+    return "{:04d}:{:02d}:{:02d} {:02d}:{:02d}:{:02d}".format(
+        rng.randint(1999, 2019), rng.randint(1, 12), rng.randint(1, 28),
+        rng.randrange(24), rng.randrange(60), rng.randrange(60)
+    )
+
+
+def writeJpeg(rng, path, size=None):
+    if size is None:
+        size = rng.choice(imageSizes)
+    im = drawImage(rng, size)
+    exif = Image.Exif()
+    if rng.random() < 0.8:
+        exif[0x0132] = exifDate(rng)  # DateTime
+        exif.get_ifd(0x8769)[0x9003] = exifDate(rng)  # DateTimeOriginal
+    im.save(path, "JPEG", quality=rng.randint(60, 95), exif=exif)
+    return im
+
+
+def syncsafe(value):
+    return bytes([(value >> 21) & 0x7F, (value >> 14) & 0x7F,
+                  (value >> 7) & 0x7F, value & 0x7F])
+
+
+def id3Frame(frameId, text):
+    data = b"\x00" + text.encode('latin-1', 'replace')
+    return frameId.encode('ascii') + struct.pack(">I", len(data)) \
+        + b"\x00\x00" + data
+
+
+def pickTags(rng):
+    artist = rng.choice(artistNames)
+    variants = artistVariants.get(artist)
+    if (variants is not None) and (rng.random() < 0.3):
+        artist = rng.choice(variants)
+    album = " ".join(rng.sample(albumWords, 2))
+    tags = {
+        'artist': artist,
+        'album': album,
+        'title': " ".join(rng.sample(titleWords, rng.randint(1, 3))),
+        'track': str(rng.randint(1, 14)),
+    }
+    if rng.random() < 0.08:
+        tags['title'] = ""  # probably not a song
+    return tags
+
+
+def writeMp3(rng, path):
+    tags = pickTags(rng)
+    frames = id3Frame("TIT2", tags['title']) \
+        + id3Frame("TPE1", tags['artist']) \
+        + id3Frame("TALB", tags['album']) \
+        + id3Frame("TRCK", tags['track'])
+    # MPEG-1 Layer III, 128 kbps, 44.1 kHz: 417 bytes per frame
+    header = b"\xff\xfb\x90\x44"
+    frameCount = rng.choice([40, 200, 1000, 3000])
+    body = header + randomBytes(rng, 413)
+    with open(path, 'wb') as outs:
+        outs.write(b"ID3\x03\x00\x00" + syncsafe(len(frames)) + frames)
+        for frameI in range(frameCount):
+            outs.write(body)
+
+
+def flacBlock(blockType, data, isLast=False):
+    first = blockType | (0x80 if isLast else 0)
+    return bytes([first]) + struct.pack(">I", len(data))[1:] + data
+
+
+def writeFlac(rng, path):
+    tags = pickTags(rng)
+    sampleRate = 44100
+    totalSamples = sampleRate * rng.randint(30, 300)
+    bits = (sampleRate << 44) | (1 << 41) | (15 << 36) | totalSamples
+    streamInfo = struct.pack(">HH", 4096, 4096) + b"\x00" * 6 \
+        + struct.pack(">Q", bits) + b"\x00" * 16
+    comments = [
+        "TITLE=" + tags['title'],
+        "ARTIST=" + tags['artist'],
+        "ALBUM=" + tags['album'],
+        "TRACKNUMBER=" + tags['track'],
+    ]
+    vendor = b"gendump"
+    comment = struct.pack("<I", len(vendor)) + vendor \
+        + struct.pack("<I", len(comments))
+    for line in comments:
+        data = line.encode('utf-8')
+        comment += struct.pack("<I", len(data)) + data
+    with open(path, 'wb') as outs:
+        outs.write(b"fLaC" + flacBlock(0, streamInfo)
+                   + flacBlock(4, comment, isLast=True))
+        outs.write(randomBytes(rng, rng.choice([20000, 200000, 600000])))
+
+
+def writeHtml(rng, path):
+    year = rng.randint(1997, 2009)
+    month = rng.randint(1, 12)
+    lines = ["<html>", "<head><title>Home Page</title></head>",
+             "<body>", "<p>Welcome to my page!</p>"]
+    mode = rng.random()
+    if mode < 0.5:
+        # GeoCities (the day must be 12 or lower since html_date_patterns
+        # reads it with %m)
+        lines.insert(0, "<!-- w17.geo.scd.yahoo.com compressed/chunked "
+                     + "{} {} {:02d} {:02d}:{:02d}:{:02d} GMT {} -->".format(
+                         rng.choice(weekdayNames), monthNames[month-1],
+                         rng.randint(1, 12), rng.randrange(24),
+                         rng.randrange(60), rng.randrange(60), year))
+    elif mode < 0.7:
+        lines.append('<!--webbot bot="Timestamp" s-format="%m/%d/%y" -->'
+                     + "{:02d}/{:02d}/{:02d}".format(
+                         month, rng.randint(1, 28), year % 100)
+                     + "<!--webbot bot=\"Timestamp\" endspan -->")
+    for lineI in range(rng.randint(5, 200)):
+        lines.append("<p>" + " ".join(rng.sample(titleWords, 4)) + "</p>")
+    lines.append("</body></html>")
+    with open(path, 'w') as outs:
+        outs.write("\n".join(lines) + "\n")
+
+
+def generateDump(destPath, fileCount, seed=0, enablePrint=True):
+    """
+    Write fileCount files into recup_dir.* folders in destPath.
+
+    Returns a dict with 'files' and 'bytes'.
+    """
+    rng = random.Random(seed)
+    kinds = [kind for kind, weight in kindWeights]
+    weights = [weight for kind, weight in kindWeights]
+    written = []  # (path, kind) of files that can be duplicated
+    images = []  # paths of drawn images that can be re-encoded
+    totalBytes = 0
+    sector = 1000
+    folderPath = None
+    for fileI in range(fileCount):
+        if fileI % filesPerDir == 0:
+            folderPath = os.path.join(
+                destPath, "recup_dir." + str(fileI // filesPerDir + 1))
+            os.makedirs(folderPath)
+            if enablePrint:
+                print("# " + folderPath)
+        sector += rng.randint(8, 4000)
+        kind = rng.choices(kinds, weights)[0]
+        if (kind in ("duplicate", "reencoded", "resized")) \
+                and (len(images) < 1):
+            kind = "png"
+        namePartial = os.path.join(folderPath, "f{:07d}".format(sector))
+        path = None
+        if kind == "jpeg":
+            path = namePartial + ".jpg"
+            writeJpeg(rng, path)
+            images.append(path)
+        elif kind == "png":
+            path = namePartial + ".png"
+            drawImage(rng, rng.choice(imageSizes)).save(path)
+            images.append(path)
+        elif kind == "bmp":
+            path = namePartial + ".bmp"
+            drawImage(rng, rng.choice(imageSizes[:3])).save(path)
+            images.append(path)
+        elif kind == "gif":
+            path = namePartial + ".gif"
+            drawImage(rng, rng.choice(imageSizes)).convert('P').save(path)
+        elif kind == "thumbnail":
+            path = namePartial + rng.choice([".jpg", ".png"])
+            drawImage(rng, rng.choice(knownThumbnailSizes)).save(path)
+        elif kind == "tiny":
+            # smaller than the JPEG draft scale (see draftScale)
+            path = namePartial + ".jpg"
+            drawImage(rng, (rng.randint(1, 7), rng.randint(1, 7))).save(
+                path, "JPEG"
+            )
+        elif kind == "blank":
+            size = rng.choice(imageSizes)
+            if rng.random() < 0.5:
+                path = namePartial + ".png"
+                Image.new('RGBA', size, (0, 0, 0, 0)).save(path)
+            else:
+                path = namePartial + rng.choice([".gif", ".bmp"])
+                Image.new('RGB', size, (255, 255, 255)).save(path)
+        elif kind == "mp3":
+            path = namePartial + ".mp3"
+            writeMp3(rng, path)
+        elif kind == "flac":
+            path = namePartial + ".flac"
+            writeFlac(rng, path)
+        elif kind == "html":
+            path = namePartial + ".html"
+            writeHtml(rng, path)
+        elif kind == "text":
+            path = namePartial + ".txt"
+            with open(path, 'w') as outs:
+                for lineI in range(rng.randint(1, 300)):
+                    outs.write(" ".join(rng.sample(titleWords, 5)) + "\n")
+        elif kind == "document":
+            path = namePartial + "." + rng.choice(documentExts)
+            with open(path, 'wb') as outs:
+                if path.endswith(".pdf"):
+                    outs.write(b"%PDF-1.4\n")
+                outs.write(randomBytes(rng, rng.randint(100, 60000)))
+        elif kind == "junk":
+            path = namePartial + "." + rng.choice(junkExts)
+            with open(path, 'wb') as outs:
+                outs.write(randomBytes(rng, rng.randint(100, 30000)))
+        elif kind == "noext":
+            path = namePartial
+            if rng.random() < 0.5:
+                # a picture that only sniffExt can identify
+                drawImage(rng, rng.choice(imageSizes)).save(path, "PNG")
+            else:
+                with open(path, 'wb') as outs:
+                    outs.write(randomBytes(rng, rng.randint(10, 5000)))
+        elif kind == "unknown":
+            path = namePartial + ".zzz"
+            with open(path, 'wb') as outs:
+                outs.write(randomBytes(rng, rng.randint(10, 5000)))
+        elif kind == "duplicate":
+            srcPath, srcKind = rng.choice(written)
+            path = namePartial + os.path.splitext(srcPath)[1]
+            with open(srcPath, 'rb') as ins:
+                data = ins.read()
+            with open(path, 'wb') as outs:
+                outs.write(data)
+        elif kind == "reencoded":
+            # the same pixels in another format
+            srcPath = rng.choice(images)
+            im = Image.open(srcPath)
+            if srcPath.endswith(".png"):
+                path = namePartial + ".bmp"
+            else:
+                path = namePartial + ".png"
+            im.save(path)
+            im.close()
+        elif kind == "resized":
+            srcPath = rng.choice(images)
+            im = Image.open(srcPath)
+            width, height = im.size
+            path = namePartial + ".jpg"
+            im.convert('RGB').resize(
+                (max(1, width * 3 // 4), max(1, height * 3 // 4))
+            ).save(path, "JPEG", quality=85)
+            im.close()
+        written.append((path, kind))
+        totalBytes += os.path.getsize(path)
+    return {'files': fileCount, 'bytes': totalBytes}
+
+
+def usage():
+    print(sys.argv[0] + " <destination directory> [options]")
+    print("")
+    print("options:")
+    print("--files=<count>  Write <count> files (default 1000).")
+    print("--seed=<number>  Write a different set of files (default 0).")
+
+
+if __name__ == "__main__":
+    destPath = None
+    fileCount = 1000
+    seed = 0
+    for arg in sys.argv[1:]:
+        if arg.startswith("--files="):
+            fileCount = int(arg[len("--files="):])
+        elif arg.startswith("--seed="):
+            seed = int(arg[len("--seed="):])
+        elif arg[:2] == "--":
+            usage()
+            print("")
+            print("ERROR: Unknown option: " + arg)
+            exit(1)
+        elif destPath is None:
+            destPath = arg
+        else:
+            usage()
+            exit(1)
+    if destPath is None:
+        usage()
+        exit(1)
+    if os.path.exists(destPath) and (len(os.listdir(destPath)) > 0):
+        print("ERROR: '" + destPath + "' is not empty.")
+        exit(1)
+    results = generateDump(destPath, fileCount, seed=seed)
+    print("files: " + str(results['files']))
+    print("bytes: " + str(results['bytes']))
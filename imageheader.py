@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+Read image dimensions from the start of a file without decoding it or
+going through PIL's plugin machinery. Only PNG, JPEG, GIF, BMP, ICO
+and HEIF (HEIC or AVIF) are handled. For anything else (or anything
+unexpected), the functions return None so that the caller can fall
+back to PIL.
+
+The EXIF dates of a JPEG can be read the same way (see probeExifDates),
+which only reads the IFD entries of the APP1 segment.
+"""
+import struct
+
+headerSize = 32
+
+pngSignature = b"\x89PNG\r\n\x1a\n"
+gifSignatures = (b"GIF87a", b"GIF89a")
+icoSignature = b"\x00\x00\x01\x00"
+bmpHeaderSizes = (12, 40, 52, 56, 64, 108, 124)
+
+# JPEG start of frame markers (not DHT 0xC4, JPG 0xC8 or DAC 0xCC)
+jpegSofMarkers = set([0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                      0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+# JPEG markers that have no length field
+jpegStandaloneMarkers = set([0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5,
+                             0xD6, 0xD7, 0xD8])
+maxJpegSegments = 1000
+
+# HEIF brands (see moremeta.ftypBrandExts) and how far to look for the
+# image spatial extents ("ispe") properties in the meta box
+heifBrands = set([b"heic", b"heix", b"heim", b"heis", b"mif1", b"msf1",
+                  b"avif", b"avis"])
+maxHeifMetaSize = 64 * 1024
+
+exifSignature = b"Exif\x00\x00"
+exifIfdTag = 0x8769  # pointer from IFD0 to the Exif IFD
+# EXIF tag number -> name (as in PIL.ExifTags.TAGS) of the dates read by
+# probeExifDates (DateTime is in IFD0, the others in the Exif IFD)
+exifDateTags = {
+    0x0132: "DateTime",
+    0x9003: "DateTimeOriginal",
+    0x9004: "DateTimeDigitized",
+}
+maxIfdEntries = 1000
+
+
+def _jpegSize(ins):
+    """
+    Get (width, height) from the first start of frame segment of a JPEG
+    file, where ins is positioned just after the SOI marker.
+    """
+    for segmentI in range(maxJpegSegments):
+        byte = ins.read(1)
+        if byte != b"\xff":
+            return None
+        marker = ins.read(1)
+        while marker == b"\xff":
+            # fill bytes
+            marker = ins.read(1)
+        if len(marker) < 1:
+            return None
+        markerI = marker[0]
+        if markerI in jpegStandaloneMarkers:
+            continue
+        if markerI == 0xD9 or markerI == 0xDA:
+            # end of image, or start of scan before any frame header
+            return None
+        lengthBytes = ins.read(2)
+        if len(lengthBytes) < 2:
+            return None
+        length = struct.unpack(">H", lengthBytes)[0]
+        if length < 2:
+            return None
+        if markerI in jpegSofMarkers:
+            frame = ins.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack(">HH", frame[1:5])
+            return (width, height)
+        ins.seek(length - 2, 1)
+    return None
+
+
+def _icoSize(ins, header):
+    """
+    Get the largest (width, height) in an ICO directory (the same size
+    that PIL reports).
+    """
+    count = struct.unpack("<H", header[4:6])[0]
+    if count < 1:
+        return None
+    ins.seek(6)
+    directory = ins.read(16 * count)
+    if len(directory) < 16 * count:
+        return None
+    ret = None
+    for entryI in range(count):
+        entry = directory[entryI*16:entryI*16+2]
+        width = entry[0] or 256
+        height = entry[1] or 256
+        if (ret is None) or (width * height > ret[0] * ret[1]):
+            ret = (width, height)
+    return ret
+
+
+def _heifSize(ins):
+    """
+    Get the largest (width, height) of the ispe properties of a HEIF
+    file (the primary image, not its thumbnails or grid tiles).
+    """
+    ins.seek(0)
+    data = ins.read(maxHeifMetaSize)
+    ret = None
+    i = data.find(b"ispe", 4)
+    while (i >= 0) and (i + 16 <= len(data)):
+        width, height = struct.unpack(">II", data[i+8:i+16])
+        if (ret is None) or (width * height > ret[0] * ret[1]):
+            ret = (width, height)
+        i = data.find(b"ispe", i + 4)
+    return ret
+
+
+def probeImageSizeOfFile(ins):
+    """
+    Get (width, height) from a binary file object positioned at the
+    start of an image, or None if the format is not handled here.
+    """
+    header = ins.read(headerSize)
+    ret = None
+    if header[:8] == pngSignature:
+        if header[12:16] == b"IHDR":
+            ret = struct.unpack(">II", header[16:24])
+    elif header[:3] == b"\xff\xd8\xff":
+        ins.seek(2)
+        ret = _jpegSize(ins)
+    elif header[:6] in gifSignatures:
+        ret = struct.unpack("<HH", header[6:10])
+    elif (header[:2] == b"BM") and (len(header) >= 26):
+        dibSize = struct.unpack("<I", header[14:18])[0]
+        if dibSize == 12:
+            ret = struct.unpack("<HH", header[18:22])
+        elif dibSize in bmpHeaderSizes:
+            width, height = struct.unpack("<ii", header[18:26])
+            # A negative height means the rows are stored top-down.
+            ret = (width, abs(height))
+    elif header[:4] == icoSignature:
+        ret = _icoSize(ins, header)
+    elif (header[4:8] == b"ftyp") and (header[8:12] in heifBrands):
+        ret = _heifSize(ins)
+    if ret is not None:
+        if (ret[0] < 1) or (ret[1] < 1):
+            return None
+        ret = (ret[0], ret[1])
+    return ret
+
+
+def _readIfd(ins, tiffStart, tiffSize, offset, byteOrder, found):
+    """
+    Add the date tags (see exifDateTags) of the IFD at offset (from the
+    start of the TIFF header) to found, and get the offset of the Exif
+    IFD if this IFD points to one (otherwise None).
+    """
+    if (offset < 8) or (offset + 2 > tiffSize):
+        raise ValueError("bad IFD offset")
+    ins.seek(tiffStart + offset)
+    entryCount = struct.unpack(byteOrder + "H", ins.read(2))[0]
+    if (entryCount > maxIfdEntries) \
+            or (offset + 2 + 12 * entryCount > tiffSize):
+        raise ValueError("bad IFD entry count")
+    entries = ins.read(12 * entryCount)
+    exifOffset = None
+    for entryI in range(entryCount):
+        tag, valueType, valueCount, value = struct.unpack(
+            byteOrder + "HHII", entries[entryI*12:entryI*12+12]
+        )
+        if tag == exifIfdTag:
+            exifOffset = value
+            continue
+        name = exifDateTags.get(tag)
+        if (name is None) or (valueType != 2):
+            # not a date, or not ASCII
+            continue
+        if valueCount <= 4:
+            data = entries[entryI*12+8:entryI*12+8+valueCount]
+        else:
+            if value + valueCount > tiffSize:
+                raise ValueError("bad " + name + " offset")
+            ins.seek(tiffStart + value)
+            data = ins.read(valueCount)
+        found[name] = data.decode('ascii', 'replace').rstrip("\x00")
+        if name == "DateTimeDigitized":
+            # It is the first choice of extract_exif_date, so stop.
+            break
+    return exifOffset
+
+
+def readExifDatesOfFile(ins):
+    """
+    Get a dict of the EXIF dates (see exifDateTags) in a binary file
+    object positioned at the start of a JPEG, or None if it has no EXIF
+    segment. Only the IFD entries and the date strings are read.
+
+    Raises ValueError or struct.error if the file is not a JPEG or the
+    EXIF data is damaged (so the caller can try PIL instead).
+    """
+    if ins.read(2) != b"\xff\xd8":
+        raise ValueError("not a JPEG")
+    for segmentI in range(maxJpegSegments):
+        byte = ins.read(1)
+        if byte != b"\xff":
+            raise ValueError("bad JPEG marker")
+        marker = ins.read(1)
+        while marker == b"\xff":
+            # fill bytes
+            marker = ins.read(1)
+        if len(marker) < 1:
+            raise ValueError("truncated JPEG")
+        markerI = marker[0]
+        if markerI in jpegStandaloneMarkers:
+            continue
+        if markerI == 0xD9 or markerI == 0xDA:
+            # end of image, or start of scan (EXIF is always before)
+            return None
+        length = struct.unpack(">H", ins.read(2))[0]
+        if length < 2:
+            raise ValueError("bad JPEG segment length")
+        segmentStart = ins.tell()
+        if (markerI == 0xE1) and (length >= 2 + 6 + 8):
+            if ins.read(6) == exifSignature:
+                tiffStart = ins.tell()
+                tiffSize = length - 2 - 6
+                tiffHeader = ins.read(8)
+                if tiffHeader[:4] == b"II*\x00":
+                    byteOrder = "<"
+                elif tiffHeader[:4] == b"MM\x00*":
+                    byteOrder = ">"
+                else:
+                    raise ValueError("bad TIFF header")
+                found = {}
+                offset = struct.unpack(byteOrder + "I", tiffHeader[4:8])[0]
+                exifOffset = _readIfd(ins, tiffStart, tiffSize, offset,
+                                      byteOrder, found)
+                if exifOffset is not None:
+                    _readIfd(ins, tiffStart, tiffSize, exifOffset,
+                             byteOrder, found)
+                return found
+        ins.seek(segmentStart + length - 2)
+    return None
+
+
+def probeExifDates(path):
+    """
+    Get readExifDatesOfFile for the file at path. Unlike the functions
+    above, this raises ValueError or struct.error instead of returning
+    None for a file it cannot read, since None means there is no EXIF.
+    """
+    with open(path, 'rb') as ins:
+        return readExifDatesOfFile(ins)
+
+
+def probeImageSize(path):
+    """
+    Get (width, height) of the image at path by reading only its header,
+    or None if the format is not handled here or the header is damaged.
+    """
+    try:
+        with open(path, 'rb') as ins:
+            return probeImageSizeOfFile(ins)
+    except (OSError, struct.error):
+        return None
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""
+Count what a run does and how long each kind of step takes, and write
+it out as JSON so runs can be graphed and compared.
+
+Usage:
+startMetrics("metrics.jsonl")  # optional: also write a snapshot to
+                               # this file every writeInterval seconds
+                               # and when the program exits
+with phase("sort"):
+    with timed("move"):
+        shutil.move(src, dst)
+    count("files.Pictures")
+    count("bytes.moved", fileSize)
+print(json.dumps(snapshot()))
+
+Counters and timings are always kept (they are cheap), but nothing is
+written unless startMetrics is called. Each line of the file is one
+snapshot: {"final": false, ...} while running and {"final": true, ...}
+at exit. A worker process can send what it recorded to the parent (see
+takeMetrics and mergeMetrics).
+"""
+import os
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+writeInterval = 60.0  # seconds between snapshots written by startMetrics
+
+# Each histogram bucket counts timings up to twice its lower bound,
+# starting with minBucketSeconds (so the bucket names are powers of 2
+# in microseconds).
+minBucketSeconds = 0.000001
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_phases = {}  # name -> {'seconds': total, 'runs': count}
+_phaseStack = []
+_startTime = time.time()
+_writer = None
+
+
+def count(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def observe(name, seconds):
+    """
+    Add a timing (in seconds) to the histogram called name.
+    """
+    bucket = minBucketSeconds
+    while (seconds >= bucket * 2) and (bucket < 1e6):
+        bucket *= 2
+    bucketName = str(int(round(bucket / minBucketSeconds)))
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = {'count': 0, 'seconds': 0.0, 'min': seconds,
+                         'max': seconds, 'buckets': {}}
+            _histograms[name] = histogram
+        histogram['count'] += 1
+        histogram['seconds'] += seconds
+        if seconds < histogram['min']:
+            histogram['min'] = seconds
+        if seconds > histogram['max']:
+            histogram['max'] = seconds
+        buckets = histogram['buckets']
+        buckets[bucketName] = buckets.get(bucketName, 0) + 1
+
+
+@contextmanager
+def timed(name):
+    """
+    Add the time that the with block takes to the histogram called name
+    (even if it raises an exception).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def timedIter(name, iterable):
+    """
+    Yield the items of iterable, adding the time taken to get each one
+    to the histogram called name (such as for a directory walk).
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        observe(name, time.perf_counter() - start)
+        yield item
+
+
+@contextmanager
+def phase(name):
+    """
+    Record the total time of a with block as a phase of the run.
+    """
+    start = time.perf_counter()
+    with _lock:
+        _phaseStack.append(name)
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            _phaseStack.pop()
+            info = _phases.get(name)
+            if info is None:
+                info = {'seconds': 0.0, 'runs': 0}
+                _phases[name] = info
+            info['seconds'] += seconds
+            info['runs'] += 1
+
+
+def takeMetrics():
+    """
+    Get the counters and histograms recorded so far, and start them over
+    (such as in a worker process, so that its work can be added to the
+    parent's with mergeMetrics).
+    """
+    global _counters
+    global _histograms
+    with _lock:
+        ret = {'counters': _counters, 'histograms': _histograms}
+        _counters = {}
+        _histograms = {}
+    return ret
+
+
+def mergeMetrics(taken):
+    """
+    Add the counters and histograms from takeMetrics (such as from a
+    worker process) to the ones recorded here.
+    """
+    with _lock:
+        for name, amount in taken['counters'].items():
+            _counters[name] = _counters.get(name, 0) + amount
+        for name, other in taken['histograms'].items():
+            histogram = _histograms.get(name)
+            if histogram is None:
+                histogram = {'count': 0, 'seconds': 0.0,
+                             'min': other['min'], 'max': other['max'],
+                             'buckets': {}}
+                _histograms[name] = histogram
+            histogram['count'] += other['count']
+            histogram['seconds'] += other['seconds']
+            if other['min'] < histogram['min']:
+                histogram['min'] = other['min']
+            if other['max'] > histogram['max']:
+                histogram['max'] = other['max']
+            buckets = histogram['buckets']
+            for bucketName, bucketCount in other['buckets'].items():
+                buckets[bucketName] = (buckets.get(bucketName, 0)
+                                       + bucketCount)
+
+
+def snapshot(final=False):
+    """
+    Get a JSON-compatible copy of all of the metrics so far.
+    """
+    with _lock:
+        histograms = {}
+        for name, histogram in _histograms.items():
+            histograms[name] = histogram.copy()
+            histograms[name]['buckets'] = histogram['buckets'].copy()
+        phases = {}
+        for name, info in _phases.items():
+            phases[name] = info.copy()
+        return {
+            'final': final,
+            'time': time.time(),
+            'started': _startTime,
+            'elapsed': time.time() - _startTime,
+            'pid': os.getpid(),
+            'phase': _phaseStack[-1] if _phaseStack else None,
+            'phases': phases,
+            'counters': _counters.copy(),
+            'histograms': histograms,
+        }
+
+
+class MetricsWriter:
+    """
+    Append a snapshot to path every interval seconds (using a daemon
+    thread) and when closed.
+    """
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopEvent.wait(self.interval):
+            self.write()
+
+    def write(self, final=False):
+        with open(self.path, 'a') as outs:
+            outs.write(json.dumps(snapshot(final=final)) + "\n")
+
+    def close(self):
+        self.stopEvent.set()
+        self.thread.join()
+        self.write(final=True)
+
+
+def startMetrics(path, interval=None):
+    """
+    Write snapshots to path (one JSON object per line) periodically and
+    when the program exits (or stopMetrics is called).
+    """
+    global _writer
+    stopMetrics()
+    if interval is None:
+        interval = writeInterval
+    _writer = MetricsWriter(path, interval)
+    return _writer
+
+
+def stopMetrics():
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+
+atexit.register(stopMetrics)
@@ -5,7 +5,9 @@ from __future__ import print_function
 
 # import EXIF  # requires https://github.com/ianare/exif-py
 import os
-import shutil
+import re
+import mmap
+import atexit
 
 # import PIL.Image
 try:
@@ -23,11 +25,27 @@ import struct
 from tinytag import TinyTag
 from tinytag import TinyTagException
 
+from scancache import cachedFact
+from treewalk import walkEntries
+from treewalk import scanFolder
+from asyncscan import mapFilesInOrder
+from imageheader import probeImageSize
+from imageheader import probeExifDates
+from moveplan import moveFile
+from progress import Progress
+from progress import totalsOfEntries
+from fuzzynames import TrigramIndex
+from fuzzynames import normalizeName
+
 dataDirName = "data"
-dataDirPath = dataDirName
+dataDirPath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           dataDirName)
 similarsDirName = "similar"
 similarsDirPath = os.path.join(dataDirPath, similarsDirName)
 similarLists = {}  # formerly artists and albums
+similarStores = {}  # SimilarNames for each list in similarLists
+similarFlushInterval = 1000  # new names to buffer before writing
+enableFuzzyNames = True  # also match typos (see SimilarNames.getFuzzy)
 
 
 badPathChars = ["></\\:;\t|\n\r\"?"]   # NOTE: Invalid characters on
@@ -44,7 +62,7 @@ categories["eBooks"] = ["prc", "lit"]
 categories["Links"] = ["url", "website"]
 categories["Meshes"] = ["x3d"]
 categories["Music"] = ["ape", "flac", "m4a", "mid", "mp3", "ogg", "wav", "wma"]
-categories["Pictures"] = ["bmp", "gif", "ico", "jpe", "jpeg", "jpg", "png", "psd", "svg", "wmf"]
+categories["Pictures"] = ["avif", "bmp", "gif", "heic", "ico", "jpe", "jpeg", "jpg", "png", "psd", "svg", "wmf"]
 categories["Playlists"] = ["asx", "bpl", "feed", "itpc", "m3u", "m3u8", "opml", "pcast", "pls", "podcast", "rm", "rmj","rmm", "rmx", "rp", "smi", "smil", "upf", "vlc", "wpl", "xspf", "zpl"]
 categories["Shortcuts"] = ["lnk"]
 categories["Videos"] = ["asf", "avi", "mp2", "mp4", "mpe", "mpeg", "mpg", "mov", "swf", "wmv", "webm", "wm"]
@@ -103,44 +121,179 @@ def getSimilar(needle, haystack):
                     ret = s
     return ret
 
-# formerly getAndCollectSimilarAlbum and getAndCollectSimilarArtist
-def getAndCollectSimilar(name, what):
-    global similarLists
-    whatName = what + ".txt"
-    whatPath = os.path.join(similarsDirPath, whatName)
-    if similarLists.get(what) is None:
-        similarLists[what] = []
-        if os.path.isfile(whatPath):
-            print("* loading " + what + "...")
-            ins = open(whatPath, 'r')
-            rawLine = True
-            while rawLine:
-                rawLine = ins.readline()
-                if rawLine:
+class SimilarNames:
+    """
+    Keep a list of names (such as artists) loaded from a file, indexed
+    by lowercase name so that get gives the same result as getSimilar
+    without checking every name, and by normalized name for getFuzzy.
+    New names are written to the file in batches (see flush).
+
+    Names added with a fuzzyScope (such as the artist of an album) are
+    only found by getFuzzy with the same fuzzyScope, and names from the
+    file only without one.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.nameSet = set()
+        self.entryByName = {}  # name -> (quality, order, name)
+        # lowercase name -> (quality, order, name) of the best match
+        self.index = {}
+        self.pending = []
+        # normalized name -> (quality, order, name) of the best match
+        self.fuzzy = TrigramIndex()
+        self.fuzzyByScope = {}  # fuzzyScope -> TrigramIndex like fuzzy
+        if os.path.isfile(path):
+            with open(path, 'r') as ins:
+                for rawLine in ins:
                     line = rawLine.strip()
                     if len(line) > 0:
-                        similarLists[what].append(line)
-            ins.close()
-    ret = getSimilar(name, similarLists[what])
+                        self._add(line)
+
+    def _getFuzzyIndex(self, fuzzyScope, create=False):
+        if fuzzyScope is None:
+            return self.fuzzy
+        fuzzy = self.fuzzyByScope.get(fuzzyScope)
+        if (fuzzy is None) and create:
+            fuzzy = TrigramIndex()
+            self.fuzzyByScope[fuzzyScope] = fuzzy
+        return fuzzy
+
+    def _addFuzzy(self, entry, fuzzyScope):
+        fuzzyKey = normalizeName(entry[2])
+        if len(fuzzyKey) > 0:
+            fuzzy = self._getFuzzyIndex(fuzzyScope, create=True)
+            prev = fuzzy.get(fuzzyKey)
+            if (prev is None) or (entry[0] > prev[0]):
+                fuzzy.set(fuzzyKey, entry)
+
+    def _add(self, name, fuzzyScope=None):
+        entry = (getTitleQuality(name), len(self.names), name)
+        self.names.append(name)
+        self.nameSet.add(name)
+        self.entryByName[name] = entry
+        key = name.lower()
+        prev = self.index.get(key)
+        # Like getSimilar, the first name with the highest quality wins.
+        if (prev is None) or (entry[0] > prev[0]):
+            self.index[key] = entry
+        self._addFuzzy(entry, fuzzyScope)
+
+    def add(self, name, fuzzyScope=None):
+        """
+        Add the name if it is new, and write it to the file later. If it
+        is not new, it can still be found by getFuzzy with fuzzyScope.
+        """
+        if name in self.nameSet:
+            if fuzzyScope is not None:
+                self._addFuzzy(self.entryByName[name], fuzzyScope)
+            return False
+        self._add(name, fuzzyScope=fuzzyScope)
+        self.pending.append(name)
+        if len(self.pending) >= similarFlushInterval:
+            self.flush()
+        return True
+
+    def get(self, needle):
+        """
+        Get the best version of needle (or of needle with "The " added)
+        the same way as getSimilar(needle, self.names).
+        """
+        if needle is None:
+            return None
+        best = None
+        for key in (needle.lower(), getWithThe(needle).lower()):
+            entry = self.index.get(key)
+            if entry is None:
+                continue
+            if (best is None) or (entry[0] > best[0]) \
+                    or ((entry[0] == best[0]) and (entry[1] < best[1])):
+                best = entry
+        if best is None:
+            return None
+        return best[2]
+
+    def getFuzzy(self, needle, fuzzyScope=None):
+        """
+        Get the name most like needle (see fuzzynames), preferring the
+        fewest edits, then the highest quality, then the earliest name.
+        """
+        if needle is None:
+            return None
+        fuzzy = self._getFuzzyIndex(fuzzyScope)
+        if fuzzy is None:
+            return None
+        found = fuzzy.find(normalizeName(needle))
+        if len(found) < 1:
+            return None
+        distance, key, entry = min(
+            found,
+            key=lambda item: (item[0], -item[2][0], item[2][1])
+        )
+        return entry[2]
+
+    def flush(self):
+        if len(self.pending) < 1:
+            return
+        folderPath = os.path.dirname(self.path)
+        if not os.path.isdir(folderPath):
+            os.makedirs(folderPath)
+        with open(self.path, 'a') as outs:
+            # one write, so names from other processes (such as --shard
+            # runs) are not mixed into a line
+            outs.write("".join(name + "\n" for name in self.pending))
+        self.pending = []
+
+
+def getSimilarNames(what):
+    """
+    Get the SimilarNames for what (such as "artist"), loading
+    <similarsDirPath>/<what>.txt the first time.
+    """
+    store = similarStores.get(what)
+    if store is None:
+        whatPath = os.path.join(similarsDirPath, what + ".txt")
+        if os.path.isfile(whatPath):
+            print("* loading " + what + "...")
+        store = SimilarNames(whatPath)
+        similarStores[what] = store
+        similarLists[what] = store.names
+    return store
+
+
+def flushSimilarNames():
+    """
+    Write names that getAndCollectSimilar added to their files.
+    """
+    for store in similarStores.values():
+        store.flush()
+
+
+# formerly getAndCollectSimilarAlbum and getAndCollectSimilarArtist
+def getAndCollectSimilar(name, what, fuzzyScope=None):
+    """
+    Get the best known version of name (see SimilarNames.get), or one
+    with a typo fixed (see SimilarNames.getFuzzy) if enableFuzzyNames,
+    only looking among names collected with the same fuzzyScope (such as
+    albums of the same artist). Otherwise, collect and return name.
+    """
+    store = getSimilarNames(what)
+    ret = store.get(name)
+    if (ret is None) and enableFuzzyNames:
+        ret = store.getFuzzy(name, fuzzyScope=fuzzyScope)
+        if ret is not None:
+            # Don't keep the variant, or it would match itself next time.
+            return ret
     if name is not None:
-        if name not in similarLists[what]:
-            similarLists[what].append(name)
-            outs = None
-            if not os.path.isdir(similarsDirPath):
-                if not os.path.isdir(dataDirPath):
-                    os.mkdir(dataDirPath)
-                os.mkdir(similarsDirPath)
-            if os.path.isfile(whatPath):
-                outs = open(whatPath, 'a')
-            else:
-                outs = open(whatPath, 'w')
-            outs.write(name + "\n")
-            outs.close()
+        store.add(name, fuzzyScope=fuzzyScope)
     if ret is None:
         ret = name
     return ret
 
 
+atexit.register(flushSimilarNames)
+
+
 def startsWithThe(s):
     if s is None:
         return False
@@ -246,6 +399,25 @@ def isPhotoSize(size, allowRatioAndMinDim=True):
                 break
     return ret
 
+def getImageSize(path):
+    """
+    Get (width, height) of an image file, reading only the header if
+    probeImageSize knows the format, otherwise using PIL. Get None if
+    the file cannot be read as an image.
+    """
+    ret = probeImageSize(path)
+    if ret is not None:
+        return ret
+    try:
+        im = Image.open(path)
+        ret = im.size
+        im.close()
+    except OSError:
+        # such as "Unsupported BMP header type (0)", or svg or other
+        # non-raster or non-image
+        return None
+    return ret
+
 minNonThumbnailPixels = 150 * 199 + 1
 def isThumbnailSize(size):
     ret = False
@@ -262,7 +434,29 @@ def isThumbnailSize(size):
     return ret
 
 
-doneNames = ["thumbnails", "unusable"]
+# Files such as the scan cache are kept in stateDirName.
+stateDirName = ".postrecsort"
+
+doneNames = ["thumbnails", "unusable", stateDirName]
+
+
+def getStateDirPath(folderPath):
+    """
+    Get the stateDirName directory in folderPath or the nearest parent
+    of folderPath that has one (so sorting a subfolder such as Pictures
+    uses the state of the whole profile). If there is none, get the path
+    where it would be in folderPath (it is not created).
+    """
+    parentPath = os.path.abspath(folderPath)
+    while True:
+        statePath = os.path.join(parentPath, stateDirName)
+        if os.path.isdir(statePath):
+            return statePath
+        nextPath = os.path.dirname(parentPath)
+        if nextPath == parentPath:
+            break
+        parentPath = nextPath
+    return os.path.join(folderPath, stateDirName)
 
 # NOTE: case matters in html entities:
 bad_hex_to_html = {
@@ -325,9 +519,9 @@ html_date_patterns.append({
     "brand:": "GeoCities",
     "opener": "<!-- w17.geo.scd.yahoo.com compressed/chunked ",
     "closer": "-->",
-    "format": "%a %b %m %H:%M:%S %Z %Y"  # Thu Sep 18 10:59:24 PDT 2003
+    "format": "%a %b %d %H:%M:%S %Z %Y"  # Thu Sep 18 10:59:24 PDT 2003
 })
-# NOTE: $m is zero-padded, and GeoCities timestamp may not be
+# NOTE: GeoCities timestamp may not be
 # the date info above is only available on pages downloaded from Yahoo
 html_date_patterns.append({
     "brand:": "webbot",
@@ -336,12 +530,48 @@ html_date_patterns.append({
     "format": "%m/%d/%y"  # 10/17/02
 })
 
+# UTC offsets of zone names that %Z does not accept (see parse_date)
+html_zone_offsets = {
+    "UTC": "+0000",
+    "GMT": "+0000",
+    "EST": "-0500",
+    "EDT": "-0400",
+    "CST": "-0600",
+    "CDT": "-0500",
+    "MST": "-0700",
+    "MDT": "-0600",
+    "PST": "-0800",
+    "PDT": "-0700",
+    "AKST": "-0900",
+    "AKDT": "-0800",
+    "HST": "-1000",
+}
+
 def parse_date(dt_s, fmt):
+    """
+    Parse dt_s using the strptime format fmt. If fmt has %Z and dt_s
+    has a zone name in html_zone_offsets (such as "PDT"), the result has
+    that UTC offset (the date and time are still the ones in dt_s).
+    """
+    if "%Z" in fmt:
+        parts = dt_s.split()
+        for i in range(len(parts)):
+            offset = html_zone_offsets.get(parts[i].upper())
+            if offset is not None:
+                parts[i] = offset
+                dt_s = " ".join(parts)
+                fmt = fmt.replace("%Z", "%z")
+                break
     return datetime.strptime(dt_s, fmt)
 
-def extract_exif_date(path, verbose=False):
+def get_exif_using_pil(path):
+    """
+    Get a dict of all EXIF tags by name using PIL, or None if there is
+    no EXIF data.
+    """
     img = Image.open(path)
     exif_data = img._getexif()
+    img.close()
     if exif_data is None:
         # print(",,NO EXIF DATA")
         return None
@@ -352,6 +582,18 @@ def extract_exif_date(path, verbose=False):
         for k, v in exif_data.items()
         if k in PIL.ExifTags.TAGS
     }
+    return exif
+
+
+def extract_exif_date(path, verbose=False):
+    try:
+        # Only read the date tags from the APP1 segment.
+        exif = probeExifDates(path)
+    except (ValueError, struct.error):
+        # not a JPEG or damaged, so see if PIL can read it
+        exif = get_exif_using_pil(path)
+    if exif is None:
+        return None
     # print()
     # print(path + ":")
     # print(str(exif))
@@ -417,211 +659,251 @@ def extract_exif_date(path, verbose=False):
         print("  result: {}".format(t_date))
     return t_date
 
-enc_pattern = {
-    'opener': "decode byte ",
-    'closer': " ",
-    'description': "hex"
-}
+def get_exif_date(path, verbose=False, st=None):
+    """
+    Get extract_exif_date(path), using the scan cache if one is open.
+    Provide st if the result of os.stat(path) is already known.
+    """
+    def compute():
+        t_date = extract_exif_date(path, verbose=verbose)
+        if t_date is None:
+            return None
+        return t_date.isoformat()
+    t_date_s = cachedFact(path, "exifDate", compute, st=st)
+    if t_date_s is None:
+        return None
+    return datetime.fromisoformat(t_date_s)
 
+# Print each byte that is not valid UTF-8 in HTML checked by
+# extract_html_date, and what to change it to (see bad_hex_to_html).
+enable_bad_byte_report = False
+_html_opener_re = None
+_html_opener_re_key = None
 
-def extract_html_date(path):
-    ins = open(path, encoding='utf-8')
-    # utf-8 supposedly allows non-ascii <https://stackoverflow.com/\
-    # questions/35028683/\
-    # python3-unicodedecodeerror-with-readlines-method>, but still fails
-    # on characters in bad_hex_to_html dict above
-    # NOTE: , errors="ignore" will throw away out-of-range bytes
-    pattern = None
-    collect = ""
-    result = None
-    start_line = None
-    closed = False
+
+def get_html_opener_re():
+    """
+    Get a compiled bytes regex that finds the opener of any of the
+    html_date_patterns (rebuilt if the patterns changed).
+    """
+    global _html_opener_re
+    global _html_opener_re_key
+    key = tuple(pattern['opener'] for pattern in html_date_patterns)
+    if key != _html_opener_re_key:
+        _html_opener_re = re.compile(b"|".join(
+            b"(" + re.escape(opener.encode('utf-8')) + b")" for opener in key
+        ))
+        _html_opener_re_key = key
+    return _html_opener_re
+
+
+def report_bad_bytes(path, data):
+    """
+    Print each byte in data (an mmap of path) that is not valid UTF-8,
+    with its line number and the HTML entity to use instead.
+    """
     line_number = 0
-    while True:
+    data.seek(0)
+    for line in iter(data.readline, b""):
         line_number += 1
-        line = False
-        # line = ins.readline()
-        try:
-            line = ins.readline()
-        except UnicodeDecodeError as e:
-            msg = ("," + path + ",(line " + str(line_number) + "): "
-                  + "ERROR: bad character")
-            e_s = str(e)
-
-            opener = enc_pattern['opener']
-            closer = enc_pattern['closer']
-            o_i = e_s.find(opener)
-            byte_found = False
-            if o_i >= 0:
-                start_i = o_i + len(opener)
-                c_i = e_s.find(closer, start_i)
-                if c_i >=0:
-                    byte_found = True
-                    hex_s = e_s[start_i:c_i]
-                    if hex_s[:2] == "0x":
-                        hex_s = hex_s[2:]
-                    hex_s = hex_s.lower()
-                    html_s = bad_hex_to_html.get(hex_s)
-                    if html_s is None:
-                        html_s = "&#x" + hex_s.upper() + ";"
-                    msg += ("--Symbol '0x" + hex_s + "' is not allowed"
-                           + " in HTML--change it to " + html_s)
-                    print(msg + "  " + e_s)
-            if not byte_found:
-                msg += ("--WARNING: Unable to read hex from error:")
-                msg += (" " + e_s)
-                print(msg)
-
-            # False: print("  " + str(line))
-            # break
-            continue
-        if line:
-            line = line.strip()
-            # if line_number == 1:
-                # print("line 1 is: " + line)
-            if pattern is not None:
-                closer_i = line.find(pattern['closer'])
-                if closer_i >= 0:
-                    collect += line[:closer_i]
-                    result = collect
-                    break
-            else:
-                for pattern_i in range(len(html_date_patterns)):
-                    try_pattern = html_date_patterns[pattern_i]
-                    opener_i = line.find(try_pattern['opener'])
-                    if opener_i >= 0:
-                        pattern = try_pattern
-                        start_i = opener_i + len(pattern['opener'])
-                        closer_i = line.find(pattern['closer'], start_i)
-                        if closer_i >= 0:
-                            result = line[start_i:closer_i]
-                            closed = True
-                        else:
-                            collect = line[start_i:]
-                        break
-            if closed:
+        start_i = 0
+        while True:
+            try:
+                line[start_i:].decode('utf-8')
                 break
-        else:
-            break
-    if (len(collect) > 0) and (result is None):
-        print("ERROR: found " + pattern['opener'] + "' without '"
-              + pattern['closer'])
-    ins.close()
+            except UnicodeDecodeError as e:
+                bad_i = start_i + e.start
+            hex_s = "{:02x}".format(line[bad_i])
+            html_s = bad_hex_to_html.get(hex_s)
+            if html_s is None:
+                html_s = "&#x" + hex_s.upper() + ";"
+            print("," + path + ",(line " + str(line_number) + "): "
+                  + "ERROR: bad character--Symbol '0x" + hex_s + "' is"
+                  + " not allowed in HTML--change it to " + html_s)
+            start_i = bad_i + 1
+
+
+def extract_html_date(path, report=None):
+    """
+    Get the date from the first of the html_date_patterns found in an
+    HTML file, or None. The file is searched as bytes (using mmap) for
+    all of the openers at once, and only the date is decoded.
+
+    Keyword arguments:
+    report -- (default enable_bad_byte_report) also print each byte that
+              is not valid UTF-8 (see report_bad_bytes)
+    """
+    if report is None:
+        report = enable_bad_byte_report
+    result = None
+    pattern = None
+    with open(path, 'rb') as ins:
+        if os.fstat(ins.fileno()).st_size < 1:
+            # mmap can't map an empty file
+            return None
+        with mmap.mmap(ins.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if report:
+                report_bad_bytes(path, data)
+            match = get_html_opener_re().search(data)
+            if match is not None:
+                pattern = html_date_patterns[match.lastindex - 1]
+                closer = pattern['closer'].encode('utf-8')
+                closer_i = data.find(closer, match.end())
+                if closer_i >= 0:
+                    result = data[match.end():closer_i].decode(
+                        'utf-8', 'replace'
+                    )
+                    # Lines were stripped and joined before (so a date
+                    # can still be split across lines).
+                    result = "".join(
+                        line.strip() for line in result.splitlines()
+                    )
+                else:
+                    print("ERROR: found " + pattern['opener'] + "' without '"
+                          + pattern['closer'])
     dt = None
     if result is not None:
         dt = parse_date(result, pattern['format'])
     return dt
 
-def process_files(folder_path, op, more_results=None, verbose=False):
-    unknown_type = None
-    unknown_type_count = None
-    missing_meta_count = None
-    missing_meta = None
-    processed_count = None
-    # checked_count = None
-    parentName = os.path.basename(folder_path)
+def read_file_date(path, verbose=False, st=None):
+    """
+    Get a tuple of the type_mark ("JPEG" or "HTML") and date of a file
+    that process_files can sort, or (None, None) if it is another type.
+    This only reads, so it can run in a thread (see process_files).
+    """
+    if is_jpeg(path):
+        t_date = get_exif_date(path, verbose=verbose, st=st)
+        # if processed_count == 0:
+            # outs = open("example.exif.dict.txt", 'w')
+            # outs.write(str(exif))
+            # outs.close()
+        return "JPEG", t_date
+    elif is_html(path):
+        return "HTML", extract_html_date(path)
+    return None, None
+
+
+def use_file_date(results, sub_folder_path, sub_path, type_mark, t_date,
+                  op):
+    """
+    Move or show one file using the result of read_file_date, and count
+    it in results (see process_files).
+    """
+    if type_mark is None:
+        results['unknown_type_count'] += 1
+        results['unknown_type'].append(sub_path)
+        return
+    if t_date is not None:
+        taken_s = t_date.strftime("%Y-%m-%d")
+        # print(taken_s)
+        if op == 'move':
+            target_dir_path = os.path.join(sub_folder_path, taken_s)
+            if taken_s != os.path.basename(sub_folder_path):
+                # if not already in dated directory
+                new_path = os.path.join(target_dir_path,
+                                        os.path.basename(sub_path))
+                moveFile(sub_path, new_path)
+        elif op == 'show':
+            print(taken_s + "," + sub_path)
+            # print("  - IS " + type_mark)
+        results['processed_count'] += 1
+    else:
+        results['missing_meta_count'] += 1
+        results['missing_meta'].append(sub_path)
+
+
+def _read_file_date_of_entry(folder_path, depth, entry, verbose=False):
+    # (for mapFilesInOrder)
+    st = entry.stat() if is_jpeg(entry.path) else None
+    type_mark, t_date = read_file_date(entry.path, verbose=verbose, st=st)
+    return folder_path, entry.path, type_mark, t_date
+
+
+def process_files(folder_path, op, more_results=None, verbose=False,
+                  concurrency=None):
+    """
+    Move each JPEG and HTML file under folder_path into a yyyy-mm-dd
+    folder beside it using the date inside of it (if op is 'move'), or
+    print the dates (if op is 'show').
+
+    Keyword arguments:
+    more_results -- counts and lists from a previous call to add to
+    concurrency -- If not None, stat and read files in this many threads
+                   at once (see asyncscan), which helps when each call
+                   waits on a slow mount. Files are still moved in this
+                   thread in the same order.
+    """
     results = {}
 
     if more_results is not None:
         results = more_results
-    unknown_type = results.get('unknown_type', [])
-    unknown_type_count = results.get('unknown_type_count', 0)
-    missing_meta = results.get('missing_meta', [])
-    missing_meta_count = results.get('missing_meta_count', 0)
-    processed_count = results.get('processed_count', 0)
-    # checked_count = results.get('checked_count', 0)
-
-    if os.path.isdir(folder_path):
-        for sub_name in os.listdir(folder_path):
-            sub_path = os.path.join(folder_path, sub_name)
-            if sub_name[:1] == ".":
-                continue
-            if os.path.isdir(sub_path):
-                if sub_name not in doneNames:
-                    process_files(sub_path, op, more_results=results)
-            elif os.path.isfile(sub_path):
-                t_date = None
-                type_mark = None
-                if is_jpeg(sub_path):
-
-                    t_date = extract_exif_date(sub_path,
-                                               verbose=verbose)
-                    # if processed_count == 0:
-                        # outs = open("example.exif.dict.txt", 'w')
-                        # outs.write(str(exif))
-                        # outs.close()
-                    type_mark = "JPEG"
-                elif is_html(sub_path):
-                    t_date = extract_html_date(sub_path)
-                    type_mark = "HTML"
-                else:
-                    unknown_type_count += 1
-                    unknown_type.append(sub_path)
-                    continue
-
-                if t_date is not None:
-                    taken_s = t_date.strftime("%Y-%m-%d")
-                    # print(taken_s)
-                    if op == 'move':
-                        target_dir_path = os.path.join(folder_path, taken_s)
-                        if taken_s != parentName:
-                            if not os.path.isdir(target_dir_path):
-                                os.makedirs(target_dir_path)
-                            # if not already in dated directory
-                            new_path = os.path.join(target_dir_path, sub_name)
-                            shutil.move(sub_path, new_path)
-                    elif op == 'show':
-                        print(taken_s + "," + sub_path)
-                        # print("  - IS " + type_mark)
-                    processed_count += 1
-                else:
-                    missing_meta_count += 1
-                    missing_meta.append(sub_path)
-    else:
+    results.setdefault('unknown_type', [])
+    results.setdefault('unknown_type_count', 0)
+    results.setdefault('missing_meta', [])
+    results.setdefault('missing_meta_count', 0)
+    results.setdefault('processed_count', 0)
+    # results.setdefault('checked_count', 0)
+
+    walk_options = {
+        'skipNames': doneNames,
+        'skipDotDirs': True,
+        'skipDotFiles': True,
+    }
+    if not os.path.isdir(folder_path):
         print(",,ERROR: '" + folder_path + "' is not a directory.")
-    results['unknown_type_count'] = unknown_type_count
-    results['unknown_type'] = unknown_type
-    results['missing_meta'] = missing_meta
-    results['missing_meta_count'] = missing_meta_count
-    results['processed_count'] = processed_count
+    elif concurrency is not None:
+        def read(sub_folder_path, depth, entry):
+            return _read_file_date_of_entry(sub_folder_path, depth, entry,
+                                            verbose=verbose)
+
+        def use(result):
+            sub_folder_path, sub_path, type_mark, t_date = result
+            use_file_date(results, sub_folder_path, sub_path, type_mark,
+                          t_date, op)
+
+        mapFilesInOrder(folder_path, read, use, concurrency=concurrency,
+                        **walk_options)
+    else:
+        for sub_folder_path, depth, dir_entries, file_entries in \
+                walkEntries(folder_path, **walk_options):
+            for entry in file_entries:
+                sub_folder_path, sub_path, type_mark, t_date = \
+                    _read_file_date_of_entry(sub_folder_path, depth, entry,
+                                             verbose=verbose)
+                use_file_date(results, sub_folder_path, sub_path, type_mark,
+                              t_date, op)
     return results
 
 # Non-recursively sort into "ext" directories where ext is extension.
 def sortByExt(folderPath):
     if os.path.isdir(folderPath):
-        subs = os.listdir(folderPath)
-        subIndex = -1
-        interval = len(subs) / 100
-        if interval < 0:
-            interval = 1
-        progressChunkCount = -1
-        for subName in subs:
-            subIndex += 1
-            progressChunkCount += 1
+        dirEntries, subs = scanFolder(folderPath)
+        parentName = os.path.basename(folderPath)
+        progress = Progress(parentName,
+                            totalsOfEntries(subs, getCategoryByExtUsingPath))
+        for entry in subs:
             newPath = None
             catPath = folderPath
             subCatName = None
-            subPath = os.path.join(folderPath, subName)
-            parentName = os.path.basename(folderPath)
-            if progressChunkCount >= interval:
-                print("# " + parentName + " " + str(int(round(float(subIndex)/float(len(subs))*100.0))) + "%")
-                progressChunkCount = -1
-            if os.path.isfile(subPath):
-                ext = os.path.splitext(subPath)[1]
-                if len(ext) > 1:
-                    ext = ext[1:]  # remove dot
-                else:
-                    continue
-                lowerExt = ext.lower()
-                category = getCategoryByExt(lowerExt)
-                if category is not None:
-                    catPath = os.path.join(folderPath, category)
-                    if not os.path.isdir(catPath):
-                        os.makedirs(catPath)
-                    newPath = os.path.join(catPath, subName)
-                    if newPath != subPath:
-                        # print("mv '" + subPath + "' '" + newPath + "'")
-                        shutil.move(subPath, newPath)
+            subName = entry.name
+            subPath = entry.path
+            progress.advance(getCategoryByExtUsingPath(subPath),
+                             entry.stat().st_size)
+            ext = os.path.splitext(subPath)[1]
+            if len(ext) > 1:
+                ext = ext[1:]  # remove dot
+            else:
+                continue
+            lowerExt = ext.lower()
+            category = getCategoryByExt(lowerExt)
+            if category is not None:
+                catPath = os.path.join(folderPath, category)
+                newPath = os.path.join(catPath, subName)
+                if newPath != subPath:
+                    # print("mv '" + subPath + "' '" + newPath + "'")
+                    moveFile(subPath, newPath)
+        progress.finish()
 
 
 def modificationDate(filePath):
@@ -675,12 +957,148 @@ def replaceMany(s, tuples):
     return ret
 
 
-def getCategoryByExt(lowercaseExt):
+categoryByExt = {}
+
+
+def indexCategories():
+    """
+    Rebuild categoryByExt from categories (call this after changing
+    categories). If an extension is in more than one list, the last
+    list wins.
+    """
+    categoryByExt.clear()
     for k, v in categories.items():
-        # print("checking if " + str(v) + "in" + str(catDirNames))
-        if lowercaseExt in v:
-            category = k
-    return category
+        for ext in v:
+            categoryByExt[ext] = k
+
+
+indexCategories()
+
+
+def getCategoryByExt(lowercaseExt):
+    """
+    Get the category of a lowercase extension, or None if unknown.
+    """
+    return categoryByExt.get(lowercaseExt)
+
+
+sniffSize = 512  # bytes read by sniffExt
+
+# (offset, signature, extension) for sniffExt, checked in order
+magicSignatures = [
+    (0, b"\x89PNG\r\n\x1a\n", "png"),
+    (0, b"\xff\xd8\xff", "jpg"),
+    (0, b"GIF87a", "gif"),
+    (0, b"GIF89a", "gif"),
+    (0, b"8BPS", "psd"),
+    (0, b"\x00\x00\x01\x00", "ico"),
+    (0, b"\xd7\xcd\xc6\x9a", "wmf"),
+    (0, b"%PDF", "pdf"),
+    (0, b"%!PS", "ps"),
+    (0, b"{\\rtf", "rtf"),
+    (0, b"ID3", "mp3"),
+    (0, b"fLaC", "flac"),
+    (0, b"OggS", "ogg"),
+    (0, b"MThd", "mid"),
+    (0, b"MAC ", "ape"),
+    (0, b"\x1a\x45\xdf\xa3", "webm"),
+    (0, b"\x30\x26\xb2\x75\x8e\x66\xcf\x11", "asf"),
+    (0, b"\x00\x00\x01\xba", "mpg"),
+    (0, b"\x00\x00\x01\xb3", "mpg"),
+    (0, b"FWS", "swf"),
+    (0, b"CWS", "swf"),
+    (0, b"7z\xbc\xaf\x27\x1c", "7z"),
+    (0, b"SQLite format 3\x00", "sqlite"),
+    (0, b"!BDN", "pst"),
+    (0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "doc"),
+    (0, b"PK\x03\x04", "zip"),
+    (0, b"\x1f\x8b", "gz"),
+    (0, b"MZ", "exe"),
+    (0, b"\x7fELF", "elf"),
+    (0, b"d8:announce", "torrent"),
+    (257, b"ustar", "tar"),
+]
+
+# ISO base media (ftyp box) major brands by the extension to use (3gp*
+# brands are also "mp4", and other brands are not recognized, since
+# they can be photos such as HEIC or something else entirely)
+ftypBrandExts = {
+    b"M4A ": "m4a",
+    b"M4B ": "m4a",
+    b"M4P ": "m4a",
+    b"qt  ": "mov",
+    b"isom": "mp4",
+    b"iso2": "mp4",
+    b"iso4": "mp4",
+    b"iso5": "mp4",
+    b"iso6": "mp4",
+    b"mp41": "mp4",
+    b"mp42": "mp4",
+    b"M4V ": "mp4",
+    b"M4VH": "mp4",
+    b"M4VP": "mp4",
+    b"avc1": "mp4",
+    b"dash": "mp4",
+    b"MSNV": "mp4",
+    b"heic": "heic",
+    b"heix": "heic",
+    b"heim": "heic",
+    b"heis": "heic",
+    b"mif1": "heic",
+    b"msf1": "heic",
+    b"avif": "avif",
+    b"avis": "avif",
+}
+
+# MPEG audio frame sync without an ID3 tag (layer III)
+mp3FrameStarts = [b"\xff\xfb", b"\xff\xfa", b"\xff\xf3", b"\xff\xf2"]
+
+
+def sniffExtOfHeader(header):
+    """
+    Get the usual lowercase extension (without a dot) of a file that
+    starts with the bytes in header, or None if not recognized.
+    """
+    if header[:4] == b"RIFF":
+        riffType = header[8:12]
+        if riffType == b"WAVE":
+            return "wav"
+        elif riffType == b"AVI ":
+            return "avi"
+        return None
+    if header[4:8] == b"ftyp":
+        brand = header[8:12]
+        ext = ftypBrandExts.get(brand)
+        if (ext is None) and (brand[:3] == b"3gp"):
+            ext = "mp4"
+        elif (brand in (b"mif1", b"msf1")) and (b"avif" in header[16:32]):
+            # a generic HEIF brand with AVIF as a compatible brand
+            ext = "avif"
+        return ext
+    if header[:2] == b"BM" and len(header) >= 18:
+        # The DIB header size distinguishes a BMP from text such as "BM"
+        dibSize = struct.unpack("<I", header[14:18])[0]
+        if dibSize in (12, 40, 52, 56, 64, 108, 124):
+            return "bmp"
+    for offset, signature, ext in magicSignatures:
+        if header[offset:offset+len(signature)] == signature:
+            return ext
+    if header[:2] in mp3FrameStarts:
+        return "mp3"
+    return None
+
+
+def sniffExt(path):
+    """
+    Get the usual extension of the file at path by reading only the
+    first sniffSize bytes (see sniffExtOfHeader).
+    """
+    try:
+        with open(path, 'rb') as ins:
+            header = ins.read(sniffSize)
+    except OSError:
+        return None
+    return sniffExtOfHeader(header)
 
 
 
@@ -700,10 +1118,50 @@ def hasAnyChar(haystack, needles):
                 break
     return ret
 
+def neatArtistAlbum(artist, album, collectSimilar=True):
+    if collectSimilar:
+        artist = getAndCollectSimilar(artist, "artist")
+
+    if (artist is None) or (len(artist) == 0):
+        artist = "unknown"
+        # print("artist set to unknown.")
+    if collectSimilar:
+        # Only fix typos using albums of the same artist.
+        album = getAndCollectSimilar(album, "album",
+                                     fuzzyScope=normalizeName(artist))
+    if (album is None) or (len(album) == 0):
+        album = "unknown"
+        # category = None
+    else:
+        album = decodeAny(album)
+    if len(album) == 0:
+        album = "unknown"
+    return artist, album
+
+
+def collectSimilarTags(stats):
+    """
+    Finish a result of neatMetaTags(path, collectSimilar=False) as if
+    collectSimilar had been True (see getAndCollectSimilar).
+    """
+    if 'RawArtist' not in stats:
+        return stats
+    ret = stats.copy()
+    artist, album = neatArtistAlbum(ret.pop('RawArtist'),
+                                    ret.pop('RawAlbum'))
+    ret['Artist'] = artist
+    ret['Album'] = album
+    return ret
+
+
 # Usage:
 # tag = TinyTag.get(subPath)
 # filenName = fileNameFromStats(tag.__dict__)
-def neatMetaTags(path, makeAllValidPathChars=True):
+#
+# If collectSimilar is False, similarLists is neither used nor changed
+# (so the function can run in another process), and the result has the
+# extra keys RawArtist and RawAlbum for collectSimilarTags.
+def neatMetaTags(path, makeAllValidPathChars=True, collectSimilar=True):
     ret = {}
     album = None
     artist = None
@@ -769,19 +1227,11 @@ def neatMetaTags(path, makeAllValidPathChars=True):
                 track = "0" + track
 
         # print("artist is first " + artist)
-        album = getAndCollectSimilar(album, "album")
-        artist = getAndCollectSimilar(artist, "artist")
-
-        if (artist is None) or (len(artist) == 0):
-            artist = "unknown"
-            # print("artist set to unknown.")
-        if (album is None) or (len(album) == 0):
-            album = "unknown"
-            # category = None
-        else:
-            album = decodeAny(album)
-        if len(album) == 0:
-            album = "unknown"
+        if not collectSimilar:
+            ret['RawArtist'] = artist
+            ret['RawAlbum'] = album
+        artist, album = neatArtistAlbum(artist, album,
+                                        collectSimilar=collectSimilar)
         if title is not None:
             if track is not None:
                 trackWithoutZero = track
@@ -802,7 +1252,7 @@ def neatMetaTags(path, makeAllValidPathChars=True):
             else:
                 newName = withExt(title, ext)
         elif track is not None:
-            newName = track + " " + subName
+            newName = track + " " + os.path.basename(path)
     except TinyTagException:
         # no tag info
         pass
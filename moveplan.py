@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+"""
+Move and remove files either right away or by recording a plan that can
+be reviewed and then applied in bulk (see applyplan.py).
+
+A plan file has one JSON object per line:
+{"op": "mv", "src": "<path>", "dst": "<path>"}
+{"op": "rm", "path": "<path>"}
+
+Usage:
+startPlan(planPath)  # or startPlan(None) to only print (dry run)
+if fileExists(newPath):
+    removeFile(newPath)
+moveFile(subPath, newPath)
+finishPlan()
+applyPlan(planPath)  # resumable, and reversible with undoPlan
+
+If no plan is started, moveFile and removeFile act immediately.
+
+While applying, each finished operation is appended to a journal next to
+the plan (planPath + journalSuffix), and removed files are moved into a
+trash folder (planPath + trashSuffix) instead of being deleted, so that
+undoPlan can put everything back. Delete the trash folder manually once
+the result is good.
+"""
+import os
+import json
+
+from transfer import transferFile
+from transfer import iterTransfers
+from transfer import checkFreeSpaceForTransfers
+from metrics import timed
+
+journalSuffix = ".journal"
+trashSuffix = ".trash"
+
+activePlan = None
+_madeDirs = set()
+
+
+def ensureDir(folderPath):
+    """
+    Create folderPath if it does not exist, without checking the disk
+    again for folders that this process already made or found.
+    """
+    if (len(folderPath) == 0) or (folderPath in _madeDirs):
+        return
+    if not os.path.isdir(folderPath):
+        os.makedirs(folderPath)
+    _madeDirs.add(folderPath)
+
+
+class MovePlan:
+    """
+    Record operations instead of doing them. Paths that were moved or
+    removed by the plan so far are tracked, so that fileExists and
+    getFileSize answer as if the plan had already been applied.
+    """
+    def __init__(self, path=None, enablePrint=False):
+        self.path = path
+        self.enablePrint = enablePrint or (path is None)
+        self.opCount = 0
+        # planned path -> size in bytes, or None if planned to be gone
+        self.sizes = {}
+        self.outs = None
+        if path is not None:
+            self.outs = open(path, 'w')
+
+    def _add(self, op):
+        self.opCount += 1
+        if self.outs is not None:
+            self.outs.write(json.dumps(op) + "\n")
+        if self.enablePrint:
+            if op['op'] == "mv":
+                print("mv '" + op['src'] + "' '" + op['dst'] + "'")
+            else:
+                print("rm '" + op['path'] + "'")
+
+    def getSize(self, path):
+        if path in self.sizes:
+            return self.sizes[path]
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return None
+
+    def move(self, src, dst):
+        fileSize = self.getSize(src)
+        self._add({'op': "mv", 'src': src, 'dst': dst})
+        self.sizes[src] = None
+        self.sizes[dst] = fileSize
+
+    def remove(self, path):
+        self._add({'op': "rm", 'path': path})
+        self.sizes[path] = None
+
+    def close(self):
+        if self.outs is not None:
+            self.outs.close()
+            self.outs = None
+
+
+def startPlan(planPath, enablePrint=False):
+    """
+    Record moveFile and removeFile calls in the plan file at planPath
+    (replacing it) until finishPlan. If planPath is None, only print the
+    operations (a dry run).
+    """
+    global activePlan
+    finishPlan()
+    activePlan = MovePlan(planPath, enablePrint=enablePrint)
+    return activePlan
+
+
+def finishPlan():
+    """
+    Stop recording, and get the number of operations recorded.
+    """
+    global activePlan
+    if activePlan is None:
+        return 0
+    activePlan.close()
+    opCount = activePlan.opCount
+    activePlan = None
+    return opCount
+
+
+def moveFile(src, dst):
+    if activePlan is not None:
+        activePlan.move(src, dst)
+        return
+    ensureDir(os.path.dirname(dst))
+    with timed("move"):
+        transferFile(src, dst)
+
+
+def removeFile(path):
+    if activePlan is not None:
+        activePlan.remove(path)
+        return
+    with timed("remove"):
+        os.remove(path)
+
+
+def fileExists(path):
+    """
+    Check whether path is a file (or will be, if a plan is started).
+    """
+    if (activePlan is not None) and (path in activePlan.sizes):
+        return activePlan.sizes[path] is not None
+    return os.path.isfile(path)
+
+
+def pathExists(path):
+    if (activePlan is not None) and (path in activePlan.sizes):
+        return activePlan.sizes[path] is not None
+    return os.path.exists(path)
+
+
+def getFileSize(path):
+    if activePlan is not None:
+        fileSize = activePlan.getSize(path)
+        if fileSize is None:
+            raise FileNotFoundError(path)
+        return fileSize
+    return os.path.getsize(path)
+
+
+def readPlan(planPath):
+    ops = []
+    with open(planPath, 'r') as ins:
+        for line in ins:
+            line = line.strip()
+            if len(line) > 0:
+                ops.append(json.loads(line))
+    return ops
+
+
+def readJournal(planPath):
+    """
+    Get the journal entries (dicts) of a plan in the order applied.
+    """
+    journalPath = planPath + journalSuffix
+    if not os.path.isfile(journalPath):
+        return []
+    return readPlan(journalPath)
+
+
+def getTargetDir(op):
+    if op['op'] == "mv":
+        return os.path.dirname(op['dst'])
+    return os.path.dirname(op['path'])
+
+
+def orderPlan(ops):
+    """
+    Get a list of (index, op) where operations with the same target
+    folder are together (in their original order), so each folder is
+    visited once. If any file is moved from where another operation
+    puts a file, the original order is kept since it may matter.
+    """
+    sources = set()
+    destinations = set()
+    for op in ops:
+        if op['op'] == "mv":
+            sources.add(op['src'])
+            destinations.add(op['dst'])
+    if not sources.isdisjoint(destinations):
+        return list(enumerate(ops))
+    groups = {}
+    for index, op in enumerate(ops):
+        groups.setdefault(getTargetDir(op), []).append((index, op))
+    ret = []
+    for group in groups.values():
+        ret.extend(group)
+    return ret
+
+
+def applyPlan(planPath, dryRun=False, enablePrint=True, streamCount=1):
+    """
+    Do the operations in a plan file. Operations already in the journal
+    (from an interrupted run) are skipped. A file that is missing is
+    skipped, and a move never replaces an existing file (the plan
+    removes files first where that is intended). The free space needed
+    for moves to other devices is checked before starting.
+
+    Keyword arguments:
+    streamCount -- the number of files to move at once (see
+                   transfer.iterTransfers)
+
+    Returns a dict of counts: 'done', 'resumed', 'missing', 'blocked',
+    'failed'.
+    """
+    results = {'done': 0, 'resumed': 0, 'missing': 0, 'blocked': 0,
+               'failed': 0}
+    ops = readPlan(planPath)
+    doneIndices = set()
+    for entry in readJournal(planPath):
+        doneIndices.add(entry['i'])
+    trashPath = planPath + trashSuffix
+    # path -> whether it would exist by now (only used for a dry run)
+    dryExists = {}
+
+    def exists(path):
+        if path in dryExists:
+            return dryExists[path]
+        return os.path.lexists(path)
+
+    def getTrashedPath(index, path):
+        return os.path.join(trashPath,
+                            str(index) + "-" + os.path.basename(path))
+
+    orderedOps = []
+    for index, op in orderPlan(ops):
+        if index in doneIndices:
+            results['resumed'] += 1
+        else:
+            orderedOps.append((index, op))
+    journal = None
+    if not dryRun:
+        pairs = []
+        for index, op in orderedOps:
+            if op['op'] == "mv":
+                pairs.append((op['src'], op['dst']))
+            else:
+                pairs.append((op['path'], getTrashedPath(index, op['path'])))
+        checkFreeSpaceForTransfers(pairs)
+        journal = open(planPath + journalSuffix, 'a')
+
+    def writeJournal(entry):
+        journal.write(json.dumps(entry) + "\n")
+        # Flush so the journal is complete even if the run is killed.
+        journal.flush()
+        results['done'] += 1
+
+    # Moves to do at once: (index, src, dst). None of them can depend
+    # on another (see where flushBatch is called), so they are journaled
+    # in the order they finish.
+    batch = []
+    batchSrcs = set()
+    batchDsts = set()
+
+    def flushBatch():
+        indexByPair = {}
+        for index, src, dst in batch:
+            indexByPair[(src, dst)] = index
+        transfers = iterTransfers(indexByPair.keys(),
+                                  streamCount=streamCount, inOrder=False)
+        for src, dst, error in transfers:
+            if error is not None:
+                print("# failed to move '" + src + "': " + str(error))
+                results['failed'] += 1
+                continue
+            writeJournal({'i': indexByPair[(src, dst)], 'op': "mv",
+                          'src': src, 'dst': dst})
+        del batch[:]
+        batchSrcs.clear()
+        batchDsts.clear()
+
+    maxBatchSize = max(1, streamCount) * 4
+    try:
+        for index, op in orderedOps:
+            if op['op'] == "mv":
+                src = op['src']
+                dst = op['dst']
+                if (dst in batchDsts) or (src in batchDsts) \
+                        or (src in batchSrcs) or (dst in batchSrcs):
+                    # It moves a file that a batched move puts in place
+                    # (or into a place that one empties), so finish the
+                    # batch before checking the paths.
+                    flushBatch()
+                if not exists(src):
+                    print("# missing '" + src + "'")
+                    results['missing'] += 1
+                    continue
+                if exists(dst):
+                    print("# not replacing '" + dst + "'")
+                    results['blocked'] += 1
+                    continue
+                if enablePrint:
+                    print("mv '" + src + "' '" + dst + "'")
+                if dryRun:
+                    dryExists[src] = False
+                    dryExists[dst] = True
+                    results['done'] += 1
+                    continue
+                ensureDir(os.path.dirname(dst))
+                batch.append((index, src, dst))
+                batchSrcs.add(src)
+                batchDsts.add(dst)
+                if len(batch) >= maxBatchSize:
+                    flushBatch()
+            else:
+                # A removal may be what makes room for a later move.
+                flushBatch()
+                path = op['path']
+                if not exists(path):
+                    print("# missing '" + path + "'")
+                    results['missing'] += 1
+                    continue
+                if enablePrint:
+                    print("rm '" + path + "'")
+                if dryRun:
+                    dryExists[path] = False
+                    results['done'] += 1
+                    continue
+                ensureDir(trashPath)
+                trashedPath = getTrashedPath(index, path)
+                transferFile(path, trashedPath)
+                writeJournal({'i': index, 'op': "rm", 'path': path,
+                              'trash': trashedPath})
+        flushBatch()
+    finally:
+        if journal is not None:
+            journal.close()
+    return results
+
+
+def undoPlan(planPath, dryRun=False, enablePrint=True):
+    """
+    Reverse the operations in the journal of a plan, newest first. Each
+    operation that is undone is removed from the journal.
+
+    Returns a dict of counts: 'undone', 'failed'.
+    """
+    results = {'undone': 0, 'failed': 0}
+    entries = readJournal(planPath)
+    remaining = []
+    try:
+        while entries:
+            entry = entries[-1]
+            if entry['op'] == "mv":
+                fromPath = entry['dst']
+                toPath = entry['src']
+            else:
+                fromPath = entry['trash']
+                toPath = entry['path']
+            if (not os.path.lexists(fromPath)) or os.path.lexists(toPath):
+                print("# can't undo: mv '" + fromPath + "' '" + toPath + "'")
+                results['failed'] += 1
+                remaining.append(entries.pop())
+                continue
+            if enablePrint:
+                print("mv '" + fromPath + "' '" + toPath + "'")
+            if dryRun:
+                remaining.append(entries.pop())
+                results['undone'] += 1
+                continue
+            ensureDir(os.path.dirname(toPath))
+            transferFile(fromPath, toPath)
+            entries.pop()
+            results['undone'] += 1
+    finally:
+        if not dryRun:
+            # Keep what was not undone (including anything left in
+            # entries if there was an error) in the original order.
+            remaining = entries + list(reversed(remaining))
+            journalPath = planPath + journalSuffix
+            with open(journalPath, 'w') as outs:
+                for entry in remaining:
+                    outs.write(json.dumps(entry) + "\n")
+    return results
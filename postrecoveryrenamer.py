@@ -8,6 +8,8 @@ import os
 import shutil
 import sys
 
+from treewalk import walkEntries
+
 if len(sys.argv) < 2:
     print("You must specify a directory.")
     exit(1)
@@ -37,56 +39,124 @@ def is_manged_of(good_needle, mangled_needle):
             result = True
     return result
 
-def index_of_nonmangled(good_needles, mangled_needle):
-    result = -1
-    for i in range(0, len(good_needles)):
-        if is_manged_of(good_needles[i], mangled_needle):
-            result = i
+def index_crumbs(good_needles):
+    # Index the names for index_of_nonmangled. Recovery software usually
+    # only replaces the first character with an underscore, so
+    # 'first' maps "_" + name[1:] to the index of the first name with
+    # it. 'chars' (see index_crumb_chars) is added when a name with more
+    # than one mangled character is looked up.
+    first_index = {}
+    for good_i in range(0, len(good_needles)):
+        first_index.setdefault(mangled_fallback_char_string
+                               + good_needles[good_i][1:], good_i)
+    return {'first': first_index, 'chars': None}
+
+
+def index_crumb_chars(good_needles):
+    # Map (length, position, character) to the indices of the names with
+    # that character there (in order).
+    char_index = {}
+    for good_i in range(0, len(good_needles)):
+        good_needle = good_needles[good_i]
+        length = len(good_needle)
+        for i in range(0, length):
+            key = (length, i, good_needle[i])
+            char_index.setdefault(key, []).append(good_i)
+    return char_index
+
+
+def index_of_nonmangled(good_needles, mangled_needle, crumb_index=None):
+    # Only names of the same length are considered. is_manged_of alone
+    # also accepts a longer mangled name (it only compares the first
+    # len(good_needle) characters), which would drop the rest of the
+    # name when renaming.
+    if crumb_index is None:
+        crumb_index = index_crumbs(good_needles)
+    if len(mangled_needle.replace(mangled_fallback_char_string, "")) < 1:
+        # only underscores, so nothing to match
+        return -1
+    result = crumb_index['first'].get(mangled_needle)
+    if result is not None:
+        return result
+    # Check only the names that have all of the known characters, by
+    # intersecting the lists of the names that have each one (rarest
+    # first).
+    if crumb_index['chars'] is None:
+        crumb_index['chars'] = index_crumb_chars(good_needles)
+    length = len(mangled_needle)
+    postings = []
+    for i in range(0, length):
+        char = mangled_needle[i]
+        if char == mangled_fallback_char_string:
+            continue
+        posting = crumb_index['chars'].get((length, i, char))
+        if posting is None:
+            return -1
+        postings.append(posting)
+    postings.sort(key=len)
+    candidates = set(postings[0])
+    for posting in postings[1:]:
+        if len(candidates) < 2:
             break
-    return result
+        candidates.intersection_update(posting)
+    for good_i in sorted(candidates):
+        if is_manged_of(good_needles[good_i], mangled_needle):
+            return good_i
+    return -1
+
+
+def _print_skipped(folder_path, error=None):
+    print("#skipped_inaccessible:\"" + folder_path + "\"")
+    if "system volume information" in folder_path.lower():
+        print("#NOTE: System Volume Information only includes Windows metadata, no actual user files")
+
+
+def _unmangle_folder(folder_path, dir_entries, file_entries, diagnostic_mode_enable=False):
+    crumb_names = list()
+    for entry in file_entries:
+        sub_name = entry.name
+        if sub_name[:2] == "._" and len(sub_name) > 2:
+            crumb_names.append(sub_name[2:])
+    if len(crumb_names) < 1:
+        return
+    crumb_index = index_crumbs(crumb_names)
+    for entry in dir_entries + file_entries:
+        sub_name = entry.name
+        sub_path = entry.path
+        if sub_name[:1] != ".":
+            if sub_name[:1] == "_":
+                good_index = index_of_nonmangled(crumb_names, sub_name,
+                                                 crumb_index=crumb_index)
+                if good_index >= 0:
+                    good_name = crumb_names[good_index]
+                    if good_name != sub_name:
+                        repaired_path = os.path.join(folder_path, good_name)
+                        if not os.path.exists(repaired_path):
+                            if not diagnostic_mode_enable:
+                                try:
+                                    shutil.move(sub_path, repaired_path)
+                                    cmd_string = "mv \"" + sub_path + "\" \"" + repaired_path + "\""
+                                except:
+                                    cmd_string = "#could_not_finish_mv \"" + sub_path + "\" \"" + repaired_path + "\""
+                                print(cmd_string)
+                        else:
+                            # if diagnostic_mode_enable:
+                            print("#mv_not_overwriting \"" + sub_path + "\" \"" + repaired_path + "\"")
 
 
 def _unmangle_recursively(folder_path, diagnostic_mode_enable=False):
-    try:
-        if os.path.isdir(folder_path):
-            crumb_names = list()
-            subs = os.listdir(folder_path)
-            # do deepest FIRST to avoid cache of old name being used wrongly:
-            for sub_name in subs:
-                sub_path = os.path.join(folder_path, sub_name)
-                if sub_name[:1] != "." and os.path.isdir(sub_path):
-                    _unmangle_recursively(sub_path, diagnostic_mode_enable=diagnostic_mode_enable)
-            # print("#found " + str(len(subs)) + " directories in \"" + folder_path + "\"")
-            for sub_name in subs:
-                sub_path = os.path.join(folder_path, sub_name)
-                if sub_name[:2] == "._" and os.path.isfile(sub_path) and len(sub_name) > 2:
-                    crumb_names.append(sub_name[2:])
-            for sub_name in subs:
-                sub_path = os.path.join(folder_path, sub_name)
-                if sub_name[:1] != ".":
-                    if sub_name[:1] == "_":
-                        good_index = index_of_nonmangled(crumb_names, sub_name)
-                        if good_index >= 0:
-                            good_name = crumb_names[good_index]
-                            if good_name != sub_name:
-                                repaired_path = os.path.join(folder_path, good_name)
-                                if not os.path.exists(repaired_path):
-                                    if not diagnostic_mode_enable:
-                                        try:
-                                            shutil.move(sub_path, repaired_path)
-                                            cmd_string = "mv \"" + sub_path + "\" \"" + repaired_path + "\""
-                                        except:
-                                            cmd_string = "#could_not_finish_mv \"" + sub_path + "\" \"" + repaired_path + "\""
-                                        print(cmd_string)
-                                else:
-                                    # if diagnostic_mode_enable:
-                                    print("#mv_not_overwriting \"" + sub_path + "\" \"" + repaired_path + "\"")
-        else:
-            print("#not_a_directory:\""+folder_path+"\"")
-    except:
-        print("#skipped_inaccessible:\"" + folder_path + "\"")
-        if "system volume information" in folder_path.lower():
-            print("#NOTE: System Volume Information only includes Windows metadata, no actual user files")
+    if not os.path.isdir(folder_path):
+        print("#not_a_directory:\""+folder_path+"\"")
+        return
+    # do deepest FIRST to avoid cache of old name being used wrongly:
+    for sub_folder_path, depth, dir_entries, file_entries in \
+            walkEntries(folder_path, skipDotDirs=True, topDown=False,
+                        onError=_print_skipped):
+        try:
+            _unmangle_folder(sub_folder_path, dir_entries, file_entries,
+                             diagnostic_mode_enable=diagnostic_mode_enable)
+        except:
+            _print_skipped(sub_folder_path)
 
 def unmangle(folder_path, diagnostic_mode_enable=False):
     print("#Starting postrecoveryrenamer.py...")
@@ -2,8 +2,9 @@
 
 import sys
 import os
-import shutil
-import filecmp
+import time
+import collections
+import multiprocessing
 # import md5
 
 try:
@@ -14,13 +15,61 @@ except ImportError:
 
 from moremeta import isThumbnailSize
 from moremeta import neatMetaTags
+from moremeta import collectSimilarTags
+from moremeta import flushSimilarNames
 from moremeta import replaceMany
 from moremeta import cleanFileName
 from moremeta import withExt
 from moremeta import getCategoryByExt
+from moremeta import getCategoryByExtUsingPath
+from moremeta import sniffExt
+from moremeta import getImageSize
+from dedupe import findDuplicateGroups
+from dedupe import iterSizedFiles
+from dedupe import newHasher
+from audiohash import findAudioDuplicateGroups
+from treewalk import walkEntries
+from asyncscan import mapFilesInOrder
+from similarimages import dHash
+from similarimages import findNearDuplicateClusters
+import transfer
 
 def usage():
-    print(sys.argv[0] + " <photorec result directory with recup_dir.*> <profile>")
+    print(sys.argv[0] + " <photorec result directory with recup_dir.*> <profile> [options]")
+    print(sys.argv[0] + " <profile> --phase=<cleanup phase> [options]")
+    print(sys.argv[0] + " --merge <profile> <staging profile> [...] [options]")
+    print("")
+    print("options:")
+    print("--nocleanup          Only sort (skip removing blanks and duplicates).")
+    print("--nodedupe           Do not remove files with identical content.")
+    print("--noaudiodedupe      Do not remove smaller songs with the same audio.")
+    print("--nonearduplicates   Do not move near-duplicate images.")
+    print("--jobs=<count>       Read tags and image sizes in <count> processes.")
+    print("--async=<count>      Stat and read files in <count> threads at once")
+    print("                     (for network shares and slow USB bridges).")
+    print("--nocache            Do not use or update the scan cache (<profile>/"
+          + stateDirName + ").")
+    print("--plan=<file>        Only write the moves and removals of the sort to")
+    print("                     <file> (apply it with applyplan.py).")
+    print("--dry-run            Only show the moves and removals of the sort.")
+    print("--verify             Read each file copied to another disk back from")
+    print("                     the disk and compare it to the original before")
+    print("                     removing the original (to copy several files")
+    print("                     at once, use --plan then applyplan.py")
+    print("                     --streams=<count>).")
+    print("--metrics=<file>     Append counts and timings to <file> as JSON")
+    print("                     lines (every minute and at the end).")
+    print("--noprogress         Do not pre-scan for progress and ETA lines.")
+    print("--resume             Continue the run that was stopped, skipping the")
+    print("                     folders, files and phases it finished (see")
+    print("                     <profile>/" + stateDirName + "/checkpoint.json).")
+    print("--phase=<name>       Only run one phase: sort, dedupe, audio, blanks,")
+    print("                     near, or cleanup (all but sort).")
+    print("--shard=<i>/<n>      Only sort shard <i> (0 to <n>-1) of <n> of the")
+    print("                     recup_dir.* folders, into a staging profile")
+    print("                     (skips the cleanup; see --merge).")
+    print("--merge              Move the files of staging profiles (from")
+    print("                     --shard) into <profile> instead of sorting.")
 
 
 def customDie(msg):
@@ -34,30 +83,71 @@ def customDie(msg):
 
 
 enableShowLarge = False
+# Images with more pixels are moved to Pictures/unusable by removeExtra
+# instead of being decoded (an RGBA copy takes 4 bytes per pixel).
+maxDecodePixels = 64 * 1000 * 1000
+draftScale = 8  # decode JPEGs at 1/draftScale size to check for blanks
+enableProgress = True  # pre-scan and show progress with an ETA
 largeSize = 1024000
-maxComparisonSize = 2 * 1024 * 1024
 
 catDirNames = {}
 
 from moremeta import knownThumbnailSizes
+from moremeta import stateDirName
+from scancache import statKey
+from scancache import cachedFact
+from scancache import getCached
+from scancache import putCached
+from scancache import openScanCache
+from scancache import closeScanCache
+from scancache import forgetInheritedCache
+from moveplan import moveFile
+from moveplan import removeFile
+from moveplan import fileExists
+from moveplan import pathExists
+from moveplan import getFileSize
+from moveplan import startPlan
+from moveplan import finishPlan
+from metrics import count
+from metrics import observe
+from metrics import timed
+from metrics import timedIter
+from metrics import phase
+from metrics import takeMetrics
+from metrics import mergeMetrics
+from metrics import startMetrics
+from metrics import stopMetrics
+from progress import prescan
+from progress import Progress
+from checkpoint import openCheckpoint
+from shards import ShardFilter
+from shards import parseShard
+from shards import readManifest
+from shards import writeManifest
 
 # region make configurable
-enableNoExtIgnore = True  # if NO extension, ignore
+enableNoExtIgnore = True  # if NO extension (and sniffExt fails), ignore
+enableSniff = True  # check content if extension is missing or unknown
 ignoreMoreExts = ["zip", "gz", "html", "htm", "mmw", "php"]
 # for more info see derivedMetas
 
 clearRatioMax = 0.9
+defaultJobCount = 1  # worker processes for sortFiles (see --jobs)
+parallelChunkSize = 16  # files sent to a worker at a time
+maxNearDuplicateDistance = 4  # max differing bits of 64-bit dHash
+# in the order they run (see --phase)
+phaseNames = ["sort", "dedupe", "audio", "blanks", "near"]
 # endregion make configurable
 
 
-ignoreExts = [ "ani", "api", "asp", "ax", "bat", "cnv", "cp_", "cpl",
+ignoreExts = set([ "ani", "api", "asp", "ax", "bat", "cnv", "cp_", "cpl",
                "class", "dat", "db", "dll", "cab", "chm", "edb", "elf", "emf", "exe", "f",
                "h", "icc", "ime", "ini", "jar", "java", "js", "jsp", "lib", "loc",
                "mui", "ocx", "olb", "reg", "rll", "sam", "scr", "sports", "sqm", "swc", "sys",
                "sys_place_holder_for_2k_and_xp_(see_pxhelp)",
-               "tlb", "ttf", "vdm", "woff", "xml"]
+               "tlb", "ttf", "vdm", "woff", "xml"])
 for thisExt in ignoreMoreExts:
-    ignoreExts.append(thisExt)
+    ignoreExts.add(thisExt)
 ignore = ["user", "nohup.out"]
 
 
@@ -105,7 +195,7 @@ catDirNames["Torrents"] = os.path.join(catDirNames["Downloads"], "torrents")
 catDirNames["Videos"] = "Videos"
 
 # Do not recurse into doneNames
-doneNames = ["blank", "duplicates", "thumbnails", "unusable"]
+doneNames = ["blank", "duplicates", "thumbnails", "unusable", stateDirName]
 
 go = True
 
@@ -125,263 +215,1110 @@ def sortedBySize(parent, subs):
         ret.append(sub)
     return ret
 
-def removeExtra(folderPath, profilePath, relPath="", depth=0):
+def getBlankStats(rgbIm):
+    """
+    Get (clearRatio, isSameColor) for an RGBA image without visiting each
+    pixel in Python, where clearRatio is the portion of pixels with an
+    alpha below 128, and isSameColor is True if every pixel is the same
+    color (any fully transparent pixel counts as (0, 0, 0, 0)).
+    """
+    width, height = rgbIm.size
+    pixCount = width * height
+    if pixCount < 1:
+        return (1.0, True)
+    alphaHist = rgbIm.getchannel('A').histogram()
+    clearRatio = float(sum(alphaHist[:128])) / float(pixCount)
+    invisibleCount = alphaHist[0]
+    if invisibleCount == pixCount:
+        # all pixels normalize to (0, 0, 0, 0)
+        return (clearRatio, True)
+    if invisibleCount > 0:
+        # a normalized invisible pixel differs from any visible one
+        return (clearRatio, False)
+    for low, high in rgbIm.getextrema():
+        if low != high:
+            return (clearRatio, False)
+    return (clearRatio, True)
+
+
+def isBlankStats(blankStats):
+    """
+    Check whether the result of getBlankStats is blank: the image is
+    blank if every pixel is the same color or if more than clearRatioMax
+    of the pixels are mostly transparent.
+    """
+    clearRatio, isSameColor = blankStats
+    return isSameColor or (clearRatio > clearRatioMax)
+
+
+def getBlankFrameStats(im, rgbIm=None):
+    """
+    Get a list of getBlankStats results for the frames of im (more than
+    one for a multi-frame image such as an animated GIF). The list stops
+    after a frame that is not blank regardless of clearRatioMax.
+    Provide rgbIm if the current frame was already converted to RGBA.
+    """
+    if rgbIm is None:
+        rgbIm = im.convert('RGBA')
+    blankStats = getBlankStats(rgbIm)
+    ret = [blankStats]
+    frameCount = getattr(im, "n_frames", 1)
+    if (frameCount > 1) and (blankStats[0] > 0 or blankStats[1]):
+        for frameI in range(1, frameCount):
+            im.seek(frameI)
+            frameIm = im.convert('RGBA')
+            blankStats = getBlankStats(frameIm)
+            frameIm.close()
+            ret.append(blankStats)
+            if (blankStats[0] == 0) and (not blankStats[1]):
+                break
+        im.seek(0)
+    return ret
+
+
+def getPixelDigest(rgbIm):
+    """
+    Hash the decoded pixels of an RGBA image along with its mode and
+    size, so that the same picture gets the same digest regardless of
+    file format or compression.
+    """
+    hasher = newHasher()
+    hasher.update("{} {}x{}\n".format(rgbIm.mode, rgbIm.size[0],
+                                       rgbIm.size[1]).encode('ascii'))
+    hasher.update(rgbIm.tobytes())
+    return hasher.hexdigest()
+
+
+def getPixelDigestOfPath(path):
+    """
+    Decode the image at path at full resolution and get its
+    getPixelDigest result.
+    """
+    count("bytes.read", os.path.getsize(path))
+    im = Image.open(path)
+    try:
+        rgbIm = im.convert('RGBA')
+        ret = getPixelDigest(rgbIm)
+        rgbIm.close()
+    finally:
+        im.close()
+    return ret
+
+
+def getBoundedBlankFrameStats(path):
+    """
+    Get getBlankFrameStats for the image at path, decoding a JPEG at a
+    reduced scale first (see draftScale). Only if the reduced image
+    looks blank is it decoded again at full resolution to be sure.
+    """
+    count("bytes.read", os.path.getsize(path))
+    im = Image.open(path)
+    try:
+        print("# checking pixels in " + '{0:.2g}'.format(os.path.getsize(path)/1024/1024) + " MB '" + path + "'...")
+        if (im.format == "JPEG") and (draftScale > 1):
+            width, height = im.size
+            # (PIL's draft fails if asked for a size of 0)
+            im.draft('RGB', (max(1, width // draftScale),
+                             max(1, height // draftScale)))
+            frameStats = getBlankFrameStats(im)
+            for blankStats in frameStats:
+                if not isBlankStats(blankStats):
+                    return frameStats
+            im.close()
+            im = Image.open(path)
+        return getBlankFrameStats(im)
+    finally:
+        im.close()
+
+
+def getDraftDigestOfPath(path):
+    """
+    Get getPixelDigest of a JPEG decoded at 1/draftScale size (see
+    getBoundedBlankFrameStats), or None if the image at path is not a
+    JPEG. JPEGs with the same pixels have the same draft digest, since
+    the reduced image is decoded from the same coefficients.
+    """
+    im = Image.open(path)
+    try:
+        if im.format != "JPEG":
+            return None
+        width, height = im.size
+        im.draft('RGB', (max(1, width // draftScale),
+                         max(1, height // draftScale)))
+        rgbIm = im.convert('RGBA')
+        ret = getPixelDigest(rgbIm)
+        rgbIm.close()
+    finally:
+        im.close()
+    return ret
+
+
+class SameSizeImages:
+    """
+    The images of one size that findSamePixels has seen, by
+    getPixelDigest result. Decoding at full size is put off until it is
+    needed: the first image is not decoded at all until another image of
+    the same size is found, and a JPEG is only decoded at full size if
+    another JPEG has the same draft digest (see getDraftDigestOfPath) or
+    an image in another format has the same size. Recovered photos from
+    one camera all have the same size, so this saves most of the work.
+    """
+    def __init__(self, path):
+        self.firstPath = path  # not checked at all yet
+        # draft digest (None if not a JPEG) -> the only image with it,
+        # which was not decoded at full size
+        self.pending = {}
+        self.digests = {}  # getPixelDigest result -> path
+        self.digestedKeys = set()  # draft digests of images in digests
+        self.hasJpeg = False
+        self.hasOther = False
+
+    def _digest(self, path, st=None):
+        """
+        Add the image at path to digests, and get the path that has its
+        pixels (path itself if it is the first).
+        """
+        pixelDigest = cachedFact(path, "pixelDigest",
+                                 lambda: getPixelDigestOfPath(path), st=st)
+        return self.digests.setdefault(pixelDigest, path)
+
+    def _digestPending(self, draftKey):
+        otherPath = self.pending.pop(draftKey)
+        self.digestedKeys.add(draftKey)
+        try:
+            self._digest(otherPath)
+        except (OSError, Image.DecompressionBombError):
+            pass
+
+    def _add(self, path, draftKey):
+        """
+        Add an image to pending if nothing else can have its pixels, or
+        get True if it has to be decoded at full size to check.
+        """
+        isJpeg = draftKey is not None
+        if (isJpeg and self.hasOther) or ((not isJpeg) and self.hasJpeg):
+            # Another format can't be compared by draft digest.
+            for otherKey in list(self.pending.keys()):
+                self._digestPending(otherKey)
+            self.hasJpeg = True
+            self.hasOther = True
+        elif isJpeg:
+            self.hasJpeg = True
+        else:
+            self.hasOther = True
+        if self.hasJpeg and self.hasOther:
+            self.digestedKeys.add(draftKey)
+            return True
+        if draftKey in self.digestedKeys:
+            return True
+        if draftKey in self.pending:
+            self._digestPending(draftKey)
+            return True
+        self.pending[draftKey] = path
+        return False
+
+    def _getDraftKey(self, path, st=None):
+        with timed("draftDigest"):
+            return cachedFact(path, "draftDigest",
+                              lambda: getDraftDigestOfPath(path), st=st)
+
+    def find(self, path, st=None):
+        """
+        Get the path of an image seen before that has the same pixels as
+        the image at path, or None (then path is added).
+        """
+        if self.firstPath is not None:
+            firstPath = self.firstPath
+            self.firstPath = None
+            try:
+                if self._add(firstPath, self._getDraftKey(firstPath)):
+                    self._digest(firstPath)
+            except (OSError, Image.DecompressionBombError):
+                pass
+        if not self._add(path, self._getDraftKey(path, st=st)):
+            return None
+        keptPath = self._digest(path, st=st)
+        if keptPath == path:
+            return None
+        return keptPath
+
+    def rename(self, oldPath, newPath):
+        if self.firstPath == oldPath:
+            self.firstPath = newPath
+        for mapping in (self.pending, self.digests):
+            for key, path in mapping.items():
+                if path == oldPath:
+                    mapping[key] = newPath
+
+
+def findSamePixels(pixelIndex, path, imSize, st=None):
+    """
+    Get the path of an image in pixelIndex that has the same pixels as
+    the image at path, or None (then path is added to pixelIndex).
+
+    pixelIndex is a dict of image size -> SameSizeImages, since only
+    images of the same size can have the same pixels.
+    """
+    sameSize = pixelIndex.get(imSize)
+    if sameSize is None:
+        pixelIndex[imSize] = SameSizeImages(path)
+        return None
+    return sameSize.find(path, st=st)
+
+
+def isSetAside(path):
+    for part in path.split(os.sep):
+        if part in doneNames:
+            return True
+    return False
+
+
+def removeDuplicates(profilePath, enableRemove=True):
+    """
+    Remove files whose content is identical to another file anywhere in
+    the profile (see dedupe.findDuplicateGroups). The copy kept is one
+    that is not in a doneNames directory if possible, otherwise the one
+    with the shortest path.
+
+    Returns a tuple of the number of duplicates and the number of bytes
+    they occupy (the space that is or can be reclaimed).
+    """
+    print("# checking for duplicates in: " + profilePath)
+    stats = {}
+    dupCount = 0
+    dupBytes = 0
+    sizedPaths = iterSizedFiles(profilePath, skipNames=[stateDirName])
+    groups = findDuplicateGroups(sizedPaths, stats=stats)
+    for group in groups:
+        group.sort(key=lambda path: (isSetAside(path), len(path), path))
+        keepPath = group[0]
+        fileSize = os.path.getsize(keepPath)
+        for dupPath in group[1:]:
+            dupCount += 1
+            dupBytes += fileSize
+            print("#dup of '" + keepPath + "':")
+            print("rm '" + dupPath + "'")
+            if enableRemove:
+                removeFile(dupPath)
+    print("# duplicates: " + str(dupCount) + " ("
+          + '{0:.3g}'.format(dupBytes/1024/1024) + " MB reclaimable,"
+          + " read " + '{0:.3g}'.format(stats.get('bytesRead', 0)/1024/1024)
+          + " MB to find them)")
+    return dupCount, dupBytes
+
+
+def removeAudioDuplicates(profilePath, enableRemove=True):
+    """
+    Remove songs in the Music folder of the profile that have the same
+    audio as another song there, even if their tags or trailing junk
+    differ (see audiohash.findAudioDuplicateGroups). The copy with the
+    most audio payload is kept, then the one with the most tag data,
+    then the larger one.
+
+    Returns a tuple of the number of duplicates and the number of bytes
+    they occupy.
+    """
+    musicPath = os.path.join(profilePath, catDirNames["Music"])
+    print("# checking for duplicate audio in: " + musicPath)
+    dupCount = 0
+    dupBytes = 0
+    if not os.path.isdir(musicPath):
+        return dupCount, dupBytes
+    sizeByPath = {}
+    for path, fileSize in iterSizedFiles(musicPath,
+                                         skipNames=[stateDirName]):
+        sizeByPath[path] = fileSize
+    for group in findAudioDuplicateGroups(sizeByPath.keys()):
+        group.sort(key=lambda item: (-item[2], -item[1],
+                                     -sizeByPath[item[0]],
+                                     isSetAside(item[0]), len(item[0]),
+                                     item[0]))
+        keepPath = group[0][0]
+        for dupPath, tagByteCount, payloadByteCount in group[1:]:
+            dupCount += 1
+            dupBytes += sizeByPath[dupPath]
+            print("#same audio as '" + keepPath + "':")
+            print("rm '" + dupPath + "'")
+            if enableRemove:
+                removeFile(dupPath)
+    print("# duplicate audio: " + str(dupCount) + " ("
+          + '{0:.3g}'.format(dupBytes/1024/1024) + " MB reclaimable)")
+    return dupCount, dupBytes
+
+
+def getFreeName(folderPath, name):
+    """
+    Get name, or name with " [n]" before the extension if name is taken.
+    """
+    newPath = os.path.join(folderPath, name)
+    namePartial, dotExt = os.path.splitext(name)
+    tryNum = 0
+    while pathExists(newPath):
+        tryNum += 1
+        newPath = os.path.join(folderPath, namePartial + " [" + str(tryNum) + "]" + dotExt)
+    return os.path.basename(newPath)
+
+
+def moveNearDuplicates(profilePath, maxDistance=None):
+    """
+    Move images that look the same as a larger image (by perceptual
+    hash, see similarimages) into Pictures/duplicates. The image with
+    the most pixels (then the largest file) in each cluster stays.
+
+    Returns the number of images moved.
+    """
+    if maxDistance is None:
+        maxDistance = maxNearDuplicateDistance
+    picturesPath = os.path.join(profilePath, catDirNames["Pictures"])
+    if not os.path.isdir(picturesPath):
+        return 0
+    dupsPath = os.path.join(picturesPath, "duplicates")
+    print("# checking for near-duplicate images in: " + picturesPath)
+    itemHashes = []
+    for subPath, fileSize in iterSizedFiles(picturesPath, skipNames=doneNames):
+        if getCategoryByExtUsingPath(subPath) != "Pictures":
+            continue
+        try:
+            im = Image.open(subPath)
+            try:
+                width, height = im.size
+                if width * height > maxDecodePixels:
+                    # too large to decode (see removeExtraInFolder)
+                    continue
+                hashValue = dHash(im)
+            finally:
+                im.close()
+        except (OSError, Image.DecompressionBombError):
+            continue
+        if hashValue == 0:
+            # no detail (such as a solid or smooth image), so not useful
+            continue
+        itemHashes.append(((width * height, fileSize, subPath), hashValue))
+    movedCount = 0
+    clusters = findNearDuplicateClusters(
+        itemHashes, maxDistance,
+        key=lambda info: (-info[0], -info[1], info[2])
+    )
+    for cluster in clusters:
+        keepPath = cluster[0][2]
+        for pixCount, fileSize, subPath in cluster[1:]:
+            newPath = os.path.join(dupsPath, getFreeName(dupsPath, os.path.basename(subPath)))
+            print("#near dup of '" + keepPath + "':")
+            print("mv '" + subPath + "' '" + newPath + "'")
+            moveFile(subPath, newPath)
+            movedCount += 1
+    return movedCount
+
+
+def indexKeptImages(pixelIndex, fileEntries):
+    """
+    Add the images in fileEntries that removeExtra already kept (in a
+    run that is being resumed) to pixelIndex, so that later copies of
+    them are still found. The image sizes and pixel digests normally
+    come from the scan cache.
+    """
+    for entry in fileEntries:
+        if getCategoryByExtUsingPath(entry.path) != "Pictures":
+            continue
+        try:
+            imSize = cachedFact(entry.path, "imSize",
+                                lambda: getImageSize(entry.path),
+                                st=entry.stat())
+            if imSize is None:
+                continue
+            imSize = tuple(imSize)
+            if imSize[0] * imSize[1] > maxDecodePixels:
+                continue
+            findSamePixels(pixelIndex, entry.path, imSize, st=entry.stat())
+        except (OSError, Image.DecompressionBombError):
+            pass
+
+
+def removeExtra(folderPath, profilePath, relPath="", depth=0, state=None):
+    """
+    Check each folder in folderPath using removeExtraInFolder.
+
+    Keyword arguments:
+    state -- a checkpoint.PassState to record each file that is done in
+             (files that a resumed run already finished are skipped)
+    """
+    # images kept so far in any folder, by size (see findSamePixels)
+    pixelIndex = {}
+    progress = None
+    if enableProgress:
+        progress = Progress(
+            "blanks",
+            prescan(folderPath, getCategoryByExtUsingPath,
+                    skipNames=doneNames,
+                    skipFilesOf=None if state is None else state.isFolderDone)
+        )
+    for subFolderPath, subDepth, dirEntries, fileEntries in \
+            walkEntries(folderPath, skipNames=doneNames):
+        if state is not None:
+            selected = state.selectFiles(subFolderPath, fileEntries)
+            if len(selected) < len(fileEntries):
+                selectedNames = set(entry.name for entry in selected)
+                indexKeptImages(pixelIndex, [
+                    entry for entry in fileEntries
+                    if entry.name not in selectedNames
+                ])
+            fileEntries = selected
+        removeExtraInFolder(subFolderPath, fileEntries, profilePath,
+                            pixelIndex=pixelIndex, progress=progress,
+                            state=state)
+    if progress is not None:
+        progress.finish()
+
+
+def removeExtraInFolder(folderPath, fileEntries, profilePath,
+                        pixelIndex=None, progress=None, state=None):
+    """
+    Move blank files in one folder to Backup/blank and remove images
+    that have the same pixels as an image already in pixelIndex (see
+    findSamePixels, which updates it). Images with more than
+    maxDecodePixels pixels are moved to Pictures/unusable unchecked.
+
+    Keyword arguments:
+    progress -- a progress.Progress to advance for each file
+    state -- a checkpoint.PassState to record each file that is done in
+    """
+    if pixelIndex is None:
+        pixelIndex = {}
     backupPath = os.path.join(profilePath, "Backup")
+    unusablePath = os.path.join(profilePath, catDirNames["Pictures"],
+                                "unusable")
     print("# checking for blanks in: " + folderPath)
-    prevIm = None
-    prevSize = None
-    prevDestPath = None
     parentName = os.path.basename(folderPath)
 
-    for subName in sortedBySize(folderPath, os.listdir(folderPath)):
-        subPath = os.path.join(folderPath, subName)
-        subRelPath = subName
-        if len(subName) > 0:
-            subRelPath = os.path.join(relPath, subName)
-        if os.path.isfile(subPath):
-            ext = os.path.splitext(subPath)[1]
-            if len(ext) > 1:
-                ext = ext[1:]  # remove dot
-            lowerExt = ext.lower()
-            enableIgnore = False
-            newName = subName
-            newParentPath = folderPath
-            newPath = subPath
-            isBlank = False
-            subCatName = None
-            isDup = False
-            fileSize = os.path.getsize(subPath)
-            category = getCategoryByExt(lowerExt)
+    for entry in sorted(fileEntries, key=lambda e: e.stat().st_size):
+        subName = entry.name
+        subPath = entry.path
+        ext = os.path.splitext(subPath)[1]
+        if len(ext) > 1:
+            ext = ext[1:]  # remove dot
+        lowerExt = ext.lower()
+        enableIgnore = False
+        newName = subName
+        newParentPath = folderPath
+        newPath = subPath
+        isBlank = False
+        subCatName = None
+        isDup = False
+        isUnusable = False
+        imSize = None
+        fileSize = entry.stat().st_size
+        category = getCategoryByExt(lowerExt)
 
-            if category == "Pictures":
-                # print("# checking if blank: " + subPath)
-                try:
-                    im = Image.open(subPath)
-                    width, height = im.size
-                    pixCount = width * height
-                    rgbIm = im.convert('RGBA')
-                    # convert, otherwise GIF will yield single value
-                    lastColor = None
+        if category == "Pictures":
+            # print("# checking if blank: " + subPath)
+            try:
+                imSize = cachedFact(subPath, "imSize",
+                                    lambda: getImageSize(subPath),
+                                    st=entry.stat())
+                if imSize is not None:
+                    imSize = tuple(imSize)
+                    if imSize[0] * imSize[1] > maxDecodePixels:
+                        isUnusable = True
+                if (imSize is not None) and not isUnusable:
+                    with timed("blankCheck"):
+                        frameStats = cachedFact(
+                            subPath, "blankStats",
+                            lambda: getBoundedBlankFrameStats(subPath),
+                            st=entry.stat()
+                        )
                     isBlank = True
-                    clearCount = 0
-                    print("# checking pixels in " + '{0:.2g}'.format(fileSize/1024/1024) + " MB '" + subPath + "'...")
-                    for y in range(height):
-                        for x in range(width):
-                            thisColor = rgbIm.getpixel((x, y))
-                            if thisColor[3] == 0:
-                                thisColor = (0, 0, 0, 0)
-                            if thisColor[3] < 128:
-                                clearCount += 1
-                            if (lastColor is not None) and (lastColor != thisColor):
-                                isBlank = False
-                                break
-                            lastColor = thisColor
-                    if (float(clearCount) / float(pixCount)) > clearRatioMax:
-                        isBlank = True
+                    for blankStats in frameStats:
+                        if not isBlankStats(blankStats):
+                            isBlank = False
+                            break
                     if not isBlank:
-                        #try:
-                        if prevIm is not None:
-                            prevW, prevH = prevIm.size
-                            if prevIm.size == im.size:
-                                isDup = True
-                                # print("# comparing pixels in '" + subPath + "'...")
-                                for y in range(height):
-                                    for x in range(width):
-                                        if rgbIm.getpixel((x, y)) != prevIm.getpixel((x, y)):
-                                            isDup = False
-                                            break
-                            prevIm.close()
-                        # except:
-                            # isDup = False
-                    prevIm = rgbIm
-                except OSError:
-                    # isBlank = True
-                    # such as "Unsupported BMP header type (0)"
-                    # but it could be an SVG, PSD, or other good file!
-                    pass
-                try:
-                    if im is not None:
-                        im.close()
-                except:
-                    pass
-            else:
-                validMinFileSize = validMinFileSizes.get(category)
-                normalMinFileSize = normalMinFileSizes.get(category)
-                if validMinFileSize is not None:
-                    if fileSize < validMinFileSize:
-                        isBlank = True
-                if normalMinFileSize is not None:
-                    if fileSize < normalMinFileSize:
-                        subCatName = "small"
-                if (prevSize is not None) and (fileSize == prevSize) \
-                        and (fileSize <= maxComparisonSize) \
-                        and (prevDestPath is not None):
-                    print("# comparing bytes to " + '{0:.2g}'.format(fileSize/1024/1024) + " MB '" + prevDestPath + "'...")
-                    if (filecmp.cmp(prevDestPath, subPath)):
-                        isDup = True
-            # else:
-                # if lowerExt not in uniqueCheckExt:
-                    # print("# not checking if blank: " + subPath)
-                    # uniqueCheckExt.append(lowerExt)
-            newName = cleanFileName(newName)
-
-            if isDup:
-                print("#dup:")
-                print("rm '" + subPath + "'")
-                os.remove(subPath)  # do not set previous if removing
-                continue
+                        with timed("dupCheck"):
+                            keptPath = findSamePixels(pixelIndex, subPath,
+                                                      imSize, st=entry.stat())
+                        isDup = keptPath is not None
+            except Image.DecompressionBombError:
+                isUnusable = True
+            except OSError:
+                # isBlank = True
+                # such as "Unsupported BMP header type (0)"
+                # but it could be an SVG, PSD, or other good file!
+                pass
+        else:
+            validMinFileSize = validMinFileSizes.get(category)
+            normalMinFileSize = normalMinFileSizes.get(category)
+            if validMinFileSize is not None:
+                if fileSize < validMinFileSize:
+                    isBlank = True
+            if normalMinFileSize is not None:
+                if fileSize < normalMinFileSize:
+                    subCatName = "small"
+        # else:
+            # if lowerExt not in uniqueCheckExt:
+                # print("# not checking if blank: " + subPath)
+                # uniqueCheckExt.append(lowerExt)
+        newName = cleanFileName(newName)
+
+        if isDup:
+            print("#dup of '" + keptPath + "':")
+            print("rm '" + subPath + "'")
+            removeFile(subPath)
+            if progress is not None:
+                progress.advance(category, fileSize)
+            if state is not None:
+                state.fileDone(subPath)
+                state.checkpoint.saveIfDue()
+            continue
+
+        if isUnusable:
+            print("# too many pixels to check (see maxDecodePixels): '"
+                  + subPath + "'")
+            newParentPath = unusablePath
+        elif isBlank:
+            newParentPath = os.path.join(backupPath, "blank")
+        elif subCatName is not None:
+            if subCatName != parentName:
+                newParentPath = os.path.join(newParentPath, subCatName)
+
+        newPath = os.path.join(newParentPath, newName)
 
-            if isBlank:
-                newParentPath = os.path.join(backupPath, "blank")
-            elif subCatName is not None:
-                if subCatName != parentName:
-                    newParentPath = os.path.join(newParentPath, subCatName)
+        if newPath != subPath:
+            moveFile(subPath, newPath)
+            sameSize = pixelIndex.get(imSize)
+            if sameSize is not None:
+                # renamed by cleanFileName, so find it by its new name
+                sameSize.rename(subPath, newPath)
+        if progress is not None:
+            progress.advance(category, fileSize)
+        if state is not None:
+            state.fileDone(subPath)
+            state.checkpoint.saveIfDue()
 
-            newPath = os.path.join(newParentPath, newName)
 
-            if newPath != subPath:
-                if not os.path.isdir(newParentPath):
-                    os.makedirs(newParentPath)
-                shutil.move(subPath, newPath)
-            prevSize = fileSize
-            prevDestPath = newPath
+def getSortStats():
+    """
+    Get the statistics that placeSortedFile collects (shown at the end
+    of a run) as a JSON-compatible dict, such as to save in a
+    checkpoint.
+    """
+    return {
+        'unknownTypes': list(unknownTypes),
+        'unknownPathExamples': list(unknownPathExamples),
+        'foundTypeCounts': dict(foundTypeCounts),
+        'foundMaximums': dict(foundMaximums),
+        'foundMaximumPaths': dict(foundMaximumPaths),
+    }
+
+
+def restoreSortStats(stats):
+    """
+    Add the statistics from getSortStats (such as from a checkpoint of
+    the run being resumed) to the ones collected so far.
+    """
+    for lowerExt, examplePath in zip(stats.get('unknownTypes', []),
+                                     stats.get('unknownPathExamples', [])):
+        if lowerExt not in unknownTypes:
+            unknownTypes.append(lowerExt)
+            unknownPathExamples.append(examplePath)
+    for lowerExt, typeCount in stats.get('foundTypeCounts', {}).items():
+        foundTypeCounts[lowerExt] = foundTypeCounts.get(lowerExt, 0) + typeCount
+    for category, fileSize in stats.get('foundMaximums', {}).items():
+        if (category not in foundMaximums) or \
+                (fileSize > foundMaximums[category]):
+            foundMaximums[category] = fileSize
+            foundMaximumPaths[category] = \
+                stats['foundMaximumPaths'][category]
+
+
+def getSortJob(subPath, st=None):
+    """
+    Get the cheap information that sortFiles needs about a file (name,
+    extension, size, category), or None if the file should be ignored.
+
+    Keyword arguments:
+    st -- the result of os.stat(subPath), if already known (such as
+          from os.DirEntry.stat)
+    """
+    subName = os.path.basename(subPath)
+    if subName in ignore:
+        return None
+    ext = os.path.splitext(subPath)[1]
+    if len(ext) > 1:
+        ext = ext[1:]  # remove dot
+    lowerExt = ext.lower()
+    if lowerExt in ignoreExts:
+        return None
+    newName = subName
+    category = getCategoryByExt(lowerExt)
+    if (category is None) and enableSniff:
+        # The extension is missing or unknown, so check the content.
+        sniffedExt = sniffExt(subPath)
+        if (sniffedExt is not None) and (sniffedExt in ignoreExts):
+            if len(lowerExt) == 0:
+                return None
+            # Such as an .epub or .apk (a zip), which is not ignored
+            # but goes to Backup/unknown under its own name.
+            sniffedExt = None
+        if sniffedExt is not None:
+            lowerExt = sniffedExt
+            newName = withExt(subName, sniffedExt)
+            category = getCategoryByExt(lowerExt)
+    if len(lowerExt) == 0:
+        if enableNoExtIgnore:
+            return None
+    if st is None:
+        st = os.stat(subPath)
+    job = {}
+    job['path'] = subPath
+    job['name'] = subName
+    job['newName'] = newName
+    job['lowerExt'] = lowerExt
+    job['fileSize'] = st.st_size
+    job['statKey'] = statKey(st)
+    job['category'] = category
+    return job
+
+
+def getFileFacts(job):
+    """
+    Read the file contents that sortFiles needs to place a file (tags of
+    music, dimensions of pictures). This is the slow part of sorting,
+    and it only reads, so it can run in a worker process.
+    """
+    facts = job.get('facts')
+    if facts is not None:
+        # from the scan cache (see loadCachedFacts)
+        return facts
+    facts = {}
+    category = job['category']
+    start = time.perf_counter()
+    if category == "Music":
+        facts['tags'] = neatMetaTags(job['path'], collectSimilar=False)
+    elif category == "Pictures":
+        facts['imSize'] = getImageSize(job['path'])
+    else:
+        return facts
+    # The caller records this, since this may run in a worker process.
+    facts['readSeconds'] = time.perf_counter() - start
+    return facts
+
+
+factNames = {
+    'Music': "tags",
+    'Pictures': "imSize",
+}
+# metrics histogram name for the time getFileFacts takes
+readTimingNames = {
+    'Music': "tagRead",
+    'Pictures': "imageSize",
+}
+
+
+def loadCachedFacts(job):
+    """
+    If the scan cache knows the facts about the job's file, store them
+    as job['facts'] so that getFileFacts does not read the file.
+    """
+    factName = factNames.get(job['category'])
+    if factName is None:
+        return
+    value = getCached(job['statKey'], factName, default=job)
+    if value is job:
+        return
+    if (factName == "imSize") and (value is not None):
+        value = tuple(value)
+    job['facts'] = {factName: value}
+
+
+def saveFacts(job, facts):
+    if 'facts' in job:
+        count("cacheHits")
+        return
+    readSeconds = facts.get('readSeconds')
+    if readSeconds is not None:
+        observe(readTimingNames[job['category']], readSeconds)
+    factName = factNames.get(job['category'])
+    if factName is not None:
+        putCached(job['statKey'], factName, facts[factName])
+
+
+def moveKeepingLarger(subPath, newPath, fileSize):
+    """
+    Move subPath to newPath unless a file at least as large is already
+    there (a smaller one is removed first). Get True if it was moved.
+    """
+    if fileExists(newPath):
+        if fileSize <= getFileSize(newPath):
+            count("files.notLarger")
+            return False
+        elif fileSize > getFileSize(newPath):
+            print("# removing smaller '" + newPath + "' and keeping '" + subPath + "'")
+            count("files.replacedSmaller")
+            removeFile(newPath)
+    moveFile(subPath, newPath)
+    count("files.moved")
+    count("bytes.moved", fileSize)
+    return True
+
+
+def placeSortedFile(job, facts, profilePath, depth=0, enablePrint=False):
+    """
+    Move a file into the profile using the information from getSortJob
+    and getFileFacts. If a file with the new name is already there, keep
+    whichever is larger.
+    """
+    subPath = job['path']
+    subName = job['name']
+    lowerExt = job['lowerExt']
+    fileSize = job['fileSize']
+    category = job['category']
+    newName = job['newName']
+    if category is None:
+        category = "Backup"
+        if lowerExt not in unknownTypes:
+            unknownTypes.append(lowerExt)
+            unknownPathExamples.append(subPath)
+        # continue
+        catMajorPath = os.path.join(profilePath, catDirNames[category])
+        catMajorPath = os.path.join(catMajorPath, "unknown")
+    else:
+        catMajorPath = os.path.join(profilePath, catDirNames[category])
+    if category == "Music":
+        # print('This track is by %s.' % tag.artist)
+        # print("  " * depth + subPath + ": " + str(tag))
+        catPath = catMajorPath
+        newStats = collectSimilarTags(facts['tags'])
+        newName = newStats.get("SuggestedFileName")
+        if (newName is not None) and (job['newName'] != subName):
+            # The extension was added by getSortJob (see sniffExt), so
+            # replace the original one that the tags name has.
+            oldDotExt = os.path.splitext(subName)[1]
+            if (len(oldDotExt) > 0) and newName.endswith(oldDotExt):
+                newName = newName[:-len(oldDotExt)]
+            newName = withExt(newName, lowerExt)
+        artist = newStats.get("Artist")
+        album = newStats.get("Album")
+        # if artist == "unknown":
+            # debug only arst
+            # print("unknown artist in " + str(newStats))
+            # exit(1)
+        if newName is None:
+            newName = job['newName']
+        if (artist is not None) and (album is not None):
+            catPath = os.path.join(
+                os.path.join(catMajorPath, artist),
+                album
+            )
         else:
-            if subName not in doneNames:
-                removeExtra(subPath, profilePath, relPath=subRelPath, depth=depth+1)
+            catPath = os.path.join(catMajorPath, "misc")
+    elif category == "Pictures":
+        imSize = facts['imSize']
+        if imSize is None:
+            catPath = os.path.join(catMajorPath, "unusable")
+        elif (isThumbnailSize(imSize)):
+            catPath = os.path.join(catMajorPath, "thumbnails")
+        else:
+            catPath = catMajorPath
+    else:
+        catPath = catMajorPath
+        validMinFileSize = validMinFileSizes.get(category)
+        if validMinFileSize is not None:
+            if fileSize < validMinFileSize:
+                catPath = os.path.join(catMajorPath, "thumbnails")
+    # if category == "Music":
+        # if lowerExt == "wma":
+    # print("ensuring dir: " + catPath)
+    newPath = os.path.join(catPath, newName)
+    # if enablePrint:
+        # print("# moving to '" + newPath + "'")
+    count("category." + category + ".files")
+    count("category." + category + ".bytes", fileSize)
+    count("ext." + lowerExt + ".files")
+    # while os.path.isfile(newPath):
+        # tryNum += 1
+        # newPath = os.path.join(catPath, newNamePartial + " [" + str(tryNum) + "]")
+        # newPath = withExt(newPath, ext)
+    if not moveKeepingLarger(subPath, newPath, fileSize):
+        return
+    if enablePrint:
+        print("mv '" + newPath+ "' '" + newPath + "'")
 
-def sortFiles(preRecoveredPath, profilePath, relPath="", depth=0, enablePrint=False):
-    # preRecoveredPath becomes a subdirectory upon recursion
-    global catDirNames
-    if os.path.isdir(preRecoveredPath):
-        folderPath = preRecoveredPath
-        for subName in os.listdir(folderPath):
-            newPath = None
-            subPath = os.path.join(folderPath, subName)
-            subRelPath = subName
-            catMajorPath = None
-            catPath = None
-            if len(subName) > 0:
-                subRelPath = os.path.join(relPath, subName)
-            if os.path.isfile(subPath):
-                enableIgnore = False
-                if subName in ignore:
-                    enableIgnore = True
-                newName = subName
-                ext = os.path.splitext(subPath)[1]
-                if len(ext) > 1:
-                    ext = ext[1:]  # remove dot
-                lowerExt = ext.lower()
-                if len(lowerExt) == 0:
-                    if enableNoExtIgnore:
-                        enableIgnore = True
-                if lowerExt in ignoreExts:
-                    enableIgnore = True
-                if enableIgnore:
-                    continue
-                fileSize = os.path.getsize(subPath)
-                category = getCategoryByExt(lowerExt)
-                if category is None:
-                    category = "Backup"
-                    if lowerExt not in unknownTypes:
-                        unknownTypes.append(lowerExt)
-                        unknownPathExamples.append(subPath)
-                    # continue
-                    catMajorPath = os.path.join(profilePath, catDirNames[category])
-                    catMajorPath = os.path.join(catMajorPath, "unknown")
-                else:
-                    catMajorPath = os.path.join(profilePath, catDirNames[category])
-                if category == "Music":
-                    # print('This track is by %s.' % tag.artist)
-                    # print("  " * depth + subPath + ": " + str(tag))
-                    catPath = catMajorPath
-                    newStats = neatMetaTags(subPath)
-                    newName = newStats.get("SuggestedFileName")
-                    artist = newStats.get("Artist")
-                    album = newStats.get("Album")
-                    # if artist == "unknown":
-                        # debug only arst
-                        # print("unknown artist in " + str(newStats))
-                        # exit(1)
-                    if newName is None:
-                        newName = subName
-                    if (artist is not None) and (album is not None):
-                        catPath = os.path.join(
-                            os.path.join(catMajorPath, artist),
-                            album
-                        )
-                    else:
-                        catPath = os.path.join(catMajorPath, "misc")
-                elif category == "Pictures":
-                    try:
-                        im = Image.open(subPath)
-                        imSize = im.size
-                        width, height = imSize
-                        im.close()
-                        if (isThumbnailSize(imSize)):
-                            catPath = os.path.join(catMajorPath, "thumbnails")
-                        else:
-                            catPath = catMajorPath
-                    except OSError:
-                        # such as "Unsupported BMP header type (0)"
-                        catPath = os.path.join(catMajorPath, "unusable")
-                else:
-                    catPath = catMajorPath
-                    validMinFileSize = validMinFileSizes.get(category)
-                    if validMinFileSize is not None:
-                        if fileSize < validMinFileSize:
-                            catPath = os.path.join(catMajorPath, "thumbnails")
-                # if category == "Music":
-                    # if lowerExt == "wma":
-                # print("ensuring dir: " + catPath)
-                if not os.path.isdir(catPath):
-                    os.makedirs(catPath)
-                newPath = os.path.join(catPath, newName)
-                tryNum = 0
-                newNamePartial = os.path.splitext(newName)[0]
-                # if enablePrint:
-                    # print("# moving to '" + newPath + "'")
-                if os.path.isfile(newPath):
-                    if fileSize <= os.path.getsize(newPath):
-                        continue
-                    elif fileSize > os.path.getsize(newPath):
-                        print("# removing smaller '" + newPath + "' and keeping '" + subPath + "'")
-                        os.remove(newPath)
-
-                # while os.path.isfile(newPath):
-                    # tryNum += 1
-                    # newPath = os.path.join(catPath, newNamePartial + " [" + str(tryNum) + "]")
-                    # newPath = withExt(newPath, ext)
-                shutil.move(subPath, newPath)
-                if enablePrint:
-                    print("mv '" + newPath+ "' '" + newPath + "'")
-
-                if enableShowLarge:
-                    if fileSize > largeSize:
-                        print('{0:.3g}'.format(fileSize/1024/1024) + "MB: " + newPath)
-                        # g removes insignificant zeros
-                if (category not in foundMaximums) or (fileSize > foundMaximums[category]):
-                    foundMaximums[category] = fileSize
-                    foundMaximumPaths[category] = newPath
-                if lowerExt not in foundTypeCounts.keys():
-                    foundTypeCounts[lowerExt] = 1
-                else:
-                    foundTypeCounts[lowerExt] += 1
-                if category is None:
-                    print("  " * depth + "unknown type: " + lowerExt + " for '" + subPath + "'")
-                # print("  " * depth + "[" + str(category) + "]" + newPath)
-            elif os.path.isdir(subPath):
-                # print(" " * depth + subName)
-                # if subName[:1] != ".":
-                sortFiles(subPath, profilePath, depth=depth+1)
+    if enableShowLarge:
+        if fileSize > largeSize:
+            print('{0:.3g}'.format(fileSize/1024/1024) + "MB: " + newPath)
+            # g removes insignificant zeros
+    if (category not in foundMaximums) or (fileSize > foundMaximums[category]):
+        foundMaximums[category] = fileSize
+        foundMaximumPaths[category] = newPath
+    if lowerExt not in foundTypeCounts.keys():
+        foundTypeCounts[lowerExt] = 1
     else:
+        foundTypeCounts[lowerExt] += 1
+    # print("  " * depth + "[" + str(category) + "]" + newPath)
+
+
+def selectSortFiles(folderPath, fileEntries, state=None, shard=None):
+    """
+    Get the files of fileEntries (the files in folderPath) that are in
+    the shard (a shards.ShardFilter) and are not done (see
+    checkpoint.PassState.selectFiles), if those are not None.
+    """
+    if shard is not None:
+        fileEntries = shard.selectFiles(folderPath, fileEntries)
+    if state is not None:
+        fileEntries = state.selectFiles(folderPath, fileEntries)
+    return fileEntries
+
+
+def iterSortJobs(folderPath, depth=0, progress=None, state=None,
+                 shard=None):
+    """
+    Yield (job, depth) for each file that sortFiles should place, in the
+    order that sortFiles visits them. Ignored files are counted as done
+    in progress and state (if not None).
+
+    Keyword arguments:
+    state -- a checkpoint.PassState, to skip files that a resumed run
+             already finished (see PassState.selectFiles)
+    shard -- a shards.ShardFilter, to only yield the files of one shard
+    """
+    skipDir = None if shard is None else shard.skipDir
+    for subFolderPath, subDepth, dirEntries, fileEntries in \
+            timedIter("walk", walkEntries(folderPath, skipDir=skipDir)):
+        fileEntries = selectSortFiles(subFolderPath, fileEntries,
+                                      state=state, shard=shard)
+        for entry in fileEntries:
+            with timed("classify"):
+                job = getSortJob(entry.path, st=entry.stat())
+            if job is not None:
+                yield job, depth + subDepth
+            else:
+                count("files.ignored")
+                if progress is not None:
+                    progress.advance(getCategoryByExtUsingPath(entry.path),
+                                     entry.stat().st_size)
+                if state is not None:
+                    state.fileDone(entry.path)
+
+
+def _initSortWorker():
+    forgetInheritedCache()
+    # Only send the parent what this process records (see
+    # _getFileFactsOfJob), not the copy of the parent's metrics.
+    takeMetrics()
+
+
+def _getFileFactsOfJob(jobAndDepth):
+    """
+    Get getFileFacts in a worker process, along with the metrics it
+    recorded (as 'metrics', see takeMetrics) so the parent can add them.
+    """
+    facts = getFileFacts(jobAndDepth[0])
+    facts['metrics'] = takeMetrics()
+    return facts
+
+
+def readSortEntry(folderPath, depth, entry):
+    """
+    Get (path, fileSize, job, depth, facts) for an os.DirEntry, where job
+    and facts are None if the file should be ignored. This only reads
+    (stat, sniffExt, the scan cache, getFileFacts), so it can run in a
+    thread (see sortFiles).
+    """
+    st = entry.stat()
+    with timed("classify"):
+        job = getSortJob(entry.path, st=st)
+    if job is None:
+        return entry.path, st.st_size, None, depth, None
+    loadCachedFacts(job)
+    return entry.path, st.st_size, job, depth, getFileFacts(job)
+
+
+def sortFiles(preRecoveredPath, profilePath, relPath="", depth=0, enablePrint=False, jobCount=1, concurrency=None, state=None, shard=None):
+    """
+    Move recovered files into category directories in profilePath.
+
+    Keyword arguments:
+    jobCount -- If more than 1, read file tags and image dimensions in
+                this many worker processes. Moves still happen in this
+                process in the same order as with one job, so the result
+                is the same.
+    concurrency -- If not None, list folders, stat files and read them
+                   in this many threads at once instead (see asyncscan),
+                   which helps when each call waits on a slow mount.
+                   Moves still happen in this thread in the same order.
+    state -- a checkpoint.PassState to record each file that is done in
+             (files that a resumed run already finished are skipped)
+    shard -- a shards.ShardFilter, to only sort the folders of one shard
+    """
+    # preRecoveredPath becomes a subdirectory upon recursion
+    if not os.path.isdir(preRecoveredPath):
         customDie(preRecoveredPath + " is not a directory")
+    progress = None
+    if enableProgress:
+        progress = Progress(
+            "sort",
+            prescan(preRecoveredPath, getCategoryByExtUsingPath,
+                    skipFilesOf=None if state is None else state.isFolderDone,
+                    skipDir=None if shard is None else shard.skipDir)
+        )
+
+    def fileDone(path):
+        if state is not None:
+            state.fileDone(path)
+            state.checkpoint.saveIfDue()
+
+    if concurrency is not None:
+        def placeEntry(result):
+            subPath, fileSize, job, jobDepth, facts = result
+            if job is None:
+                count("files.ignored")
+            else:
+                saveFacts(job, facts)
+                placeSortedFile(job, facts, profilePath,
+                                depth=depth+jobDepth,
+                                enablePrint=enablePrint)
+            if progress is not None:
+                progress.advance(getCategoryByExtUsingPath(subPath),
+                                 fileSize)
+            fileDone(subPath)
+
+        def selectFiles(folderPath, fileEntries):
+            return selectSortFiles(folderPath, fileEntries, state=state,
+                                   shard=shard)
+
+        mapFilesInOrder(preRecoveredPath, readSortEntry, placeEntry,
+                        concurrency=concurrency, selectFiles=selectFiles,
+                        skipDir=None if shard is None else shard.skipDir)
+        if progress is not None:
+            progress.finish()
+        return
+    jobs = iterSortJobs(preRecoveredPath, depth=depth, progress=progress,
+                        state=state, shard=shard)
+    if jobCount > 1:
+        pool = multiprocessing.Pool(jobCount, _initSortWorker)
+        try:
+            pendingJobs = collections.deque()
+
+            def rememberJobs():
+                for jobAndDepth in jobs:
+                    loadCachedFacts(jobAndDepth[0])
+                    pendingJobs.append(jobAndDepth)
+                    yield jobAndDepth
+
+            results = pool.imap(_getFileFactsOfJob, rememberJobs(),
+                                chunksize=parallelChunkSize)
+            for facts in results:
+                job, jobDepth = pendingJobs.popleft()
+                mergeMetrics(facts.pop('metrics'))
+                saveFacts(job, facts)
+                placeSortedFile(job, facts, profilePath, depth=jobDepth,
+                                enablePrint=enablePrint)
+                if progress is not None:
+                    progress.advance(getCategoryByExtUsingPath(job['path']),
+                                     job['fileSize'])
+                fileDone(job['path'])
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for job, jobDepth in jobs:
+            loadCachedFacts(job)
+            facts = getFileFacts(job)
+            saveFacts(job, facts)
+            placeSortedFile(job, facts, profilePath, depth=jobDepth,
+                            enablePrint=enablePrint)
+            if progress is not None:
+                progress.advance(getCategoryByExtUsingPath(job['path']),
+                                 job['fileSize'])
+            fileDone(job['path'])
+    if progress is not None:
+        progress.finish()
+
+def mergeShards(profilePath, stagingPaths, enablePrint=False):
+    """
+    Move the files of the staging profiles written by --shard runs (see
+    shards.py) into profilePath, keeping the larger file when names
+    collide like sortFiles. Content that is already in profilePath or in
+    an earlier staged file is not moved (see dedupe.findDuplicateGroups,
+    which runs once over all of them), so duplicates are left in the
+    staging profiles along with files that were not larger.
+
+    The statistics in each manifest are added to the ones shown at the
+    end of the run. Raise OSError or ValueError if a manifest can't be
+    read.
+    """
+    staged = []  # (path, newPath) in shard order
+    for stagingPath in stagingPaths:
+        manifest = readManifest(stagingPath)
+        stats = manifest.get('stats', {})
+        maximumPaths = stats.get('foundMaximumPaths', {})
+        for category, path in maximumPaths.items():
+            # where it will be after merging
+            relPath = os.path.relpath(path, stagingPath)
+            maximumPaths[category] = os.path.join(profilePath, relPath)
+        restoreSortStats(stats)
+        for relPath, fileSize in manifest['files']:
+            staged.append((os.path.join(stagingPath, relPath),
+                           os.path.join(profilePath, relPath)))
+    newPaths = {}
+    sizedPaths = []
+    for path, newPath in staged:
+        if fileExists(path):
+            newPaths[path] = newPath
+            sizedPaths.append((path, getFileSize(path)))
+        else:
+            count("files.missing")
+    if os.path.isdir(profilePath):
+        sizedPaths += list(iterSizedFiles(profilePath,
+                                          skipNames=[stateDirName]))
+    skipPaths = set()
+    with timed("mergeDupCheck"):
+        groups = findDuplicateGroups(sizedPaths)
+    for group in groups:
+        # Keep it the same way as removeDuplicates, but prefer a copy
+        # already in the profile (so nothing is moved for it).
+        group.sort(key=lambda path: (
+            isSetAside(newPaths.get(path, path)),
+            path in newPaths,
+            len(newPaths.get(path, path)),
+            newPaths.get(path, path),
+        ))
+        for path in group[1:]:
+            if path in newPaths:
+                skipPaths.add(path)
+    movedCount = 0
+    for path, newPath in staged:
+        if (path not in newPaths) or (path in skipPaths):
+            continue
+        if moveKeepingLarger(path, newPath, getFileSize(path)):
+            movedCount += 1
+            if enablePrint:
+                print("mv '" + path + "' '" + newPath + "'")
+    count("files.mergeDuplicates", len(skipPaths))
+    print("# merged " + str(movedCount) + " of " + str(len(staged))
+          + " staged files (" + str(len(skipPaths)) + " duplicates and "
+          + str(len(newPaths) - len(skipPaths) - movedCount)
+          + " not larger are left in the staging profiles)")
+    return movedCount
+
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        customDie("There must be two parameters.")
     # print(sys.argv[1])
-    sortFiles(sys.argv[1], sys.argv[2])
     enableCleanup = True
+    enableDedupe = True
+    enableAudioDedupe = True
+    enableNearDuplicates = True
+    jobCount = defaultJobCount
+    concurrency = None
+    enableCache = True
+    planPath = None
+    enableDryRun = False
+    metricsPath = None
+    enableResume = False
+    onlyPhase = None
+    shard = None
+    enableMerge = False
+    paths = []
     for argI in range(len(sys.argv)):
         arg = sys.argv[argI]
         if argI == 0:
@@ -390,11 +1327,191 @@ if __name__ == "__main__":
         elif arg[:2] == "--":
             if arg == "--nocleanup":
                 enableCleanup = False
+            elif arg == "--nodedupe":
+                enableDedupe = False
+            elif arg == "--noaudiodedupe":
+                enableAudioDedupe = False
+            elif arg == "--nonearduplicates":
+                enableNearDuplicates = False
+            elif arg == "--nocache":
+                enableCache = False
+            elif arg == "--noprogress":
+                enableProgress = False
+            elif arg == "--dry-run":
+                enableDryRun = True
+            elif arg == "--resume":
+                enableResume = True
+            elif arg == "--verify":
+                transfer.enableVerify = True
+            elif arg == "--merge":
+                enableMerge = True
+            elif arg.startswith("--shard="):
+                try:
+                    shard = parseShard(arg[len("--shard="):])
+                except ValueError as ex:
+                    customDie("--shard must be like --shard=0/4 ("
+                              + str(ex) + ")")
+            elif arg.startswith("--phase="):
+                onlyPhase = arg[len("--phase="):]
+                if (onlyPhase not in phaseNames) and (onlyPhase != "cleanup"):
+                    customDie("--phase must be cleanup or one of: "
+                              + ", ".join(phaseNames))
+            elif arg.startswith("--plan="):
+                planPath = arg[len("--plan="):]
+            elif arg.startswith("--metrics="):
+                metricsPath = arg[len("--metrics="):]
+            elif arg.startswith("--jobs="):
+                try:
+                    jobCount = int(arg[len("--jobs="):])
+                except ValueError:
+                    customDie("--jobs must be a number such as --jobs=4")
+            elif arg.startswith("--async="):
+                try:
+                    concurrency = int(arg[len("--async="):])
+                except ValueError:
+                    concurrency = 0
+                if concurrency < 1:
+                    customDie("--async must be a number such as --async=32")
             else:
                 customDie("Unknown option: " + arg)
-    if enableCleanup:
-        removeExtra(sys.argv[2], sys.argv[2])  # same arg for both
+        else:
+            paths.append(arg)
+    stagingPaths = None
+    if enableMerge:
+        # The merge is done instead of the sort.
+        if len(paths) < 2:
+            customDie("--merge needs the profile and at least one staging"
+                      " profile.")
+        if shard is not None:
+            customDie("--merge and --shard can't be used together.")
+        srcPath = None
+        profilePath = paths[0]
+        stagingPaths = paths[1:]
+    else:
+        if (onlyPhase not in (None, "sort")) and (len(paths) == 1):
+            # Only the profile is needed.
+            paths.insert(0, None)
+        if len(paths) != 2:
+            customDie("There must be two parameters.")
+        srcPath, profilePath = paths
+    if (concurrency is not None) and (jobCount > 1):
+        customDie("--async and --jobs can't be used together.")
+    sortPhaseName = "merge" if enableMerge else "sort"
+    runPhases = []
+    if onlyPhase in (None, "sort"):
+        runPhases.append(sortPhaseName)
+    if (onlyPhase == "cleanup") or ((onlyPhase is None) and enableCleanup):
+        if enableDedupe:
+            runPhases.append("dedupe")
+        if enableAudioDedupe:
+            runPhases.append("audio")
+        runPhases.append("blanks")
+        if enableNearDuplicates:
+            runPhases.append("near")
+    elif onlyPhase not in (None, "sort"):
+        runPhases.append(onlyPhase)
+    if enableDryRun or (planPath is not None):
+        # The cleanup reads the sorted files, so it can't be planned
+        # until the plan is applied.
+        if sortPhaseName not in runPhases:
+            customDie("--plan and --dry-run only apply to the sort phase.")
+        if enableResume:
+            customDie("--resume can't be used with --plan or --dry-run.")
+        runPhases = [sortPhaseName]
+    if shard is not None:
+        # The cleanup needs the files of every shard (see --merge).
+        if "sort" not in runPhases:
+            customDie("--shard only applies to the sort phase.")
+        runPhases = ["sort"]
+        shard = ShardFilter(srcPath, shard[0], shard[1])
+    if metricsPath is not None:
+        startMetrics(metricsPath)
+    stateDirPath = os.path.join(profilePath, stateDirName)
+    if enableDryRun and not os.path.isdir(stateDirPath):
+        # Do not create anything in the profile.
+        enableCache = False
+    if enableCache:
+        # A dry run only uses facts found by earlier runs.
+        openScanCache(stateDirPath, readOnly=enableDryRun)
+    checkpoint = None
+    if enableDryRun or (planPath is not None):
+        startPlan(None if enableDryRun else planPath)
+    else:
+        checkpoint = openCheckpoint(stateDirPath, enableResume=enableResume)
+        if checkpoint.resumed:
+            print("# resuming from '" + checkpoint.path + "'")
+            restoreSortStats(checkpoint.stats)
+        elif enableResume:
+            print("# There is no checkpoint to resume in '" + stateDirPath
+                  + "', so starting over.")
+        checkpoint.getStats = getSortStats
+
+    def getPassState(name, topPath):
+        # Get the checkpoint.PassState of a phase, or None if not saving
+        # checkpoints.
+        if checkpoint is None:
+            return None
+        try:
+            return checkpoint.getPass(name, topPath)
+        except ValueError as ex:
+            customDie(str(ex))
+
+    try:
+        for phaseName in runPhases:
+            topPath = srcPath if (phaseName == "sort") else profilePath
+            state = getPassState(phaseName, topPath)
+            if (state is not None) and state.finished:
+                print("# skipping the " + phaseName + " phase (finished"
+                      + " before resuming)")
+                continue
+            with phase(phaseName):
+                if phaseName == "sort":
+                    sortFiles(srcPath, profilePath, jobCount=jobCount,
+                              concurrency=concurrency, state=state,
+                              shard=shard)
+                    if (shard is not None) and not enableDryRun and \
+                            (planPath is None):
+                        manifest = writeManifest(profilePath, shard, srcPath,
+                                                 stats=getSortStats())
+                        print("# wrote the manifest of shard "
+                              + str(shard.shardIndex) + "/"
+                              + str(shard.shardCount) + " ("
+                              + str(len(manifest['folders'])) + " folders, "
+                              + str(len(manifest['files'])) + " files)")
+                elif phaseName == "merge":
+                    try:
+                        mergeShards(profilePath, stagingPaths)
+                    except (OSError, ValueError) as ex:
+                        customDie("Reading the manifests failed: " + str(ex))
+                elif phaseName == "dedupe":
+                    removeDuplicates(profilePath)
+                elif phaseName == "audio":
+                    removeAudioDuplicates(profilePath)
+                elif phaseName == "blanks":
+                    # same arg for both
+                    removeExtra(profilePath, profilePath, state=state)
+                elif phaseName == "near":
+                    moveNearDuplicates(profilePath)
+            if state is not None:
+                state.finish()
+            if phaseName == sortPhaseName:
+                opCount = finishPlan()
+                if enableDryRun:
+                    print("# dry run: " + str(opCount)
+                          + " operations were not done")
+                elif planPath is not None:
+                    print("# wrote " + str(opCount) + " operations to '"
+                          + planPath + "'")
+                    print("# apply them using: applyplan.py '" + planPath
+                          + "'")
+    finally:
+        if checkpoint is not None:
+            # Also save where an interrupted phase stopped.
+            checkpoint.close()
 
+    flushSimilarNames()
+    closeScanCache()
+    stopMetrics()
     print("Maximums:")
     for k, v in foundMaximums.items():
         print("  Largest in " + k + ":" + '{0:.3g}'.format(v/1024/1024) + " MB): " + foundMaximumPaths[k])
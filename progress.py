@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Show the progress and estimated time left of a long pass over many
+files, such as sorting a multi-terabyte PhotoRec result.
+
+A cheap pre-scan (see prescan) totals the files and bytes of each
+category first. The time spent on each category is measured while
+running, so the estimate accounts for categories that are slow per
+byte (such as images that are decoded) and ones that are nearly free
+(such as files that are only renamed).
+
+Usage:
+totals = prescan(folderPath, getCategoryByExtUsingPath)
+progress = Progress("sort", totals)
+for ...:
+    ...
+    progress.advance(category, fileSize)
+progress.finish()
+"""
+import time
+import threading
+
+from treewalk import walkEntries
+
+progressInterval = 10.0  # seconds between progress lines
+# Work done per file regardless of its size (opening it, moving it and
+# so on), as a number of bytes of work.
+fileCostBytes = 64 * 1024
+# Files of a category to measure before using its own speed for the
+# estimate (until then the overall speed is used).
+minMeasuredFiles = 20
+
+
+def addToTotals(totals, key, fileSize):
+    counts = totals.get(key)
+    if counts is None:
+        counts = [0, 0]
+        totals[key] = counts
+    counts[0] += 1
+    counts[1] += fileSize
+
+
+def totalsOfEntries(fileEntries, getKey=None):
+    """
+    Get a dict of key -> [file count, byte count] for a list of
+    os.DirEntry. The key of each file is getKey(path) (or None if
+    getKey is None).
+    """
+    totals = {}
+    for entry in fileEntries:
+        key = None
+        if getKey is not None:
+            key = getKey(entry.path)
+        try:
+            fileSize = entry.stat().st_size
+        except OSError:
+            continue
+        addToTotals(totals, key, fileSize)
+    return totals
+
+
+def prescan(folderPath, getKey=None, skipNames=None, skipFilesOf=None,
+            skipDir=None):
+    """
+    Walk folderPath (without reading any files) and get the totals of
+    each category like totalsOfEntries.
+
+    Keyword arguments:
+    skipFilesOf -- a function that gets a folder path and returns True
+                   to leave out the files in it (such as ones that a
+                   resumed run already finished)
+    skipDir -- see walkEntries
+    """
+    totals = {}
+    for subFolderPath, depth, dirEntries, fileEntries in \
+            walkEntries(folderPath, skipNames=skipNames, skipDir=skipDir):
+        if (skipFilesOf is not None) and skipFilesOf(subFolderPath):
+            continue
+        for key, counts in totalsOfEntries(fileEntries, getKey).items():
+            done = totals.get(key)
+            if done is None:
+                totals[key] = counts
+            else:
+                done[0] += counts[0]
+                done[1] += counts[1]
+    return totals
+
+
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60,
+                                     seconds % 60)
+
+
+def formatBytes(byteCount):
+    if byteCount >= 1024 * 1024 * 1024:
+        return '{0:.2f}'.format(byteCount/1024/1024/1024) + " GB"
+    return '{0:.1f}'.format(byteCount/1024/1024) + " MB"
+
+
+class Progress:
+    """
+    Track files done (see advance) against the totals from prescan or
+    totalsOfEntries, and print the progress and time left at most
+    every interval seconds.
+    """
+    def __init__(self, name, totals, interval=None, enablePrint=True):
+        if interval is None:
+            interval = progressInterval
+        self.name = name
+        self.totals = totals
+        self.interval = interval
+        self.enablePrint = enablePrint
+        self.done = {}  # key -> [file count, byte count, seconds]
+        self.startTime = time.perf_counter()
+        self.lastTime = self.startTime
+        self.lastPrintTime = self.startTime
+        self.printCount = 0
+        # advance may be called by a thread feeding a Pool (see sortFiles)
+        self.lock = threading.Lock()
+
+    def advance(self, key, fileSize):
+        """
+        Count one more file as done, and the time since the last one as
+        time spent on the category key.
+        """
+        with self.lock:
+            now = time.perf_counter()
+            done = self.done.get(key)
+            if done is None:
+                done = [0, 0, 0.0]
+                self.done[key] = done
+            done[0] += 1
+            done[1] += fileSize
+            done[2] += now - self.lastTime
+            self.lastTime = now
+            if (not self.enablePrint) or \
+                    (now - self.lastPrintTime < self.interval):
+                return
+            self.lastPrintTime = now
+            self.printCount += 1
+            status = self.getStatus()
+        print("# " + status)
+
+    def getTimeLeft(self):
+        """
+        Estimate the seconds left, using the measured seconds per byte of
+        work (see fileCostBytes) of each category.
+        """
+        doneUnits = 0
+        doneSeconds = 0.0
+        for done in self.done.values():
+            doneUnits += done[0] * fileCostBytes + done[1]
+            doneSeconds += done[2]
+        if doneUnits < 1:
+            return None
+        overallRate = doneSeconds / doneUnits
+        ret = 0.0
+        for key, totals in self.totals.items():
+            done = self.done.get(key, (0, 0, 0.0))
+            leftUnits = ((totals[0] - done[0]) * fileCostBytes
+                         + totals[1] - done[1])
+            if leftUnits <= 0:
+                continue
+            rate = overallRate
+            if done[0] >= minMeasuredFiles:
+                rate = done[2] / (done[0] * fileCostBytes + done[1])
+            ret += leftUnits * rate
+        return ret
+
+    def getStatus(self):
+        totalFiles = 0
+        totalBytes = 0
+        for totals in self.totals.values():
+            totalFiles += totals[0]
+            totalBytes += totals[1]
+        doneFiles = 0
+        doneBytes = 0
+        for done in self.done.values():
+            doneFiles += done[0]
+            doneBytes += done[1]
+        elapsed = time.perf_counter() - self.startTime
+        timeLeft = self.getTimeLeft()
+        percent = ""
+        eta = "?"
+        if timeLeft is not None:
+            # This is the part of the estimated time that is done, so it
+            # is weighted by size and by how slow each category is.
+            percent = '{0:.1f}'.format(
+                100.0 * elapsed / max(elapsed + timeLeft, 0.001)) + "% "
+            eta = formatDuration(timeLeft)
+        return (self.name + ": " + percent + "(" + str(doneFiles) + "/"
+                + str(totalFiles) + " files, " + formatBytes(doneBytes)
+                + "/" + formatBytes(totalBytes) + ") elapsed "
+                + formatDuration(elapsed) + " ETA " + eta)
+
+    def finish(self):
+        """
+        Print a summary if any progress was printed (so quick passes stay
+        quiet).
+        """
+        if self.enablePrint and (self.printCount > 0):
+            doneFiles = 0
+            doneBytes = 0
+            for done in self.done.values():
+                doneFiles += done[0]
+                doneBytes += done[1]
+            print("# " + self.name + ": done " + str(doneFiles) + " files ("
+                  + formatBytes(doneBytes) + ") in "
+                  + formatDuration(time.perf_counter() - self.startTime))
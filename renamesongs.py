@@ -2,55 +2,135 @@
 
 import sys
 import os
-import shutil
-
-from tinytag import TinyTag
-from tinytag import TinyTagException
-
-from postrecsort import *
+from concurrent.futures import ThreadPoolExecutor
 
+from moremeta import neatMetaTags
+from moremeta import collectSimilarTags
+from moremeta import flushSimilarNames
 from moremeta import withExt
+from moveplan import moveFile
+from treewalk import walkEntries
 
 #badPathChars = ["></\\:;\t|\n\r\"?"]   # NOTE: Invalid characters on
                                        # Windows also include 1-31 & \b
 #replacementPathChars = [("\"", "in"), (":","-"), ("?",""),("\r",""), ("\n",""), ("/",","), ("\\",","), (":","-")]
 
-def renameSongs(folderPath, relPath=""):
-    for subName in os.listdir(folderPath):
-        subPath = os.path.join(folderPath, subName)
-        # catPath = folderPath
-        subRelPath = subName
-        if len(subName) > 0:
-            subRelPath = os.path.join(relPath, subName)
-
-        catMajorPath = os.path.join(folderPath, "Music")
-        if os.path.isfile(subPath):
-            # print(subPath)
-            newPath = subPath
-            ext = os.path.splitext(subPath)[1]
-            if len(ext) > 1:
-                ext = ext[1:]  # remove dot
-            # lowerExt = ext.lower()
-            # print('This track is by %s.' % tag.artist)
-            # print("  " * depth + subPath + ": " + str(tag))
-            newStats = neatMetaTags(subPath)
-            newName = newStats.get('SuggestedFileName')
-            # print("* " + artist + "/" + album + "/" + newName)
-            if newName is not None:
-                newPath = os.path.join(folderPath, newName)
-            if (newPath is not None) and (subPath != newPath):
-                newPath = os.path.join(folderPath, newName)
-                tryNum = 0
-                newNamePartial = os.path.splitext(newName)[0]
-                while os.path.isfile(newPath):
-                    tryNum += 1
-                    newPath = os.path.join(folderPath, newNamePartial + " [" + str(tryNum) + "]")
-                    newPath = withExt(newPath, ext)
-                shutil.move(subPath, newPath)
-                # print(newPath)
-        else:
-            renameSongs(subPath, relPath=subRelPath)
+defaultJobCount = 8  # threads reading tags (see renameSongs)
+
+
+def usage():
+    print(sys.argv[0] + " <music directory> [options]")
+    print("")
+    print("options:")
+    print("--jobs=<count>       Read tags in <count> threads (default "
+          + str(defaultJobCount) + ").")
+
+
+def _getNeatTags(path):
+    return neatMetaTags(path, collectSimilar=False)
+
+
+def getFreeNewName(takenNames, newName, ext):
+    """
+    Get newName, or newName with " [n]" added before the extension if
+    it is in takenNames (a set of os.path.normcase names in the folder),
+    and add the result to takenNames.
+    """
+    tryNum = 0
+    newNamePartial = os.path.splitext(newName)[0]
+    while os.path.normcase(newName) in takenNames:
+        tryNum += 1
+        newName = withExt(newNamePartial + " [" + str(tryNum) + "]", ext)
+    takenNames.add(os.path.normcase(newName))
+    return newName
+
+
+def renameSongsInFolder(folderPath, dirEntries, fileEntries, mapTags):
+    """
+    Rename the songs in one folder to the SuggestedFileName of their
+    tags. Names in the folder are tracked in a set instead of checking
+    for each "[n]" name on disk, and the renames are done together once
+    all of the tags were read. mapTags is a map function (such as
+    ThreadPoolExecutor.map) used to get neatMetaTags for each path.
+    """
+    takenNames = set()
+    for entry in dirEntries:
+        takenNames.add(os.path.normcase(entry.name))
+    for entry in fileEntries:
+        takenNames.add(os.path.normcase(entry.name))
+    paths = [entry.path for entry in fileEntries]
+    renames = []
+    for subPath, rawStats in zip(paths, mapTags(_getNeatTags, paths)):
+        # Collect artist and album names here in the same order as
+        # neatMetaTags would, since getSimilarNames is not thread-safe.
+        newStats = collectSimilarTags(rawStats)
+        newName = newStats.get('SuggestedFileName')
+        if newName is None:
+            continue
+        subName = os.path.basename(subPath)
+        if newName == subName:
+            continue
+        ext = os.path.splitext(subPath)[1]
+        if len(ext) > 1:
+            ext = ext[1:]  # remove dot
+        # The rename of subPath is done before any later one, so its
+        # old name is free by the time a later rename could take it.
+        takenNames.discard(os.path.normcase(subName))
+        newName = getFreeNewName(takenNames, newName, ext)
+        renames.append((subPath, os.path.join(folderPath, newName)))
+    for subPath, newPath in renames:
+        moveFile(subPath, newPath)
+        # print(newPath)
+    return len(renames)
+
+
+def renameSongs(folderPath, relPath="", jobCount=defaultJobCount):
+    """
+    Rename each song under folderPath using its tags (see
+    renameSongsInFolder).
+
+    Keyword arguments:
+    jobCount -- read tags in this many threads (1 to read them in this
+                thread)
+    """
+    renameCount = 0
+    executor = None
+    mapTags = map
+    if jobCount > 1:
+        executor = ThreadPoolExecutor(max_workers=jobCount)
+        mapTags = executor.map
+    try:
+        for subFolderPath, depth, dirEntries, fileEntries in \
+                walkEntries(folderPath):
+            renameCount += renameSongsInFolder(subFolderPath, dirEntries,
+                                               fileEntries, mapTags)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return renameCount
 
 
 if __name__ == "__main__":
-    renameSongs(sys.argv[1])
+    jobCount = defaultJobCount
+    paths = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--jobs="):
+            try:
+                jobCount = int(arg[len("--jobs="):])
+            except ValueError:
+                usage()
+                print("")
+                print("ERROR: --jobs must be a number such as --jobs=4")
+                exit(1)
+        elif arg[:2] == "--":
+            usage()
+            print("")
+            print("ERROR: Unknown option: " + arg)
+            exit(1)
+        else:
+            paths.append(arg)
+    if len(paths) != 1:
+        usage()
+        exit(1)
+    renameSongs(paths[0], jobCount=jobCount)
+    flushSimilarNames()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Remember facts about files (image size, tags, EXIF date, hashes, etc.)
+between runs in an SQLite database. Each fact is stored under the file's
+(device, inode, size, modification time), so moving a file on the same
+device keeps its facts, and changing it makes the old facts disappear.
+
+Usage:
+openScanCache(path)
+imSize = cachedFact(path, "imSize", lambda: readImageSize(path))
+closeScanCache()
+
+If no cache is open, cachedFact just calls the function.
+"""
+import os
+import json
+import sqlite3
+import atexit
+import threading
+
+cacheFileName = "scancache.sqlite"
+commitInterval = 1000  # puts between commits
+
+activeCache = None
+_inheritedCaches = []
+
+
+def statKey(st):
+    """
+    Get the cache key for the result of os.stat (or DirEntry.stat).
+    """
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class ScanCache:
+    def __init__(self, path, readOnly=False):
+        self.path = path
+        self.readOnly = readOnly  # if True, put does nothing
+        self.pendingCount = 0
+        # Allow use from a helper thread such as a Pool's task feeder.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS facts ("
+            " dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER,"
+            " name TEXT, value TEXT,"
+            " PRIMARY KEY (dev, ino, name))"
+        )
+        self.conn.commit()
+
+    def get(self, key, name, default=None):
+        dev, ino, size, mtime = key
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime, value FROM facts"
+                " WHERE dev=? AND ino=? AND name=?",
+                (dev, ino, name)
+            ).fetchone()
+        if (row is None) or (row[0] != size) or (row[1] != mtime):
+            return default
+        return json.loads(row[2])
+
+    def put(self, key, name, value):
+        if self.readOnly:
+            return
+        dev, ino, size, mtime = key
+        with self.lock:
+            # Facts about the inode from before it changed are now wrong.
+            self.conn.execute(
+                "DELETE FROM facts WHERE dev=? AND ino=?"
+                " AND (size<>? OR mtime<>?)",
+                (dev, ino, size, mtime)
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO facts"
+                " (dev, ino, size, mtime, name, value)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (dev, ino, size, mtime, name, json.dumps(value))
+            )
+            self.pendingCount += 1
+            if self.pendingCount >= commitInterval:
+                self.conn.commit()
+                self.pendingCount = 0
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.pendingCount = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def openScanCache(stateDirPath, readOnly=False):
+    """
+    Open (or create) the cache in stateDirPath and use it for
+    cachedFact, getCached and putCached until closeScanCache. If
+    readOnly is True (such as for a dry run), facts are only looked up.
+    """
+    global activeCache
+    closeScanCache()
+    if not os.path.isdir(stateDirPath):
+        os.makedirs(stateDirPath)
+    activeCache = ScanCache(os.path.join(stateDirPath, cacheFileName),
+                            readOnly=readOnly)
+    return activeCache
+
+
+def closeScanCache():
+    global activeCache
+    if activeCache is not None:
+        activeCache.close()
+        activeCache = None
+
+
+def forgetInheritedCache():
+    """
+    Stop using a cache inherited from a parent process (call this first
+    in a worker process) without closing the parent's connection.
+    """
+    global activeCache
+    if activeCache is not None:
+        _inheritedCaches.append(activeCache)
+        activeCache = None
+
+
+def getCached(key, name, default=None):
+    if activeCache is None:
+        return default
+    return activeCache.get(key, name, default=default)
+
+
+def putCached(key, name, value):
+    if activeCache is not None:
+        activeCache.put(key, name, value)
+
+
+_missing = object()
+
+
+def cachedFact(path, name, compute, st=None):
+    """
+    Get a fact about the file at path from the cache, or compute and
+    store it. The value must be JSON-compatible (tuples come back as
+    lists).
+
+    Keyword arguments:
+    st -- the result of os.stat(path), if already known
+    """
+    if activeCache is None:
+        return compute()
+    if st is None:
+        st = os.stat(path)
+    key = statKey(st)
+    value = activeCache.get(key, name, default=_missing)
+    if value is _missing:
+        value = compute()
+        activeCache.put(key, name, value)
+    return value
+
+
+atexit.register(closeScanCache)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Split the recup_dir.N folders of a PhotoRec result between several
+postrecsort.py processes (on one or more machines) with --shard=i/n,
+where each sorts its share into its own staging profile and writes a
+manifest of it there. Then postrecsort.py --merge moves the staged
+files into the final profile (see mergeShards in postrecsort.py).
+
+A folder named recup_dir.N belongs to shard N % n, so the folders of
+each shard are spread over the whole result. Other folders are
+assigned by a checksum of their name, and files that are not in a
+folder belong to shard 0.
+"""
+import os
+import re
+import json
+import zlib
+
+from moremeta import stateDirName
+from treewalk import walkEntries
+
+manifestFileName = "manifest.json"
+_numberedRe = re.compile(r"^recup_dir\.(\d+)$")
+
+
+def parseShard(text):
+    """
+    Get (shardIndex, shardCount) from text such as "2/8" (the third of
+    8 shards), or raise ValueError.
+    """
+    parts = text.split("/")
+    if len(parts) != 2:
+        raise ValueError("A shard must be like 0/4, not " + text)
+    shardIndex = int(parts[0])
+    shardCount = int(parts[1])
+    if (shardCount < 1) or (shardIndex < 0) or (shardIndex >= shardCount):
+        raise ValueError("The shard index must be from 0 to one less than"
+                         " the shard count, not " + text)
+    return shardIndex, shardCount
+
+
+def getShardOfName(name, shardCount):
+    match = _numberedRe.match(name)
+    if match is not None:
+        return int(match.group(1)) % shardCount
+    return zlib.crc32(name.encode('utf-8')) % shardCount
+
+
+class ShardFilter:
+    """
+    Select the folders and files of one shard of a walk of topPath (see
+    skipDir and selectFiles), and remember which top folders that was.
+    """
+    def __init__(self, topPath, shardIndex, shardCount):
+        self.topPath = topPath
+        self.shardIndex = shardIndex
+        self.shardCount = shardCount
+        self.folderNames = set()
+
+    def skipDir(self, entry, depth):
+        """
+        Leave out the top folders of other shards (for walkEntries).
+        """
+        if depth != 0:
+            return False
+        if getShardOfName(entry.name, self.shardCount) != self.shardIndex:
+            return True
+        self.folderNames.add(entry.name)
+        return False
+
+    def selectFiles(self, folderPath, fileEntries):
+        """
+        Get the files in fileEntries (the files in folderPath) that
+        belong to this shard.
+        """
+        if (self.shardIndex != 0) and \
+                (os.path.normpath(folderPath)
+                 == os.path.normpath(self.topPath)):
+            return []
+        return fileEntries
+
+
+def getManifestPath(stagingPath):
+    return os.path.join(stagingPath, stateDirName, manifestFileName)
+
+
+def listProfileFiles(profilePath):
+    """
+    Get a list of [relPath, size] for each file in profilePath (not
+    including its stateDirName folder).
+    """
+    files = []
+    for folderPath, depth, dirEntries, fileEntries in \
+            walkEntries(profilePath, skipNames=[stateDirName]):
+        for entry in fileEntries:
+            try:
+                fileSize = entry.stat().st_size
+            except OSError:
+                continue
+            files.append([os.path.relpath(entry.path, profilePath),
+                          fileSize])
+    files.sort()
+    return files
+
+
+def writeManifest(stagingPath, shardFilter, sourcePath, stats=None):
+    """
+    Write the manifest of a staging profile: which shard of sourcePath
+    it is, the folders that were sorted, stats (such as from
+    getSortStats) and each file in it.
+    """
+    manifest = {
+        'shardIndex': shardFilter.shardIndex,
+        'shardCount': shardFilter.shardCount,
+        'source': os.path.abspath(sourcePath),
+        'folders': sorted(shardFilter.folderNames),
+        'stats': stats if (stats is not None) else {},
+        'files': listProfileFiles(stagingPath),
+    }
+    path = getManifestPath(stagingPath)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmpPath = path + ".tmp"
+    with open(tmpPath, 'w') as outs:
+        json.dump(manifest, outs)
+    os.replace(tmpPath, path)
+    return manifest
+
+
+def readManifest(stagingPath):
+    with open(getManifestPath(stagingPath), 'r') as ins:
+        return json.load(ins)
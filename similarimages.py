@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Find images that look the same even if they were saved at a different
+size or with a different encoding, using a difference hash (dHash) of
+each image and a BK-tree so that finding every hash within a Hamming
+distance does not require comparing every pair of images.
+"""
+try:
+    from PIL import Image
+except ImportError:
+    print("This program requires PIL such as from the python-pil package")
+
+hashSize = 8
+
+
+def dHash(im, hashSize=hashSize):
+    """
+    Get a hashSize * hashSize bit difference hash of a PIL image as an
+    int. Each bit is set if a pixel is brighter than the pixel to its
+    right in a grayscale copy reduced to (hashSize + 1) x hashSize.
+    """
+    if im.format == "JPEG":
+        # Let the decoder scale down instead of decoding every pixel.
+        im.draft('L', ((hashSize + 1) * 4, hashSize * 4))
+    small = im.convert('L').resize((hashSize + 1, hashSize), Image.LANCZOS)
+    pixels = list(small.getdata())
+    small.close()
+    ret = 0
+    for y in range(hashSize):
+        row = y * (hashSize + 1)
+        for x in range(hashSize):
+            ret <<= 1
+            if pixels[row + x] > pixels[row + x + 1]:
+                ret |= 1
+    return ret
+
+
+def dHashOfFile(path, hashSize=hashSize):
+    im = Image.open(path)
+    try:
+        return dHash(im, hashSize=hashSize)
+    finally:
+        im.close()
+
+
+def hammingDistance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """
+    A Burkhard-Keller tree of int hashes using Hamming distance. Each
+    node stores one hash, the items that have that hash, and children
+    keyed by their distance from the node.
+    """
+    def __init__(self):
+        self.root = None
+        self.count = 0
+
+    def add(self, hashValue, item):
+        self.count += 1
+        if self.root is None:
+            self.root = [hashValue, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hammingDistance(hashValue, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hashValue, [item], {}]
+                return
+            node = child
+
+    def search(self, hashValue, maxDistance):
+        """
+        Get a list of (distance, item) for every item with a hash no
+        more than maxDistance bits from hashValue.
+        """
+        results = []
+        if self.root is None:
+            return results
+        pending = [self.root]
+        while pending:
+            node = pending.pop()
+            distance = hammingDistance(hashValue, node[0])
+            if distance <= maxDistance:
+                for item in node[1]:
+                    results.append((distance, item))
+            # By the triangle inequality, only children whose distance
+            # from this node is within maxDistance of distance can match.
+            low = distance - maxDistance
+            high = distance + maxDistance
+            for childDistance, child in node[2].items():
+                if low <= childDistance <= high:
+                    pending.append(child)
+        return results
+
+
+def findNearDuplicateClusters(itemHashes, maxDistance, key=None):
+    """
+    Group items whose hashes are within maxDistance of the first item of
+    their group (the one that is kept). Items are taken in order (sorted
+    by key if not None), and each item that is not in a group yet starts
+    a group of the remaining items near it, so a chain of similar images
+    never pulls in one that is far from the kept image.
+
+    Keyword arguments:
+    itemHashes -- a list of (item, hash) tuples
+    key -- a function of an item that sorts the best one to keep first
+
+    Returns a list of clusters (lists of items, the kept one first) with
+    more than one item.
+    """
+    order = list(range(len(itemHashes)))
+    if key is not None:
+        order.sort(key=lambda itemI: key(itemHashes[itemI][0]))
+    tree = BKTree()
+    for itemI in order:
+        tree.add(itemHashes[itemI][1], itemI)
+    rankOf = {}
+    for rank, itemI in enumerate(order):
+        rankOf[itemI] = rank
+    assigned = [False] * len(itemHashes)
+    ret = []
+    for itemI in order:
+        if assigned[itemI]:
+            continue
+        assigned[itemI] = True
+        near = []
+        for distance, otherI in tree.search(itemHashes[itemI][1],
+                                            maxDistance):
+            if not assigned[otherI]:
+                near.append(otherI)
+        if len(near) < 1:
+            continue
+        near.sort(key=lambda otherI: rankOf[otherI])
+        cluster = [itemHashes[itemI][0]]
+        for otherI in near:
+            assigned[otherI] = True
+            cluster.append(itemHashes[otherI][0])
+        ret.append(cluster)
+    return ret
@@ -5,13 +5,44 @@
 import sys
 
 from moremeta import *
+from scancache import openScanCache
+from scancache import closeScanCache
 
-if len(sys.argv) < 2:
+concurrency = None
+enableCache = True
+paths = []
+for arg in sys.argv[1:]:
+    if arg == "--nocache":
+        enableCache = False
+    elif arg.startswith("--async="):
+        try:
+            concurrency = int(arg[len("--async="):])
+        except ValueError:
+            concurrency = 0
+        if concurrency < 1:
+            print("--async must be a number such as --async=32")
+            exit(1)
+    elif arg[:2] == "--":
+        print("Unknown option: " + arg)
+        exit(1)
+    else:
+        paths.append(arg)
+
+if len(paths) < 1:
     print("You must specify a directory.")
+    print("options:")
+    print("--async=<count>  Stat and read files in <count> threads at once")
+    print("                 (for network shares and slow USB bridges).")
+    print("--nocache        Do not use or update the scan cache ("
+          + stateDirName + " in the directory")
+    print("                 or the nearest parent that has one).")
     exit(1)
 
 #process_files("/run/media/owner/sandisku32/DCIM/2017-10-29", 'move')
-results = process_files(sys.argv[1], 'move')
+if enableCache:
+    openScanCache(getStateDirPath(paths[0]))
+results = process_files(paths[0], 'move', concurrency=concurrency)
+closeScanCache()
 
 print("unknown_type_count: " + str(results.get('unknown_type_count')))
 print("missing_meta_count: " + str(results.get('missing_meta_count')))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+Move files the fast way for where they are going: a rename on the same
+device, otherwise a kernel-side copy (os.copy_file_range or os.sendfile)
+into a preallocated file, then removal of the source. The free space on
+the destination is checked first, and (if verify is enabled, such as by
+applyplan.py --verify) the copy is read back from the device and
+compared to a checksum of the source before the source is removed.
+"""
+import os
+import errno
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+
+from dedupe import newHasher
+from dedupe import hashFile
+from metrics import count
+
+enableVerify = False  # checksum copies (see copyFile)
+copyChunkSize = 8 * 1024 * 1024
+minFreeSpace = 64 * 1024 * 1024  # bytes to leave free on a destination
+
+# errors from copy_file_range or sendfile that mean "not for these files"
+_unsupportedErrnos = set([errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                          errno.EOPNOTSUPP, errno.ENOTSUP])
+
+
+def _getExistingFolder(path):
+    folderPath = os.path.abspath(path)
+    while not os.path.isdir(folderPath):
+        parentPath = os.path.dirname(folderPath)
+        if parentPath == folderPath:
+            break
+        folderPath = parentPath
+    return folderPath
+
+
+def checkFreeSpace(folderPath, neededBytes):
+    """
+    Raise OSError (ENOSPC) if the device where folderPath is (or would
+    be) does not have neededBytes free, plus minFreeSpace.
+    """
+    existingPath = _getExistingFolder(folderPath)
+    freeBytes = shutil.disk_usage(existingPath).free
+    if freeBytes - minFreeSpace < neededBytes:
+        raise OSError(
+            errno.ENOSPC,
+            "{:.1f} MB are needed but {:.1f} MB are free".format(
+                neededBytes/1024/1024, freeBytes/1024/1024
+            ),
+            existingPath
+        )
+
+
+def checkFreeSpaceForTransfers(pairs):
+    """
+    Check the free space for all of the (src, dst) pairs before starting
+    any of them (see checkFreeSpace). Files that will only be renamed
+    (same device) need no space. Missing sources are skipped.
+    """
+    neededByDev = {}
+    folderByDev = {}
+    devByFolder = {}
+    for src, dst in pairs:
+        try:
+            srcSt = os.lstat(src)
+        except OSError:
+            continue
+        dstFolderPath = _getExistingFolder(os.path.dirname(dst))
+        dev = devByFolder.get(dstFolderPath)
+        if dev is None:
+            dev = os.stat(dstFolderPath).st_dev
+            devByFolder[dstFolderPath] = dev
+        if srcSt.st_dev == dev:
+            continue
+        folderByDev[dev] = dstFolderPath
+        neededByDev[dev] = neededByDev.get(dev, 0) + srcSt.st_size
+    for dev, neededBytes in neededByDev.items():
+        checkFreeSpace(folderByDev[dev], neededBytes)
+
+
+def preallocate(fd, size):
+    """
+    Reserve size bytes for the file so it is less fragmented, if the
+    system and filesystem support it.
+    """
+    if size < 1:
+        return
+    fallocate = getattr(os, "posix_fallocate", None)
+    if fallocate is None:
+        return
+    try:
+        fallocate(fd, 0, size)
+    except OSError:
+        # such as EOPNOTSUPP on some filesystems
+        pass
+
+
+def _copyInKernel(inFd, outFd, size):
+    """
+    Copy size bytes without passing them through Python, or return None
+    if neither copy_file_range nor sendfile can copy these files (only
+    decided at the start, so nothing was written).
+    """
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append("copy_file_range")
+    if hasattr(os, "sendfile"):
+        methods.append("sendfile")
+    for method in methods:
+        offset = 0
+        try:
+            while offset < size:
+                count = min(copyChunkSize, size - offset)
+                if method == "copy_file_range":
+                    sent = os.copy_file_range(inFd, outFd, count,
+                                              offset, offset)
+                else:
+                    sent = os.sendfile(outFd, inFd, offset, count)
+                if sent == 0:
+                    # The source became shorter.
+                    break
+                offset += sent
+        except OSError as ex:
+            if (offset > 0) or (ex.errno not in _unsupportedErrnos):
+                raise
+            continue
+        return offset
+    return None
+
+
+def _copyInPython(ins, outs, hasher=None):
+    copiedCount = 0
+    buffer = bytearray(copyChunkSize)
+    view = memoryview(buffer)
+    while True:
+        readCount = ins.readinto(buffer)
+        if not readCount:
+            break
+        chunk = view[:readCount]
+        if hasher is not None:
+            hasher.update(chunk)
+        outs.write(chunk)
+        copiedCount += readCount
+    return copiedCount
+
+
+def dropCachedPages(path):
+    """
+    Write the file at path to the device and drop it from the page
+    cache (if the system supports it), so reading it again reads what
+    is on the device.
+    """
+    fadvise = getattr(os, "posix_fadvise", None)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        if fadvise is not None:
+            fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def copyFile(src, dst, verify=None):
+    """
+    Copy src to dst (replacing it) including the modification time and
+    permissions. The copy is done in the kernel where possible.
+
+    Keyword arguments:
+    verify -- (default enableVerify) hash the data while copying it,
+              then read the copy back from the device (see
+              dropCachedPages) and raise OSError (EIO) if it does not
+              match. The data passes through Python in this case, since
+              it has to be read to hash it anyway.
+    """
+    if verify is None:
+        verify = enableVerify
+    hasher = None
+    with open(src, 'rb') as ins:
+        size = os.fstat(ins.fileno()).st_size
+        with open(dst, 'wb') as outs:
+            preallocate(outs.fileno(), size)
+            copiedCount = None
+            if verify:
+                hasher = newHasher()
+                copiedCount = _copyInPython(ins, outs, hasher=hasher)
+            else:
+                copiedCount = _copyInKernel(ins.fileno(), outs.fileno(),
+                                            size)
+                if copiedCount is None:
+                    copiedCount = _copyInPython(ins, outs)
+    if copiedCount != size:
+        raise OSError(errno.EIO, "The size changed while copying", src)
+    shutil.copystat(src, dst)
+    count("bytes.copied", copiedCount)
+    if verify:
+        dropCachedPages(dst)
+        if hashFile(dst) != hasher.hexdigest():
+            raise OSError(errno.EIO, "The copy does not match", dst)
+    return copiedCount
+
+
+def transferFile(src, dst, verify=None):
+    """
+    Move src to dst (replacing it) like shutil.move, but copy
+    cross-device files with copyFile after checking the free space, and
+    only remove src once the copy is complete (and verified, see
+    copyFile). The folder of dst must exist.
+
+    Returns True if the file was copied, or False if it was renamed.
+    """
+    try:
+        os.rename(src, dst)
+        return False
+    except OSError as ex:
+        if ex.errno != errno.EXDEV:
+            raise
+    if os.path.islink(src):
+        shutil.move(src, dst)
+        return False
+    checkFreeSpace(os.path.dirname(dst), os.path.getsize(src))
+    try:
+        copyFile(src, dst, verify=verify)
+    except BaseException:
+        if os.path.isfile(dst):
+            os.remove(dst)
+        raise
+    os.remove(src)
+    return True
+
+
+def _transferPair(pair):
+    try:
+        transferFile(pair[0], pair[1])
+    except OSError as ex:
+        return ex
+    return None
+
+
+def iterTransfers(pairs, streamCount=1, inOrder=True):
+    """
+    Do transferFile for each (src, dst) pair, using streamCount threads
+    (the copying is done outside of Python's lock, so streams to or from
+    different disks can overlap). Yield (src, dst, error) in the same
+    order as pairs (or as each finishes if inOrder is False), where
+    error is None or the OSError that happened.
+    """
+    pairs = list(pairs)
+    if streamCount < 2:
+        for pair in pairs:
+            yield pair[0], pair[1], _transferPair(pair)
+        return
+    with ThreadPoolExecutor(max_workers=streamCount) as executor:
+        if inOrder:
+            for pair, error in zip(pairs,
+                                   executor.map(_transferPair, pairs)):
+                yield pair[0], pair[1], error
+            return
+        pairByFuture = {}
+        for pair in pairs:
+            pairByFuture[executor.submit(_transferPair, pair)] = pair
+        for future in as_completed(pairByFuture):
+            pair = pairByFuture[future]
+            yield pair[0], pair[1], future.result()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Walk a directory tree with os.scandir so that each entry's type (and
+stat result, once requested) is cached in its os.DirEntry instead of
+being looked up again with os.path.isfile, isdir and getsize. The walk
+uses a stack instead of recursion, so deep trees do not reach Python's
+recursion limit.
+"""
+import os
+
+
+def scanFolder(folderPath, skipNames=None, skipDotDirs=False,
+               skipDotFiles=False, followLinks=False):
+    """
+    List a directory in a single os.scandir pass.
+
+    Returns a tuple of (dirEntries, fileEntries) lists of os.DirEntry in
+    the order the system lists them. Directories named in skipNames and
+    entries that are neither files nor directories are left out.
+
+    Keyword arguments:
+    skipDotDirs -- leave out directories whose name starts with "."
+    skipDotFiles -- leave out files whose name starts with "."
+    followLinks -- include symbolic links to directories in dirEntries
+    """
+    dirEntries = []
+    fileEntries = []
+    with os.scandir(folderPath) as entries:
+        for entry in entries:
+            name = entry.name
+            isDot = name[:1] == "."
+            try:
+                isDir = entry.is_dir()
+            except OSError:
+                isDir = False
+            if isDir:
+                if skipDotDirs and isDot:
+                    continue
+                if (skipNames is not None) and (name in skipNames):
+                    continue
+                if (not followLinks) and entry.is_symlink():
+                    continue
+                dirEntries.append(entry)
+                continue
+            if skipDotFiles and isDot:
+                continue
+            try:
+                if entry.is_file():
+                    fileEntries.append(entry)
+            except OSError:
+                pass
+    return dirEntries, fileEntries
+
+
+def walkEntries(topPath, skipNames=None, skipDotDirs=False,
+                skipDotFiles=False, topDown=True, followLinks=False,
+                onError=None, skipDir=None):
+    """
+    Yield (folderPath, depth, dirEntries, fileEntries) for topPath (depth
+    0) and each directory under it (see scanFolder for the arguments
+    shared with it).
+
+    If skipDir is not None, a directory is left out of dirEntries (and
+    not walked) if skipDir(entry, depth) is True, where entry is its
+    os.DirEntry and depth is the depth of the directory it is in.
+
+    If topDown is True, a directory is yielded before the directories in
+    it, and the caller may remove entries from dirEntries to prevent
+    walking into them. Otherwise a directory is yielded after all of the
+    directories in it (so they may be renamed safely).
+
+    If listing a directory fails, onError(folderPath, error) is called
+    (if provided) and the directory is skipped.
+    """
+    # Each item is (folderPath, depth, scanned) where scanned is None
+    # until the folder was listed and its subfolders were queued.
+    pending = [(topPath, 0, None)]
+    while pending:
+        folderPath, depth, scanned = pending.pop()
+        if scanned is not None:
+            yield (folderPath, depth, scanned[0], scanned[1])
+            continue
+        try:
+            dirEntries, fileEntries = scanFolder(
+                folderPath,
+                skipNames=skipNames,
+                skipDotDirs=skipDotDirs,
+                skipDotFiles=skipDotFiles,
+                followLinks=followLinks,
+            )
+        except OSError as ex:
+            if onError is not None:
+                onError(folderPath, ex)
+            continue
+        if skipDir is not None:
+            dirEntries = [entry for entry in dirEntries
+                          if not skipDir(entry, depth)]
+        if topDown:
+            yield (folderPath, depth, dirEntries, fileEntries)
+        else:
+            pending.append((folderPath, depth, (dirEntries, fileEntries)))
+        # Add in reverse so the first directory listed is walked first.
+        for entry in reversed(dirEntries):
+            pending.append((entry.path, depth + 1, None))
+
+
+def iterFileEntries(topPath, **kwargs):
+    """
+    Yield (folderPath, entry) for each file under topPath (top-down).
+    The keyword arguments are the same as for walkEntries.
+    """
+    for folderPath, depth, dirEntries, fileEntries in \
+            walkEntries(topPath, **kwargs):
+        for entry in fileEntries:
+            yield folderPath, entry